@@ -29,6 +29,15 @@ from shadowsocks import common, lru_cache, eventloop, shell
 
 CACHE_SWEEP_INTERVAL = 30
 
+# resend the query if there is no response in DNS_RETRY_INTERVAL seconds,
+# and give up after DNS_MAX_RETRIES retries
+DNS_RETRY_INTERVAL = 2
+DNS_MAX_RETRIES = 3
+
+# we ask for A and AAAA at the same time, once one of them is answered, we
+# wait at most RESOLUTION_DELAY seconds for the other, RFC 8305 section 3
+RESOLUTION_DELAY = 0.05
+
 VALID_HOSTNAME = re.compile(br"(?!-)[A-Z\d-]{1,63}(?<!-)$", re.IGNORECASE)
 
 common.patch_socket()
@@ -242,8 +251,27 @@ class DNSResponse(object):
         return '%s: %s' % (self.hostname, str(self.answers))
 
 
-STATUS_IPV4 = 0
-STATUS_IPV6 = 1
+def sort_addresses(ipv4, ipv6):
+    # interleave the families, IPv6 first, RFC 8305 section 4
+    result = []
+    for i in range(0, max(len(ipv4), len(ipv6))):
+        if i < len(ipv6):
+            result.append(ipv6[i])
+        if i < len(ipv4):
+            result.append(ipv4[i])
+    return result
+
+
+def preferred_address(ips):
+    # callbacks get (hostname, ip, ips), ips are all the addresses in the
+    # order we should try them, ip is the one for those who use only one,
+    # IPv4 if there is one, as we did before
+    for ip in ips:
+        if common.is_ip(ip) == socket.AF_INET:
+            return ip
+    if ips:
+        return ips[0]
+    return None
 
 
 # DNS 解析器
@@ -253,10 +281,15 @@ class DNSResolver(object):
     def __init__(self, server_list=None):
         self._loop = None
         self._hosts = {}
+        # hostname: the qtypes we are still waiting for
         self._hostname_status = {}
+        # hostname: {qtype: [ip]}
+        self._hostname_to_ips = {}
         self._hostname_to_cb = {}
         self._cb_to_hostname = {}
+        self._hostname_to_timer = {}
         self._cache = lru_cache.LRUCache(timeout=300)
+        self._sweep_timer = None
         self._sock = None
         if server_list is None:
             # 如果没有指定 dns 服务器，则读取 /etc/resolv.conf
@@ -321,46 +354,58 @@ class DNSResolver(object):
                                    socket.SOL_UDP)
         self._sock.setblocking(False)
         loop.add(self._sock, eventloop.POLL_IN, self)
-        loop.add_periodic(self.handle_periodic)
+        self._sweep_timer = loop.call_later(CACHE_SWEEP_INTERVAL,
+                                            self.handle_periodic)
 
-    def _call_callback(self, hostname, ip, error=None):
+    def _call_callback(self, hostname, ips, error=None):
+        ip = preferred_address(ips)
         callbacks = self._hostname_to_cb.get(hostname, [])
         for callback in callbacks:
             if callback in self._cb_to_hostname:
                 del self._cb_to_hostname[callback]
             if ip or error:
-                callback((hostname, ip), error)
+                callback((hostname, ip, ips), error)
             else:
-                callback((hostname, None),
+                callback((hostname, None, ips),
                          Exception('unknown hostname %s' % hostname))
         if hostname in self._hostname_to_cb:
             del self._hostname_to_cb[hostname]
-        if hostname in self._hostname_status:
-            del self._hostname_status[hostname]
+        self._hostname_status.pop(hostname, None)
+        self._hostname_to_ips.pop(hostname, None)
+        self._cancel_retry(hostname)
+
+    def _handle_resolved(self, hostname):
+        # got both answers, or waited long enough for the other one
+        self._cancel_retry(hostname)
+        answers = self._hostname_to_ips.get(hostname, {})
+        ips = sort_addresses(answers.get(QTYPE_A, []),
+                             answers.get(QTYPE_AAAA, []))
+        if ips:
+            self._cache[hostname] = ips
+        self._call_callback(hostname, ips)
 
     def _handle_data(self, data):
         response = parse_response(data)
-        if response and response.hostname:
+        if response and response.hostname and response.questions:
             hostname = response.hostname
-            ip = None
-            for answer in response.answers:
-                if answer[1] in (QTYPE_A, QTYPE_AAAA) and \
-                        answer[2] == QCLASS_IN:
-                    ip = answer[0]
-                    break
-            if not ip and self._hostname_status.get(hostname, STATUS_IPV6) \
-                    == STATUS_IPV4:
-                self._hostname_status[hostname] = STATUS_IPV6
-                self._send_req(hostname, QTYPE_AAAA)
-            else:
-                if ip:
-                    self._cache[hostname] = ip
-                    self._call_callback(hostname, ip)
-                elif self._hostname_status.get(hostname, None) == STATUS_IPV6:
-                    for question in response.questions:
-                        if question[1] == QTYPE_AAAA:
-                            self._call_callback(hostname, None)
-                            break
+            qtype = response.questions[0][1]
+            pending = self._hostname_status.get(hostname, None)
+            if not pending or qtype not in pending:
+                # we have got this answer from another server
+                return
+            pending.remove(qtype)
+            ips = [answer[0] for answer in response.answers
+                   if answer[1] == qtype and answer[2] == QCLASS_IN]
+            answers = self._hostname_to_ips.setdefault(hostname, {})
+            answers[qtype] = ips
+            if not pending:
+                self._handle_resolved(hostname)
+            elif ips:
+                # don't wait for the other family too long, it may be broken
+                self._cancel_retry(hostname)
+                self._hostname_to_timer[hostname] = \
+                    self._loop.call_later(RESOLUTION_DELAY,
+                                          self._handle_resolved, hostname)
 
     def handle_event(self, sock, fd, event):
         if sock != self._sock:
@@ -383,6 +428,32 @@ class DNSResolver(object):
 
     def handle_periodic(self):
         self._cache.sweep()
+        self._sweep_timer = self._loop.call_later(CACHE_SWEEP_INTERVAL,
+                                                  self.handle_periodic)
+
+    def _schedule_retry(self, hostname, retries):
+        self._cancel_retry(hostname)
+        self._hostname_to_timer[hostname] = \
+            self._loop.call_later(DNS_RETRY_INTERVAL, self._handle_retry,
+                                  hostname, retries)
+
+    def _cancel_retry(self, hostname):
+        timer = self._hostname_to_timer.pop(hostname, None)
+        if timer:
+            self._loop.cancel(timer)
+
+    def _handle_retry(self, hostname, retries):
+        del self._hostname_to_timer[hostname]
+        if hostname not in self._hostname_to_cb:
+            return
+        if retries >= DNS_MAX_RETRIES:
+            self._call_callback(hostname, [],
+                                Exception('timed out resolving %s' %
+                                          common.to_str(hostname)))
+            return
+        for qtype in self._hostname_status.get(hostname, ()):
+            self._send_req(hostname, qtype)
+        self._schedule_retry(hostname, retries + 1)
 
     def remove_callback(self, callback):
         hostname = self._cb_to_hostname.get(callback)
@@ -393,8 +464,9 @@ class DNSResolver(object):
                 arr.remove(callback)
                 if not arr:
                     del self._hostname_to_cb[hostname]
-                    if hostname in self._hostname_status:
-                        del self._hostname_status[hostname]
+                    self._hostname_status.pop(hostname, None)
+                    self._hostname_to_ips.pop(hostname, None)
+                    self._cancel_retry(hostname)
 
     def _send_req(self, hostname, qtype):
         req = build_request(hostname, qtype)
@@ -409,34 +481,40 @@ class DNSResolver(object):
         if not hostname:
             callback(None, Exception('empty hostname'))
         elif common.is_ip(hostname):
-            callback((hostname, hostname), None)
+            callback((hostname, hostname, [hostname]), None)
         elif hostname in self._hosts:
             logging.debug('hit hosts: %s', hostname)
             ip = self._hosts[hostname]
-            callback((hostname, ip), None)
+            callback((hostname, ip, [ip]), None)
         elif hostname in self._cache:
             logging.debug('hit cache: %s', hostname)
-            ip = self._cache[hostname]
-            callback((hostname, ip), None)
+            ips = self._cache[hostname]
+            callback((hostname, preferred_address(ips), ips), None)
         else:
             if not is_valid_hostname(hostname):
                 callback(None, Exception('invalid hostname: %s' % hostname))
                 return
             arr = self._hostname_to_cb.get(hostname, None)
             if not arr:
-                self._hostname_status[hostname] = STATUS_IPV4
+                self._hostname_status[hostname] = set([QTYPE_A, QTYPE_AAAA])
                 self._send_req(hostname, QTYPE_A)
+                self._send_req(hostname, QTYPE_AAAA)
                 self._hostname_to_cb[hostname] = [callback]
                 self._cb_to_hostname[callback] = hostname
+                self._schedule_retry(hostname, 0)
             else:
+                # the query is still pending, the retry timer will send it
+                # again if it waited too long
                 arr.append(callback)
-                # TODO send again only if waited too long
-                self._send_req(hostname, QTYPE_A)
+                self._cb_to_hostname[callback] = hostname
 
     def close(self):
         if self._sock:
             if self._loop:
-                self._loop.remove_periodic(self.handle_periodic)
+                self._loop.cancel(self._sweep_timer)
+                for timer in self._hostname_to_timer.values():
+                    self._loop.cancel(timer)
+                self._hostname_to_timer.clear()
                 self._loop.remove(self._sock)
             self._sock.close()
             self._sock = None
@@ -487,5 +565,101 @@ def test():
     loop.run()
 
 
+def test_sort_addresses():
+    assert sort_addresses([], []) == []
+    assert sort_addresses(['1.1.1.1', '2.2.2.2'], ['::1']) == \
+        ['::1', '1.1.1.1', '2.2.2.2']
+    assert preferred_address(['::1', '1.1.1.1']) == '1.1.1.1'
+    assert preferred_address(['::1']) == '::1'
+    assert preferred_address([]) is None
+
+
+def test_resolve_all():
+    # answers the queries ourselves instead of a DNS server
+
+    def build_response(hostname, qtype, ips):
+        request = build_request(hostname, qtype)
+        # QR and RD set, RA set, one question and len(ips) answers
+        response = request[:2] + struct.pack('!BBHHHH', 0x81, 0x80, 1,
+                                             len(ips), 0, 0) + request[12:]
+        if qtype == QTYPE_A:
+            family = socket.AF_INET
+        else:
+            family = socket.AF_INET6
+        for ip in ips:
+            rdata = socket.inet_pton(family, ip)
+            # the name is a pointer to the question
+            response += struct.pack('!HHHiH', 0xC00C, qtype, QCLASS_IN, 300,
+                                    len(rdata)) + rdata
+        return response
+
+    loop = eventloop.EventLoop()
+    dns_resolver = DNSResolver(['127.0.0.1'])
+    dns_resolver.add_to_loop(loop)
+    results = {}
+
+    def callback(result, error):
+        results[result[0]] = (result[1], result[2], error)
+
+    dns_resolver.resolve('dual.test', callback)
+    dns_resolver._handle_data(build_response(b'dual.test', QTYPE_A,
+                                             ['1.1.1.1', '2.2.2.2']))
+    assert not results
+    dns_resolver._handle_data(build_response(b'dual.test', QTYPE_AAAA,
+                                             ['2001:db8::1']))
+    assert results[b'dual.test'] == \
+        ('1.1.1.1', ['2001:db8::1', '1.1.1.1', '2.2.2.2'], None)
+
+    # the other answer comes within RESOLUTION_DELAY, the callback is called
+    # only once, and a new lookup isn't disturbed by the first one
+    calls = []
+
+    def counting_callback(result, error):
+        calls.append((result, error))
+
+    dns_resolver.resolve('late.test', counting_callback)
+    dns_resolver._handle_data(build_response(b'late.test', QTYPE_A,
+                                             ['4.4.4.4']))
+    dns_resolver._handle_data(build_response(b'late.test', QTYPE_AAAA,
+                                             ['2001:db8::4']))
+    assert len(calls) == 1
+    del dns_resolver._cache[b'late.test']
+    dns_resolver.resolve('late.test', counting_callback)
+    assert dns_resolver._hostname_status[b'late.test']
+
+    # the AAAA answer never comes
+    dns_resolver.resolve('v4.test', callback)
+    dns_resolver._handle_data(build_response(b'v4.test', QTYPE_A,
+                                             ['3.3.3.3']))
+    assert b'v4.test' not in results
+
+    # neither has any records
+    dns_resolver.resolve('none.test', callback)
+    dns_resolver._handle_data(build_response(b'none.test', QTYPE_AAAA, []))
+    dns_resolver._handle_data(build_response(b'none.test', QTYPE_A, []))
+    assert results[b'none.test'][0] is None
+    assert results[b'none.test'][2] is not None
+
+    def check():
+        assert len(calls) == 1
+        assert dns_resolver._hostname_status[b'late.test']
+        assert results[b'v4.test'] == ('3.3.3.3', ['3.3.3.3'], None)
+        # from the cache
+        results.clear()
+        dns_resolver.resolve('dual.test', callback)
+        assert results[b'dual.test'][1] == \
+            ['2001:db8::1', '1.1.1.1', '2.2.2.2']
+        dns_resolver.close()
+        loop.stop()
+
+    loop.call_later(RESOLUTION_DELAY * 2, check)
+    loop.call_later(5, loop.stop)
+    loop.run()
+    # check() has run
+    assert list(results.keys()) == [b'dual.test']
+
+
 if __name__ == '__main__':
+    test_sort_addresses()
+    test_resolve_all()
     test()
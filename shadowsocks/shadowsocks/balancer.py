@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# chooses a server for sslocal when there are more than one
+#
+# the power of two choices: pick two servers at random, and use the one with
+# the lower connect latency, weighted by its connections in flight
+# a server that fails to connect EJECT_AFTER times in a row is not chosen
+# for a while, twice as long each time it fails again
+# 随机取两台服务器，选延迟和连接数更小的那台，连续失败的服务器暂时不用
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import random
+import logging
+
+from shadowsocks import common, eventloop
+
+__all__ = ['Balancer']
+
+# weight of a new latency sample in the moving average
+EWMA_WEIGHT = 0.3
+
+EJECT_AFTER = 2
+
+# seconds
+EJECT_TIME = 5
+MAX_EJECT_TIME = 300
+
+
+class ServerStat(object):
+    def __init__(self, address):
+        self.address = address
+        # moving average of connect latency in seconds, None until measured
+        self.latency = None
+        self.in_flight = 0
+        # consecutive failures
+        self.failures = 0
+        self.eject_time = EJECT_TIME
+        self.ejected_until = 0
+
+    def score(self):
+        # lower is better, a server we haven't measured yet is tried first
+        return (self.latency or 0) * (self.in_flight + 1)
+
+
+class Balancer(object):
+    """
+    servers is a list of (server, server_port)
+
+    TCP acquire()s a server for each connection, reports how connecting went
+    and release()s it when the connection is closed, UDP only choose()s, as
+    it can't tell whether a server is alive
+    """
+
+    def __init__(self, servers):
+        self._stats = {}
+        for address in servers:
+            self._stats[address] = ServerStat(address)
+        self._servers = list(self._stats.values())
+
+    @staticmethod
+    def from_config(config):
+        servers = config['server']
+        if type(servers) != list:
+            servers = [servers]
+        ports = config['server_port']
+        if type(ports) != list:
+            ports = [ports]
+        return Balancer([(server, port) for server in servers
+                         for port in ports])
+
+    def choose(self):
+        servers = self._servers
+        if len(servers) == 1:
+            return servers[0].address
+        now = eventloop.monotonic()
+        candidates = [s for s in servers if s.ejected_until <= now]
+        if not candidates:
+            # all of them are failing, try the one that comes back first
+            return min(servers, key=lambda s: s.ejected_until).address
+        if len(candidates) == 1:
+            return candidates[0].address
+        a, b = random.sample(candidates, 2)
+        if b.score() < a.score():
+            a = b
+        return a.address
+
+    def acquire(self):
+        address = self.choose()
+        self._stats[address].in_flight += 1
+        return address
+
+    def release(self, address):
+        stat = self._stats.get(address, None)
+        if stat is not None and stat.in_flight > 0:
+            stat.in_flight -= 1
+
+    def report_success(self, address, latency):
+        stat = self._stats.get(address, None)
+        if stat is None:
+            return
+        if stat.latency is None:
+            stat.latency = latency
+        else:
+            stat.latency += (latency - stat.latency) * EWMA_WEIGHT
+        stat.failures = 0
+        stat.eject_time = EJECT_TIME
+
+    def report_failure(self, address):
+        stat = self._stats.get(address, None)
+        if stat is None:
+            return
+        stat.failures += 1
+        if stat.failures < EJECT_AFTER or len(self._servers) == 1:
+            return
+        logging.warn('server %s:%d failed %d times, not using it for %ds',
+                     common.to_str(address[0]), address[1], stat.failures,
+                     stat.eject_time)
+        stat.ejected_until = eventloop.monotonic() + stat.eject_time
+        # if it fails again right after it comes back, eject it for longer
+        stat.eject_time = min(stat.eject_time * 2, MAX_EJECT_TIME)
+
+    def stat(self, address):
+        return self._stats[address]
+
+
+def test_choose():
+    fast = ('a', 8388)
+    slow = ('b', 8388)
+    balancer = Balancer([fast, slow])
+    balancer.report_success(fast, 0.01)
+    balancer.report_success(slow, 0.305)
+    for i in range(0, 10):
+        assert balancer.choose() == fast
+    # until the fast one has 30 connections in flight
+    for i in range(0, 30):
+        assert balancer.acquire() == fast
+    assert balancer.choose() == slow
+    for i in range(0, 30):
+        balancer.release(fast)
+    assert balancer.stat(fast).in_flight == 0
+    assert balancer.choose() == fast
+
+
+def test_eject():
+    a = ('a', 8388)
+    b = ('b', 8388)
+    balancer = Balancer([a, b])
+    balancer.report_success(b, 0.3)
+    balancer.report_failure(a)
+    assert balancer.stat(a).ejected_until == 0
+    balancer.report_failure(a)
+    assert balancer.stat(a).ejected_until > 0
+    for i in range(0, 10):
+        assert balancer.choose() == b
+    # b fails as well, a comes back first
+    balancer.report_failure(b)
+    balancer.report_failure(b)
+    assert balancer.choose() == a
+    # a is back, and fails again, for twice as long
+    balancer.stat(a).ejected_until = 0
+    balancer.report_failure(a)
+    assert balancer.stat(a).eject_time == EJECT_TIME * 4
+    balancer.report_success(a, 0.1)
+    assert balancer.stat(a).failures == 0
+    assert balancer.stat(a).eject_time == EJECT_TIME
+
+
+def test_from_config():
+    balancer = Balancer.from_config({'server': ['a', 'b'],
+                                     'server_port': [1, 2]})
+    assert len(balancer._servers) == 4
+    balancer = Balancer.from_config({'server': 'a', 'server_port': 1})
+    assert balancer.acquire() == ('a', 1)
+    balancer.report_failure(('a', 1))
+    balancer.report_failure(('a', 1))
+    # never eject the only server
+    assert balancer.stat(('a', 1)).ejected_until == 0
+
+
+if __name__ == '__main__':
+    test_choose()
+    test_eject()
+    test_from_config()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import errno
+import socket
+import collections
+import itertools
+
+__all__ = ['BufferPool', 'WriteQueue', 'MemoryBudget', 'ZERO_COPY']
+
+# we can only pass a pointer into a memoryview to ctypes on Python 3
+ZERO_COPY = bytes != str
+
+# keep at most MAX_FREE_BUFFERS free buffers in each pool
+MAX_FREE_BUFFERS = 64
+
+# a chunk smaller than 1/SMALL_CHUNK of its pooled buffer is copied out, and
+# the buffer goes back to the pool at once, so that small reads don't pin a
+# whole buffer each
+SMALL_CHUNK = 8
+
+# socket.sendmsg() is available on Python 3.3+ and Unix, it sends several
+# buffers in one syscall, like writev()
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# send at most MAX_IOV buffers in one sendmsg() call, Linux allows 1024
+MAX_IOV = 64
+
+# default watermarks of the write queues in bytes
+# once a queue grows beyond the high watermark, we stop reading the other side
+# of the connection, and resume once the queue drains below the low watermark
+HIGH_WATERMARK = 128 * 1024
+LOW_WATERMARK = 32 * 1024
+
+
+# 缓冲池，复用固定大小的 bytearray，避免每次 recv 都分配一个新的 bytes 对象
+# 配合 sock.recv_into() 和 memoryview 使用
+class BufferPool(object):
+    """This class is not thread safe, use one pool for each event loop"""
+
+    def __init__(self, size, max_free=MAX_FREE_BUFFERS):
+        self.size = size
+        self._max_free = max_free
+        self._free = []
+
+    def get(self):
+        if self._free:
+            return self._free.pop()
+        return bytearray(self.size)
+
+    def put(self, buf):
+        # the caller must not keep any memoryview of buf after put()
+        if len(self._free) < self._max_free:
+            self._free.append(buf)
+
+    def __len__(self):
+        return len(self._free)
+
+
+# 多个写队列共享的内存预算，统计所有队列占用的内存，池中的缓冲区按整块计算
+class MemoryBudget(object):
+    """This class is not thread safe"""
+
+    def __init__(self, limit=0):
+        # limit is in bytes, 0 means unlimited
+        self.limit = limit
+        self.used = 0
+
+    @property
+    def exceeded(self):
+        return 0 < self.limit < self.used
+
+
+# 待发送数据队列，保存 memoryview 而不是把所有数据拼接成一个大 bytes
+# 部分发送时只移动偏移量，不复制剩余数据
+class WriteQueue(object):
+    """This class is not thread safe"""
+
+    def __init__(self, pool=None, budget=None):
+        # pool is where the pooled buffers in this queue go back to
+        # budget is a MemoryBudget shared with other queues
+        self._pool = pool
+        self._budget = budget
+        self._queue = collections.deque()  # (data, buf, held)
+        # bytes waiting to be sent
+        self._size = 0
+        # bytes the queue keeps in memory, a chunk counts as a whole as long
+        # as any of it is waiting, held is what each chunk counts for, the
+        # size of its pooled buffer, or of the data when it was appended
+        self._memory = 0
+
+    def append(self, data, buf=None):
+        # if data is a memoryview of the pooled buffer buf, the queue owns
+        # buf from now on, and puts it back to the pool once data is sent
+        if buf is not None and (type(data) != memoryview or
+                                len(data) * SMALL_CHUNK < len(buf)):
+            if type(data) == memoryview:
+                data = data.tobytes()
+            self._pool.put(buf)
+            buf = None
+        if not data:
+            if buf is not None:
+                self._pool.put(buf)
+            return
+        held = len(buf) if buf is not None else len(data)
+        self._queue.append((data, buf, held))
+        self._size += len(data)
+        self._hold(held)
+
+    def _hold(self, n):
+        self._memory += n
+        if self._budget is not None:
+            self._budget.used += n
+
+    def __len__(self):
+        # bytes waiting to be sent
+        return self._size
+
+    @property
+    def memory(self):
+        return self._memory
+
+    def __bool__(self):
+        return self._size > 0
+
+    __nonzero__ = __bool__
+
+    def join(self):
+        # all the data in the queue as one bytes object, without consuming it
+        return b''.join(bytes(data) if type(data) != bytes else data
+                        for data, buf, held in self._queue)
+
+    def consume(self, n):
+        # drop the first n bytes, which have been sent
+        queue = self._queue
+        self._size -= n
+        while n > 0:
+            data, buf, held = queue[0]
+            size = len(data)
+            if n < size:
+                # the rest is a view of the same chunk, which stays in
+                # memory until it is popped
+                if ZERO_COPY and type(data) != memoryview:
+                    data = memoryview(data)
+                queue[0] = (data[n:], buf, held)
+                return
+            queue.popleft()
+            self._hold(-held)
+            if buf is not None:
+                self._pool.put(buf)
+            n -= size
+
+    def send(self, sock):
+        # send as much as possible, returns bytes sent
+        # socket errors other than EAGAIN are raised
+        queue = self._queue
+        total = 0
+        while queue:
+            try:
+                if HAS_SENDMSG and len(queue) > 1:
+                    datas = [data for data, buf, held in
+                             itertools.islice(queue, 0, MAX_IOV)]
+                    size = sum(map(len, datas))
+                    s = sock.sendmsg(datas)
+                else:
+                    size = len(queue[0][0])
+                    s = sock.send(queue[0][0])
+            except (OSError, IOError) as e:
+                if e.errno in (errno.EAGAIN, errno.EINPROGRESS,
+                               errno.EWOULDBLOCK):
+                    break
+                raise
+            self.consume(s)
+            total += s
+            if s < size:
+                # the socket buffer is full
+                break
+        return total
+
+    def clear(self):
+        for data, buf, held in self._queue:
+            if buf is not None:
+                self._pool.put(buf)
+        self._queue.clear()
+        self._hold(-self._memory)
+        self._size = 0
+
+
+def test_buffer_pool():
+    pool = BufferPool(16, max_free=2)
+    a = pool.get()
+    b = pool.get()
+    c = pool.get()
+    assert len(a) == 16 and a is not b
+    pool.put(a)
+    pool.put(b)
+    pool.put(c)
+    assert len(pool) == 2
+    assert pool.get() is b
+    assert pool.get() is a
+    assert len(pool.get()) == 16
+
+
+def test_write_queue():
+    pool = BufferPool(16)
+    queue = WriteQueue(pool)
+    buf = pool.get()
+    buf[:] = b'0123456789abcdef'
+    # 10 of 16 is not a small chunk, it stays in the buffer
+    queue.append(b'hello ')
+    queue.append(b'')
+    if ZERO_COPY:
+        queue.append(memoryview(buf)[:10], buf)
+    else:
+        queue.append(b'0123456789')
+    assert len(queue) == 16
+    assert queue.join() == b'hello 0123456789'
+    queue.consume(3)
+    assert queue.join() == b'lo 0123456789'
+    queue.consume(5)
+    assert len(queue) == 8 and len(pool) == 0
+    queue.consume(8)
+    assert not queue
+    assert queue.memory == 0
+    if ZERO_COPY:
+        assert len(pool) == 1
+
+    budget = MemoryBudget(10)
+    q1 = WriteQueue(budget=budget)
+    q2 = WriteQueue(budget=budget)
+    q1.append(b'x' * 6)
+    q2.append(b'y' * 4)
+    assert budget.used == 10 and not budget.exceeded
+    q2.append(b'z')
+    assert budget.exceeded
+    # a partly sent chunk still counts as a whole
+    q1.consume(2)
+    assert budget.used == 11 and budget.exceeded
+    q1.consume(4)
+    assert budget.used == 5 and not budget.exceeded
+    q2.clear()
+    assert budget.used == 0
+
+    # a pooled buffer counts as a whole while any of it is queued, a small
+    # chunk is copied out so it doesn't pin its buffer
+    pool = BufferPool(64)
+    budget = MemoryBudget(100)
+    queue = WriteQueue(pool, budget)
+    buf = pool.get()
+    queue.append(memoryview(buf)[:16], buf)
+    small = pool.get()
+    queue.append(memoryview(small)[:4], small)
+    assert len(queue) == 20
+    if ZERO_COPY:
+        assert queue.memory == budget.used == 64 + 4
+        assert len(pool) == 1
+    queue.consume(10)
+    if ZERO_COPY:
+        assert queue.memory == 64 + 4
+    queue.consume(8)
+    assert queue.memory == budget.used == 4
+    queue.clear()
+    assert budget.used == 0
+    if ZERO_COPY:
+        # 32 bytes of data pin two buffers, that is over the budget, so the
+        # handlers stop reading
+        for i in range(0, 2):
+            buf = pool.get()
+            queue.append(memoryview(buf)[:16], buf)
+        assert len(queue) == 32
+        assert budget.exceeded
+        queue.clear()
+        assert not budget.exceeded
+
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    queue = WriteQueue(BufferPool(16))
+    for i in range(0, 4):
+        queue.append(b'x' * 1024)
+    assert queue.send(a) == 4096
+    assert b.recv(8192) == b'x' * 4096
+    # fill the socket buffer, the rest stays in the queue
+    for i in range(0, 1024):
+        queue.append(b'y' * 4096)
+    sent = queue.send(a)
+    assert 0 < sent < 4096 * 1024
+    assert len(queue) == 4096 * 1024 - sent
+    queue.clear()
+    assert not queue
+    a.close()
+    b.close()
+
+
+if __name__ == '__main__':
+    test_buffer_pool()
+    test_write_queue()
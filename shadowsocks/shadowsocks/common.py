@@ -127,6 +127,20 @@ def patch_socket():
 patch_socket()
 
 
+# Python 2 doesn't define SO_REUSEPORT, 15 is the value on Linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+def set_reuse_port(sock):
+    # allow several processes to bind the same address, so that each worker
+    # can have its own listening socket, requires Linux 3.9+
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    except (OSError, IOError):
+        logging.error('SO_REUSEPORT is not available on this OS')
+        raise
+
+
 ADDRTYPE_IPV4 = 1
 ADDRTYPE_IPV6 = 4
 ADDRTYPE_HOST = 3
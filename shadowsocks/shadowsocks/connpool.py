@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# idle connections to a server that sslocal connected in advance, so that a
+# new SOCKS5 request doesn't wait a round trip for the TCP handshake
+# 提前连好 ss 服务器，新连接直接拿来用，省掉一次握手的往返时间
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import errno
+import socket
+import logging
+from collections import deque
+
+from shadowsocks import eventloop
+
+__all__ = ['ConnectionPool']
+
+# the server times out connections without data after its timeout, 300s by
+# default, so we close idle connections well before that
+MAX_IDLE = 30
+
+# after a failed connection, we wait RETRY_DELAY seconds before trying
+# again, twice as long after each failure, up to MAX_RETRY_DELAY
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+
+class ConnectionPool(object):
+    """
+    keeps up to size connected sockets to one server, refills itself in the
+    background, and drops the sockets that have been idle for too long or
+    are closed by the server
+    """
+
+    def __init__(self, loop, dns_resolver, server, port, size,
+                 max_idle=MAX_IDLE):
+        self._loop = loop
+        self._dns_resolver = dns_resolver
+        self._server = server
+        self._port = port
+        self._size = size
+        self._max_idle = max_idle
+        # (sock, connected at), the newest at the right
+        self._idle = deque()
+        # fd: sock
+        self._connecting = {}
+        self._resolving = False
+        self._retry_delay = RETRY_DELAY
+        self._retry_timer = None
+        self._closed = False
+        loop.add_periodic(self.handle_periodic)
+        self._fill()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def take(self):
+        # returns a connected socket, or None if there isn't one
+        # the socket is removed from the loop, the caller adds it again
+        # with its own handler
+        sock = None
+        while self._idle:
+            s, since = self._idle.pop()
+            self._loop.remove(s)
+            if self._is_alive(s):
+                sock = s
+                break
+            s.close()
+        self._fill()
+        return sock
+
+    def _is_alive(self, sock):
+        # the server may have closed it after the last poll
+        try:
+            return sock.recv(1, socket.MSG_PEEK) != b''
+        except (OSError, IOError) as e:
+            error_no = eventloop.errno_from_exception(e)
+            return error_no in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+    def _fill(self):
+        if self._closed or self._resolving or self._retry_timer:
+            return
+        if len(self._idle) + len(self._connecting) >= self._size:
+            return
+        self._resolving = True
+        # notice here may go into _on_resolved directly
+        self._dns_resolver.resolve(self._server, self._on_resolved)
+
+    def _on_resolved(self, result, error):
+        self._resolving = False
+        if self._closed:
+            return
+        if error or not result or not result[1]:
+            logging.warn('prewarm: can not resolve %s: %s', self._server,
+                         error)
+            self._retry_later()
+            return
+        ip = result[1]
+        try:
+            while len(self._idle) + len(self._connecting) < self._size:
+                self._connect(ip)
+        except (OSError, IOError) as e:
+            logging.warn('prewarm: can not connect to %s:%d: %s',
+                         self._server, self._port, e)
+            self._retry_later()
+
+    def _connect(self, ip):
+        addrs = socket.getaddrinfo(ip, self._port, 0, socket.SOCK_STREAM,
+                                   socket.SOL_TCP)
+        if len(addrs) == 0:
+            raise socket.error("getaddrinfo failed for %s:%d" %
+                               (ip, self._port))
+        af, socktype, proto, canonname, sa = addrs[0]
+        sock = socket.socket(af, socktype, proto)
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock.connect(sa)
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) != errno.EINPROGRESS:
+                sock.close()
+                raise
+        self._connecting[sock.fileno()] = sock
+        self._loop.add(sock, eventloop.POLL_OUT | eventloop.POLL_ERR, self)
+
+    def _retry_later(self):
+        if self._retry_timer or self._closed:
+            return
+        self._retry_timer = self._loop.call_later(self._retry_delay,
+                                                  self._retry)
+        self._retry_delay = min(self._retry_delay * 2, MAX_RETRY_DELAY)
+
+    def _retry(self):
+        self._retry_timer = None
+        self._fill()
+
+    def handle_event(self, sock, fd, event):
+        if fd in self._connecting:
+            del self._connecting[fd]
+            if event & eventloop.POLL_ERR or \
+                    sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                logging.warn('prewarm: can not connect to %s:%d: %s',
+                             self._server, self._port,
+                             eventloop.get_sock_error(sock))
+                self._loop.remove(sock)
+                sock.close()
+                self._retry_later()
+                return
+            self._retry_delay = RETRY_DELAY
+            # the server doesn't send anything before we do, so once it is
+            # readable, the server has closed it
+            self._loop.modify(sock, eventloop.POLL_IN | eventloop.POLL_ERR)
+            self._idle.append((sock, eventloop.monotonic()))
+            return
+        for i in range(0, len(self._idle)):
+            if self._idle[i][0] is sock:
+                logging.debug('prewarm: closed by %s:%d', self._server,
+                              self._port)
+                del self._idle[i]
+                self._loop.remove(sock)
+                sock.close()
+                # don't reconnect at once if the server closes the idle
+                # connections right away
+                self._retry_later()
+                return
+
+    def handle_periodic(self):
+        # close the sockets that have been idle for too long, the oldest are
+        # at the left
+        deadline = eventloop.monotonic() - self._max_idle
+        while self._idle and self._idle[0][1] < deadline:
+            sock = self._idle.popleft()[0]
+            self._loop.remove(sock)
+            sock.close()
+        self._fill()
+
+    def close(self):
+        self._closed = True
+        self._loop.remove_periodic(self.handle_periodic)
+        self._loop.cancel(self._retry_timer)
+        self._retry_timer = None
+        if self._resolving:
+            self._dns_resolver.remove_callback(self._on_resolved)
+            self._resolving = False
+        for sock in list(self._connecting.values()):
+            self._loop.remove(sock)
+            sock.close()
+        self._connecting.clear()
+        while self._idle:
+            sock = self._idle.pop()[0]
+            self._loop.remove(sock)
+            sock.close()
+
+
+def test_pool():
+    from shadowsocks import asyncdns
+
+    loop = eventloop.EventLoop()
+    dns_resolver = asyncdns.DNSResolver()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    port = listener.getsockname()[1]
+    pool = ConnectionPool(loop, dns_resolver, '127.0.0.1', port, 3)
+    # the server side of each connection, by the port of the client side
+    accepted = {}
+
+    def check():
+        assert len(pool) == 3
+        for i in range(0, 3):
+            conn, addr = listener.accept()
+            accepted[addr[1]] = conn
+        sock = pool.take()
+        assert sock is not None
+        sock.send(b'hello')
+        assert accepted.pop(sock.getsockname()[1]).recv(5) == b'hello'
+        # the server closes another one
+        accepted.popitem()[1].close()
+        loop.call_later(0.2, check_closed, sock)
+
+    def check_closed(sock):
+        sock.close()
+        # the one we took is replaced, the one closed by the server is not,
+        # until the retry delay
+        assert len(pool) == 2
+        pool.close()
+        loop.stop()
+
+    loop.call_later(0.2, check)
+    # don't wait forever if something is wrong
+    loop.call_later(5, loop.stop)
+    loop.run()
+    assert len(pool) == 0
+    assert len(accepted) == 1
+    for conn in accepted.values():
+        conn.close()
+    listener.close()
+
+
+def test_refused():
+    from shadowsocks import asyncdns
+
+    loop = eventloop.EventLoop()
+    dns_resolver = asyncdns.DNSResolver()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    # bound but not listening, so the connections are refused
+    pool = ConnectionPool(loop, dns_resolver, '127.0.0.1', port, 2)
+
+    def check():
+        assert pool.take() is None
+        assert pool._retry_timer is not None
+        pool.close()
+        loop.stop()
+
+    loop.call_later(0.2, check)
+    loop.call_later(5, loop.stop)
+    loop.run()
+    listener.close()
+
+
+if __name__ == '__main__':
+    test_pool()
+    test_refused()
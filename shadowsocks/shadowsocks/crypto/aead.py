@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# AEAD ciphers, see https://shadowsocks.org/en/spec/AEAD-Ciphers.html
+#
+# the IV of the other ciphers is used as the salt, a subkey is derived from
+# the key and the salt for each session
+#
+# TCP: [salt][encrypted length][length tag][encrypted payload][payload tag]...
+#      the length is 2 bytes in big endian, at most CHUNK_SIZE
+# UDP: [salt][encrypted payload][payload tag]
+#
+# the nonce is a little endian counter, starting from 0 for each subkey, and
+# increased after each encryption or decryption
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import hmac
+import struct
+import hashlib
+
+__all__ = ['AeadCryptoBase', 'AeadDecryptError', 'CHUNK_SIZE', 'TAG_SIZE']
+
+CHUNK_SIZE = 0x3FFF
+
+TAG_SIZE = 16
+
+NONCE_SIZE = 12
+
+SUBKEY_INFO = b'ss-subkey'
+
+
+class AeadDecryptError(Exception):
+    pass
+
+
+def hkdf_sha1(key, salt, info, length):
+    # HKDF with SHA1, RFC 5869
+    prk = hmac.new(salt, key, hashlib.sha1).digest()
+    okm = b''
+    t = b''
+    i = 0
+    while len(okm) < length:
+        i += 1
+        t = hmac.new(prk, t + info + struct.pack('B', i),
+                     hashlib.sha1).digest()
+        okm += t
+    return okm[:length]
+
+
+class AeadCryptoBase(object):
+    """
+    subclasses implement cipher_init(key), aead_encrypt(data) and
+    aead_decrypt(data) with the current nonce
+    """
+
+    # encrypt.py seals and opens a whole UDP packet with packet()
+    aead = True
+
+    def __init__(self, cipher_name, key, iv, op):
+        self._key = key
+        self._op = op
+        self._subkey = hkdf_sha1(key, iv, SUBKEY_INFO, len(key))
+        self._counter = 0
+        # data waiting for the rest of its chunk, when decrypting
+        self._pending = b''
+        self._chunk_len = None
+
+    def nonce(self):
+        return struct.pack('<Q', self._counter) + b'\x00' * (NONCE_SIZE - 8)
+
+    def reset(self, iv):
+        # start a new session with a new salt
+        self._subkey = hkdf_sha1(self._key, iv, SUBKEY_INFO, len(self._key))
+        self.cipher_init(self._subkey)
+        self._counter = 0
+        self._pending = b''
+        self._chunk_len = None
+
+    def _encrypt_once(self, data):
+        r = self.aead_encrypt(data)
+        self._counter += 1
+        return r
+
+    def _decrypt_once(self, data):
+        r = self.aead_decrypt(data)
+        if r is None:
+            raise AeadDecryptError('AEAD data is corrupted or tampered')
+        self._counter += 1
+        return r
+
+    def update(self, data):
+        # TCP, encrypts data into chunks, or decrypts all the complete
+        # chunks and keeps the rest for next time
+        if self._op:
+            return self._encrypt_chunks(data)
+        return self._decrypt_chunks(data)
+
+    def packet(self, data):
+        # UDP, seals or opens a whole packet with nonce 0
+        self._counter = 0
+        if self._op:
+            return self._encrypt_once(data)
+        if len(data) < TAG_SIZE:
+            raise AeadDecryptError('AEAD packet too short')
+        return self._decrypt_once(data)
+
+    def _encrypt_chunks(self, data):
+        results = []
+        for i in range(0, len(data), CHUNK_SIZE):
+            chunk = data[i:i + CHUNK_SIZE]
+            results.append(self._encrypt_once(struct.pack('>H', len(chunk))))
+            results.append(self._encrypt_once(chunk))
+        return b''.join(results)
+
+    def _decrypt_chunks(self, data):
+        if self._pending:
+            data = self._pending + data
+        results = []
+        pos = 0
+        l = len(data)
+        while True:
+            if self._chunk_len is None:
+                if l - pos < 2 + TAG_SIZE:
+                    break
+                length = self._decrypt_once(data[pos:pos + 2 + TAG_SIZE])
+                self._chunk_len = struct.unpack('>H', length)[0] & CHUNK_SIZE
+                pos += 2 + TAG_SIZE
+            if l - pos < self._chunk_len + TAG_SIZE:
+                break
+            end = pos + self._chunk_len + TAG_SIZE
+            results.append(self._decrypt_once(data[pos:end]))
+            self._chunk_len = None
+            pos = end
+        self._pending = data[pos:]
+        return b''.join(results)
+
+
+def test_hkdf_sha1():
+    # RFC 5869 test case 4
+    ikm = b'\x0b' * 11
+    salt = bytes(bytearray(range(0, 13)))
+    info = bytes(bytearray(range(0xf0, 0xfa)))
+    okm = hkdf_sha1(ikm, salt, info, 42)
+    assert okm[:8] == b'\x08\x5a\x01\xea\x1b\x10\xf3\x69'
+    assert okm[-2:] == b'\xf8\x96'
+
+
+def run_method(cipher, decipher):
+    from os import urandom
+    import random
+
+    plain = urandom(100000)
+    cipher_text = cipher.update(plain)
+    # 2 chunks of length + tag each
+    assert len(cipher_text) == len(plain) + \
+        (len(plain) // CHUNK_SIZE + 1) * (2 + TAG_SIZE * 2)
+    results = []
+    pos = 0
+    while pos < len(cipher_text):
+        l = random.randint(1, 5000)
+        results.append(decipher.update(cipher_text[pos:pos + l]))
+        pos += l
+    assert b''.join(results) == plain
+
+    tampered = bytearray(cipher.update(b'hello'))
+    tampered[-1] ^= 1
+    try:
+        decipher.update(bytes(tampered))
+    except AeadDecryptError:
+        pass
+    else:
+        assert False
+
+
+if __name__ == '__main__':
+    test_hkdf_sha1()
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# the ciphers of openssl.py and sodium.py through cffi instead of ctypes,
+# encrypt.py uses them instead when cffi is installed
+#
+# ctypes boxes every argument of every call, which costs more than the
+# cipher itself for small chunks, cffi converts them in C
+# 如果编译过 cffi_build.py 里的模块就直接调用，否则用 cffi 的 ABI 模式加载
+# ctypes 找到的同一个库
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import logging
+import threading
+
+from shadowsocks import common
+from shadowsocks.crypto import util, aead, openssl, sodium
+
+try:
+    import cffi
+except ImportError:
+    cffi = None
+
+__all__ = ['ciphers', 'HAS_CFFI']
+
+HAS_CFFI = cffi is not None
+
+OPENSSL_CDEF = '''
+typedef struct evp_cipher_st EVP_CIPHER;
+typedef struct evp_cipher_ctx_st EVP_CIPHER_CTX;
+
+const EVP_CIPHER *EVP_get_cipherbyname(const char *name);
+EVP_CIPHER_CTX *EVP_CIPHER_CTX_new(void);
+void EVP_CIPHER_CTX_free(EVP_CIPHER_CTX *ctx);
+int EVP_CIPHER_CTX_copy(EVP_CIPHER_CTX *out, const EVP_CIPHER_CTX *in);
+int EVP_CIPHER_CTX_ctrl(EVP_CIPHER_CTX *ctx, int type, int arg, void *ptr);
+int EVP_CipherInit_ex(EVP_CIPHER_CTX *ctx, const EVP_CIPHER *type,
+                      void *impl, const unsigned char *key,
+                      const unsigned char *iv, int enc);
+int EVP_CipherUpdate(EVP_CIPHER_CTX *ctx, unsigned char *out, int *outl,
+                     const unsigned char *in, int inl);
+int EVP_CipherFinal_ex(EVP_CIPHER_CTX *ctx, unsigned char *outm, int *outl);
+'''
+
+SODIUM_CDEF = '''
+int crypto_stream_salsa20_xor_ic(unsigned char *c, const unsigned char *m,
+                                 unsigned long long mlen,
+                                 const unsigned char *n, uint64_t ic,
+                                 const unsigned char *k);
+int crypto_stream_chacha20_xor_ic(unsigned char *c, const unsigned char *m,
+                                  unsigned long long mlen,
+                                  const unsigned char *n, uint64_t ic,
+                                  const unsigned char *k);
+int crypto_aead_chacha20poly1305_ietf_encrypt(
+    unsigned char *c, unsigned long long *clen_p, const unsigned char *m,
+    unsigned long long mlen, const unsigned char *ad,
+    unsigned long long adlen, const unsigned char *nsec,
+    const unsigned char *npub, const unsigned char *k);
+int crypto_aead_chacha20poly1305_ietf_decrypt(
+    unsigned char *m, unsigned long long *mlen_p, unsigned char *nsec,
+    const unsigned char *c, unsigned long long clen,
+    const unsigned char *ad, unsigned long long adlen,
+    const unsigned char *npub, const unsigned char *k);
+'''
+
+
+class Library(object):
+    def __init__(self, ffi, lib, compiled):
+        self.ffi = ffi
+        self.lib = lib
+        self.compiled = compiled
+        self._local = threading.local()
+
+    def get_buffer(self, size):
+        # like util.get_buffer(), but a cffi buffer
+        buf = getattr(self._local, 'buf', None)
+        if buf is None or len(buf) < size:
+            buf = self.ffi.new('unsigned char[]',
+                               max(size * 2, util.MIN_BUFFER_SIZE))
+            self._local.buf = buf
+        return buf
+
+
+def load_openssl():
+    try:
+        from shadowsocks.crypto._openssl_cffi import ffi, lib
+        lib.OpenSSL_add_all_ciphers()
+        return Library(ffi, lib, True)
+    except ImportError:
+        pass
+    # ctypes finds the library, then cffi opens the same file
+    libcrypto = util.find_library(('crypto', 'eay32'),
+                                  'EVP_get_cipherbyname', 'libcrypto')
+    if libcrypto is None:
+        raise Exception('libcrypto(OpenSSL) not found')
+    if hasattr(libcrypto, 'OpenSSL_add_all_ciphers'):
+        # OpenSSL 1.0, it is a macro since 1.1
+        libcrypto.OpenSSL_add_all_ciphers()
+    ffi = cffi.FFI()
+    ffi.cdef(OPENSSL_CDEF)
+    return Library(ffi, ffi.dlopen(libcrypto._name), False)
+
+
+def load_libsodium():
+    try:
+        from shadowsocks.crypto._sodium_cffi import ffi, lib
+        return Library(ffi, lib, True)
+    except ImportError:
+        pass
+    libsodium = util.find_library('sodium', 'crypto_stream_salsa20_xor_ic',
+                                  'libsodium')
+    if libsodium is None:
+        raise Exception('libsodium not found')
+    ffi = cffi.FFI()
+    ffi.cdef(SODIUM_CDEF)
+    return Library(ffi, ffi.dlopen(libsodium._name), False)
+
+
+_libraries = {}
+
+_loaders = {
+    'openssl': load_openssl,
+    'sodium': load_libsodium,
+}
+
+
+def get_library(name):
+    library = _libraries.get(name, None)
+    if library is None:
+        library = _loaders[name]()
+        logging.debug('using %s through cffi, %s', name,
+                      'compiled' if library.compiled else 'ABI mode')
+        _libraries[name] = library
+    return library
+
+
+class OpenSSLCrypto(object):
+    def __init__(self, cipher_name, key, iv, op):
+        self._ctx = None
+        library = get_library('openssl')
+        self._library = library
+        ffi, lib = library.ffi, library.lib
+        cipher_name = common.to_bytes(cipher_name)
+        cipher = lib.EVP_get_cipherbyname(cipher_name)
+        if cipher == ffi.NULL:
+            raise Exception('cipher %s not found in libcrypto' % cipher_name)
+        self._key = key
+        self._out_len = ffi.new('int *')
+        self._ctx = lib.EVP_CIPHER_CTX_new()
+        if self._ctx == ffi.NULL:
+            self._ctx = None
+            raise Exception('can not create cipher context')
+        r = lib.EVP_CipherInit_ex(self._ctx, cipher, ffi.NULL, key,
+                                  iv or ffi.NULL, op)
+        if not r:
+            self.clean()
+            raise Exception('can not initialize cipher context')
+
+    def reset(self, iv, key=None):
+        # see openssl.OpenSSLCrypto.reset()
+        ffi = self._library.ffi
+        if key is None and not iv:
+            key = self._key
+        r = self._library.lib.EVP_CipherInit_ex(self._ctx, ffi.NULL,
+                                                ffi.NULL, key or ffi.NULL,
+                                                iv or ffi.NULL, -1)
+        if not r:
+            raise Exception('can not reset cipher context')
+
+    def clone(self, iv):
+        # see openssl.OpenSSLCrypto.clone()
+        lib = self._library.lib
+        cipher = object.__new__(type(self))
+        cipher.__dict__.update(self.__dict__)
+        cipher._out_len = self._library.ffi.new('int *')
+        cipher._ctx = lib.EVP_CIPHER_CTX_new()
+        if cipher._ctx == self._library.ffi.NULL:
+            cipher._ctx = None
+            raise Exception('can not create cipher context')
+        if not lib.EVP_CIPHER_CTX_copy(cipher._ctx, self._ctx):
+            cipher.clean()
+            raise Exception('can not copy cipher context')
+        cipher.reset(iv)
+        return cipher
+
+    def update(self, data):
+        l = len(data)
+        library = self._library
+        buf = library.get_buffer(l)
+        out_len = self._out_len
+        library.lib.EVP_CipherUpdate(self._ctx, buf, out_len, data, l)
+        return library.ffi.buffer(buf, out_len[0])[:]
+
+    def update_into(self, src, dst):
+        # see openssl.OpenSSLCrypto.update_into()
+        l = len(src)
+        if not l:
+            return 0
+        ffi = self._library.ffi
+        dst_ptr = ffi.from_buffer(dst)
+        if src is dst:
+            src = dst_ptr
+        elif type(src) != bytes:
+            src = ffi.from_buffer(src)
+        self._library.lib.EVP_CipherUpdate(self._ctx, dst_ptr, self._out_len,
+                                           src, l)
+        return self._out_len[0]
+
+    def __del__(self):
+        self.clean()
+
+    def clean(self):
+        if self._ctx:
+            # EVP_CIPHER_CTX_free() cleans up the context as well
+            self._library.lib.EVP_CIPHER_CTX_free(self._ctx)
+            self._ctx = None
+
+
+class OpenSSLAeadCrypto(aead.AeadCryptoBase):
+    def __init__(self, cipher_name, key, iv, op):
+        aead.AeadCryptoBase.__init__(self, cipher_name, key, iv, op)
+        self._crypto = OpenSSLCrypto(cipher_name, self._subkey, None, op)
+        self._library = self._crypto._library
+        self._ctx = self._crypto._ctx
+        self._out_len = self._crypto._out_len
+
+    def cipher_init(self, key):
+        self._crypto.reset(None, key)
+
+    def aead_encrypt(self, data):
+        l = len(data)
+        library = self._library
+        ffi, lib = library.ffi, library.lib
+        buf = library.get_buffer(l + aead.TAG_SIZE)
+        out_len = self._out_len
+        ctx = self._ctx
+        lib.EVP_CipherInit_ex(ctx, ffi.NULL, ffi.NULL, ffi.NULL,
+                              self.nonce(), -1)
+        lib.EVP_CipherUpdate(ctx, buf, out_len, data, l)
+        lib.EVP_CipherFinal_ex(ctx, buf + out_len[0], out_len)
+        # append the tag
+        lib.EVP_CIPHER_CTX_ctrl(ctx, openssl.EVP_CTRL_GCM_GET_TAG,
+                                aead.TAG_SIZE, buf + l)
+        return ffi.buffer(buf, l + aead.TAG_SIZE)[:]
+
+    def aead_decrypt(self, data):
+        # returns None if the tag doesn't match
+        l = len(data) - aead.TAG_SIZE
+        library = self._library
+        ffi, lib = library.ffi, library.lib
+        buf = library.get_buffer(l)
+        out_len = self._out_len
+        ctx = self._ctx
+        lib.EVP_CipherInit_ex(ctx, ffi.NULL, ffi.NULL, ffi.NULL,
+                              self.nonce(), -1)
+        # the tag is only read, although ctrl() takes a void *
+        lib.EVP_CIPHER_CTX_ctrl(ctx, openssl.EVP_CTRL_GCM_SET_TAG,
+                                aead.TAG_SIZE, ffi.from_buffer(data) + l)
+        lib.EVP_CipherUpdate(ctx, buf, out_len, data, l)
+        if not lib.EVP_CipherFinal_ex(ctx, buf + out_len[0], out_len):
+            return None
+        return ffi.buffer(buf, l)[:]
+
+
+class SodiumCrypto(object):
+    def __init__(self, cipher_name, key, iv, op):
+        library = get_library('sodium')
+        self._library = library
+        self.key = key
+        self.iv = iv
+        if cipher_name == 'salsa20':
+            self.cipher = library.lib.crypto_stream_salsa20_xor_ic
+        elif cipher_name == 'chacha20':
+            self.cipher = library.lib.crypto_stream_chacha20_xor_ic
+        else:
+            raise Exception('Unknown cipher')
+        # byte counter, not block counter
+        self.counter = 0
+        # see sodium.SodiumCrypto
+        self._block = library.ffi.new('unsigned char[]', sodium.BLOCK_SIZE)
+
+    def reset(self, iv):
+        # start over with a new IV
+        self.iv = iv
+        self.counter = 0
+
+    def update(self, data):
+        l = len(data)
+        library = self._library
+        offset = self.counter % sodium.BLOCK_SIZE
+        buf = library.get_buffer(offset + l)
+        if offset:
+            # see sodium.SodiumCrypto.update()
+            library.ffi.memmove(buf + offset, data, l)
+            self.cipher(buf, buf, offset + l, self.iv,
+                        self.counter // sodium.BLOCK_SIZE, self.key)
+            self.counter += l
+        else:
+            self._xor(data, buf, l)
+        return library.ffi.buffer(buf + offset, l)[:]
+
+    def update_into(self, src, dst):
+        # see sodium.SodiumCrypto.update_into()
+        l = len(src)
+        if not l:
+            return 0
+        ffi = self._library.ffi
+        dst_ptr = ffi.from_buffer(dst)
+        if src is dst:
+            src = dst_ptr
+        elif type(src) != bytes:
+            src = ffi.from_buffer(src)
+        self._xor(src, dst_ptr, l)
+        return l
+
+    def _xor(self, src, dst, l):
+        # see sodium.SodiumCrypto._xor(), src is either bytes or a pointer
+        ffi = self._library.ffi
+        offset = self.counter % sodium.BLOCK_SIZE
+        head = 0
+        if offset:
+            head = min(sodium.BLOCK_SIZE - offset, l)
+            block = self._block
+            ffi.memmove(block + offset, src, head)
+            self.cipher(block, block, sodium.BLOCK_SIZE, self.iv,
+                        self.counter // sodium.BLOCK_SIZE, self.key)
+            ffi.memmove(dst, block + offset, head)
+            if type(src) == bytes:
+                src = ffi.from_buffer(src)
+            src += head
+        if l > head:
+            self.cipher(dst + head, src, l - head, self.iv,
+                        (self.counter + head) // sodium.BLOCK_SIZE, self.key)
+        self.counter += l
+
+
+class SodiumAeadCrypto(aead.AeadCryptoBase):
+    def __init__(self, cipher_name, key, iv, op):
+        library = get_library('sodium')
+        self._library = library
+        if cipher_name != 'chacha20-ietf-poly1305':
+            raise Exception('Unknown cipher')
+        try:
+            self._encrypt = \
+                library.lib.crypto_aead_chacha20poly1305_ietf_encrypt
+            self._decrypt = \
+                library.lib.crypto_aead_chacha20poly1305_ietf_decrypt
+        except AttributeError:
+            raise Exception('chacha20-ietf-poly1305 requires libsodium '
+                            '1.0.4+')
+        self._out_len = library.ffi.new('unsigned long long *')
+        aead.AeadCryptoBase.__init__(self, cipher_name, key, iv, op)
+        self.cipher_init(self._subkey)
+
+    def cipher_init(self, key):
+        self.key = key
+
+    def aead_encrypt(self, data):
+        l = len(data)
+        library = self._library
+        ffi = library.ffi
+        buf = library.get_buffer(l + aead.TAG_SIZE)
+        self._encrypt(buf, self._out_len, data, l, ffi.NULL, 0, ffi.NULL,
+                      self.nonce(), self.key)
+        return ffi.buffer(buf, self._out_len[0])[:]
+
+    def aead_decrypt(self, data):
+        # returns None if the tag doesn't match
+        l = len(data)
+        library = self._library
+        ffi = library.ffi
+        buf = library.get_buffer(l)
+        r = self._decrypt(buf, self._out_len, ffi.NULL, data, l, ffi.NULL, 0,
+                          self.nonce(), self.key)
+        if r != 0:
+            return None
+        return ffi.buffer(buf, self._out_len[0])[:]
+
+
+# the same methods as the ctypes ones, with the classes replaced
+_classes = {
+    openssl.OpenSSLCrypto: OpenSSLCrypto,
+    openssl.OpenSSLAeadCrypto: OpenSSLAeadCrypto,
+    sodium.SodiumCrypto: SodiumCrypto,
+    sodium.SodiumAeadCrypto: SodiumAeadCrypto,
+}
+
+ciphers = {}
+if HAS_CFFI:
+    for method, (key_len, iv_len, m) in list(openssl.ciphers.items()) + \
+            list(sodium.ciphers.items()):
+        ciphers[method] = (key_len, iv_len, _classes[m])
+
+
+def run_method(method, m, ctypes_m, key_len, iv_len):
+    # the wire format must be the same as the ctypes backend's
+    cipher = m(method, b'k' * key_len, b'i' * iv_len, 1)
+    decipher = ctypes_m(method, b'k' * key_len, b'i' * iv_len, 0)
+    if getattr(m, 'aead', False):
+        aead.run_method(cipher, decipher)
+    else:
+        util.run_cipher(cipher, decipher)
+
+
+def test_openssl():
+    if not HAS_CFFI:
+        return
+    run_method('aes-256-cfb', OpenSSLCrypto, openssl.OpenSSLCrypto, 32, 16)
+    run_method('rc4', OpenSSLCrypto, openssl.OpenSSLCrypto, 16, 0)
+    run_method('aes-256-gcm', OpenSSLAeadCrypto, openssl.OpenSSLAeadCrypto,
+               32, 32)
+
+    template = OpenSSLCrypto('aes-256-cfb', b'k' * 32, b'i' * 16, 1)
+    cipher = template.clone(b'j' * 16)
+    decipher = openssl.OpenSSLCrypto('aes-256-cfb', b'k' * 32, b'j' * 16, 0)
+    assert decipher.update(cipher.update(b'hello world')) == b'hello world'
+
+
+def test_sodium():
+    if not HAS_CFFI:
+        return
+    run_method('chacha20', SodiumCrypto, sodium.SodiumCrypto, 32, 8)
+    run_method('chacha20-ietf-poly1305', SodiumAeadCrypto,
+               sodium.SodiumAeadCrypto, 32, 32)
+
+
+def test_update_into():
+    from os import urandom
+
+    if not HAS_CFFI:
+        return
+    plain = urandom(1000)
+    for method, m, ctypes_m, iv_len in (
+            ('aes-256-cfb', OpenSSLCrypto, openssl.OpenSSLCrypto, 16),
+            ('salsa20', SodiumCrypto, sodium.SodiumCrypto, 8)):
+        expected = ctypes_m(method, b'k' * 32, b'i' * iv_len, 1) \
+            .update(plain)
+        cipher = m(method, b'k' * 32, b'i' * iv_len, 1)
+        buf = bytearray(plain)
+        view = memoryview(buf)
+        pos = 0
+        for size in (1, 63, 64, 65, 807):
+            assert cipher.update_into(view[pos:pos + size],
+                                      view[pos:pos + size]) == size
+            pos += size
+        assert bytes(buf) == expected
+
+
+if __name__ == '__main__':
+    test_openssl()
+    test_sodium()
+    test_update_into()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# compiles the modules that cffi_backend.py uses when they exist, they call
+# OpenSSL and libsodium directly, which is faster than cffi's ABI mode
+# requires a C compiler, cffi and the headers of the libraries:
+#
+#     python shadowsocks/crypto/cffi_build.py
+#
+# a library without headers is skipped, cffi_backend.py uses ABI mode for it
+# 编译后的模块放在本目录下，删掉就回到 ABI 模式
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+
+__all__ = ['openssl_builder', 'sodium_builder']
+
+
+def openssl_builder():
+    import cffi
+    from shadowsocks.crypto import cffi_backend
+
+    builder = cffi.FFI()
+    # a macro since OpenSSL 1.1, but the compiled module can call it anyway
+    builder.cdef(cffi_backend.OPENSSL_CDEF +
+                 'void OpenSSL_add_all_ciphers(void);\n')
+    builder.set_source('shadowsocks.crypto._openssl_cffi',
+                       '#include <openssl/evp.h>\n',
+                       libraries=['crypto'])
+    return builder
+
+
+def sodium_builder():
+    import cffi
+    from shadowsocks.crypto import cffi_backend
+
+    builder = cffi.FFI()
+    builder.cdef(cffi_backend.SODIUM_CDEF)
+    builder.set_source('shadowsocks.crypto._sodium_cffi',
+                       '#include <sodium.h>\n',
+                       libraries=['sodium'])
+    return builder
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(here, '../../'))
+    built = 0
+    for name, builder in (('openssl', openssl_builder),
+                          ('libsodium', sodium_builder)):
+        # keep the C files and the objects out of the source tree
+        tmpdir = tempfile.mkdtemp()
+        try:
+            builder().compile(tmpdir=tmpdir)
+            for path in glob.glob(os.path.join(tmpdir, 'shadowsocks',
+                                               'crypto', '_*_cffi*')):
+                if not path.endswith(('.c', '.o')):
+                    shutil.copy(path, here)
+                    print('built %s: %s' % (name, os.path.join(
+                        here, os.path.basename(path))))
+                    built += 1
+        except Exception as e:
+            print('skipped %s: %s' % (name, e), file=sys.stderr)
+        finally:
+            shutil.rmtree(tmpdir)
+    if not built:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,22 +17,23 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-from ctypes import c_char_p, c_int, c_long, byref,\
-    create_string_buffer, c_void_p
+from ctypes import c_char_p, c_int, byref, c_void_p, c_char, addressof, \
+    string_at
 
 from shadowsocks import common
-from shadowsocks.crypto import util
+from shadowsocks.crypto import util, aead
 
 __all__ = ['ciphers']
 
 libcrypto = None
 loaded = False
 
-buf_size = 2048
+EVP_CTRL_GCM_GET_TAG = 0x10
+EVP_CTRL_GCM_SET_TAG = 0x11
 
 
 def load_openssl():
-    global loaded, libcrypto, buf
+    global loaded, libcrypto
 
     libcrypto = util.find_library(('crypto', 'eay32'),
                                   'EVP_get_cipherbyname',
@@ -47,14 +48,18 @@ def load_openssl():
                                             c_char_p, c_char_p, c_int)
 
     libcrypto.EVP_CipherUpdate.argtypes = (c_void_p, c_void_p, c_void_p,
-                                           c_char_p, c_int)
+                                           c_void_p, c_int)
 
+    libcrypto.EVP_CipherFinal_ex.argtypes = (c_void_p, c_void_p, c_void_p)
+    libcrypto.EVP_CIPHER_CTX_ctrl.argtypes = (c_void_p, c_int, c_int,
+                                              c_void_p)
+
+    libcrypto.EVP_CIPHER_CTX_copy.argtypes = (c_void_p, c_void_p)
     libcrypto.EVP_CIPHER_CTX_cleanup.argtypes = (c_void_p,)
     libcrypto.EVP_CIPHER_CTX_free.argtypes = (c_void_p,)
     if hasattr(libcrypto, 'OpenSSL_add_all_ciphers'):
         libcrypto.OpenSSL_add_all_ciphers()
 
-    buf = create_string_buffer(buf_size)
     loaded = True
 
 
@@ -80,6 +85,7 @@ class OpenSSLCrypto(object):
             cipher = load_cipher(cipher_name)
         if not cipher:
             raise Exception('cipher %s not found in libcrypto' % cipher_name)
+        self._key = key
         key_ptr = c_char_p(key)
         iv_ptr = c_char_p(iv)
         self._ctx = libcrypto.EVP_CIPHER_CTX_new()
@@ -91,17 +97,60 @@ class OpenSSLCrypto(object):
             self.clean()
             raise Exception('can not initialize cipher context')
 
+    def reset(self, iv, key=None):
+        # start over with a new IV, and a new key if given, reusing the
+        # context, so that we don't allocate a context for each UDP packet
+        # with only a new IV, the key schedule is kept as well
+        if key is None and not iv:
+            # no IV, like RC4, the key has to be set up again
+            key = self._key
+        r = libcrypto.EVP_CipherInit_ex(self._ctx, None, None,
+                                        key, iv or None, c_int(-1))
+        if not r:
+            raise Exception('can not reset cipher context')
+
+    def clone(self, iv):
+        # a new cipher with the same key and direction, and a new IV
+        # copying a keyed context is cheaper than setting one up from the
+        # cipher name, see encrypt.CipherProfile
+        cipher = object.__new__(type(self))
+        cipher.__dict__.update(self.__dict__)
+        cipher._ctx = libcrypto.EVP_CIPHER_CTX_new()
+        if not cipher._ctx:
+            raise Exception('can not create cipher context')
+        if not libcrypto.EVP_CIPHER_CTX_copy(cipher._ctx, self._ctx):
+            cipher.clean()
+            raise Exception('can not copy cipher context')
+        cipher.reset(iv)
+        return cipher
+
     def update(self, data):
-        global buf_size, buf
-        cipher_out_len = c_long(0)
+        cipher_out_len = c_int(0)
         l = len(data)
-        if buf_size < l:
-            buf_size = l * 2
-            buf = create_string_buffer(buf_size)
+        buf = util.get_buffer(l)
         libcrypto.EVP_CipherUpdate(self._ctx, byref(buf),
                                    byref(cipher_out_len), c_char_p(data), l)
-        # buf is copied to a str object when we access buf.raw
-        return buf.raw[:cipher_out_len.value]
+        # copy only the output to a str object, not the whole buffer
+        return string_at(buf, cipher_out_len.value)
+
+    def update_into(self, src, dst):
+        # process src and write the result into dst, which must be a
+        # writable buffer, like a memoryview of a bytearray
+        # src and dst can be the same buffer, so it is done in place
+        l = len(src)
+        if not l:
+            return 0
+        cipher_out_len = c_int(0)
+        dst_ptr = addressof(c_char.from_buffer(dst))
+        if src is dst:
+            src_ptr = dst_ptr
+        elif type(src) == bytes:
+            src_ptr = src
+        else:
+            src_ptr = addressof(c_char.from_buffer(src))
+        libcrypto.EVP_CipherUpdate(self._ctx, dst_ptr, byref(cipher_out_len),
+                                   src_ptr, l)
+        return cipher_out_len.value
 
     def __del__(self):
         self.clean()
@@ -110,6 +159,53 @@ class OpenSSLCrypto(object):
         if self._ctx:
             libcrypto.EVP_CIPHER_CTX_cleanup(self._ctx)
             libcrypto.EVP_CIPHER_CTX_free(self._ctx)
+            self._ctx = None
+
+
+class OpenSSLAeadCrypto(aead.AeadCryptoBase):
+    def __init__(self, cipher_name, key, iv, op):
+        aead.AeadCryptoBase.__init__(self, cipher_name, key, iv, op)
+        self._crypto = OpenSSLCrypto(cipher_name, self._subkey, None, op)
+        self._ctx = self._crypto._ctx
+
+    def cipher_init(self, key):
+        self._crypto.reset(None, key)
+
+    def aead_encrypt(self, data):
+        l = len(data)
+        buf = util.get_buffer(l + aead.TAG_SIZE)
+        out_len = c_int(0)
+        ctx = self._ctx
+        libcrypto.EVP_CipherInit_ex(ctx, None, None, None, self.nonce(),
+                                    c_int(-1))
+        libcrypto.EVP_CipherUpdate(ctx, byref(buf), byref(out_len),
+                                   c_char_p(data), l)
+        final_len = c_int(0)
+        libcrypto.EVP_CipherFinal_ex(ctx, addressof(buf) + out_len.value,
+                                     byref(final_len))
+        # append the tag
+        libcrypto.EVP_CIPHER_CTX_ctrl(ctx, EVP_CTRL_GCM_GET_TAG,
+                                      aead.TAG_SIZE, addressof(buf) + l)
+        return string_at(buf, l + aead.TAG_SIZE)
+
+    def aead_decrypt(self, data):
+        # returns None if the tag doesn't match
+        l = len(data) - aead.TAG_SIZE
+        buf = util.get_buffer(l)
+        out_len = c_int(0)
+        ctx = self._ctx
+        libcrypto.EVP_CipherInit_ex(ctx, None, None, None, self.nonce(),
+                                    c_int(-1))
+        libcrypto.EVP_CIPHER_CTX_ctrl(ctx, EVP_CTRL_GCM_SET_TAG,
+                                      aead.TAG_SIZE, c_char_p(data[l:]))
+        libcrypto.EVP_CipherUpdate(ctx, byref(buf), byref(out_len),
+                                   c_char_p(data), l)
+        final_len = c_int(0)
+        if not libcrypto.EVP_CipherFinal_ex(ctx,
+                                            addressof(buf) + out_len.value,
+                                            byref(final_len)):
+            return None
+        return string_at(buf, l)
 
 
 ciphers = {
@@ -138,6 +234,9 @@ ciphers = {
     'rc2-cfb': (16, 8, OpenSSLCrypto),
     'rc4': (16, 0, OpenSSLCrypto),
     'seed-cfb': (16, 16, OpenSSLCrypto),
+    'aes-128-gcm': (16, 16, OpenSSLAeadCrypto),
+    'aes-192-gcm': (24, 24, OpenSSLAeadCrypto),
+    'aes-256-gcm': (32, 32, OpenSSLAeadCrypto),
 }
 
 
@@ -177,5 +276,58 @@ def test_rc4():
     run_method('rc4')
 
 
+def test_aes_256_gcm():
+    cipher = OpenSSLAeadCrypto('aes-256-gcm', b'k' * 32, b'i' * 32, 1)
+    decipher = OpenSSLAeadCrypto('aes-256-gcm', b'k' * 32, b'i' * 32, 0)
+
+    aead.run_method(cipher, decipher)
+
+
+def test_reset():
+    cipher = OpenSSLCrypto('aes-256-cfb', b'k' * 32, b'i' * 16, 1)
+    c1 = cipher.update(b'hello world')
+    cipher.reset(b'j' * 16)
+    c2 = cipher.update(b'hello world')
+    cipher.reset(b'i' * 16)
+    assert cipher.update(b'hello world') == c1
+    decipher = OpenSSLCrypto('aes-256-cfb', b'k' * 32, b'j' * 16, 0)
+    assert decipher.update(c2) == b'hello world'
+
+    cipher = OpenSSLCrypto('rc4', b'k' * 16, b'', 1)
+    c1 = cipher.update(b'hello world')
+    cipher.reset(b'')
+    assert cipher.update(b'hello world') == c1
+
+
+def test_clone():
+    template = OpenSSLCrypto('aes-256-cfb', b'k' * 32, b'i' * 16, 1)
+    cipher = template.clone(b'j' * 16)
+    decipher = OpenSSLCrypto('aes-256-cfb', b'k' * 32, b'j' * 16, 0)
+    assert decipher.update(cipher.update(b'hello world')) == b'hello world'
+    # the template is not affected
+    decipher = OpenSSLCrypto('aes-256-cfb', b'k' * 32, b'i' * 16, 0)
+    assert decipher.update(template.update(b'hello')) == b'hello'
+
+
+def test_update_into():
+    from os import urandom
+    from shadowsocks import buffers
+
+    if not buffers.ZERO_COPY:
+        return
+    cipher = OpenSSLCrypto('aes-256-cfb', b'k' * 32, b'i' * 16, 1)
+    decipher = OpenSSLCrypto('aes-256-cfb', b'k' * 32, b'i' * 16, 0)
+    plain = urandom(10240)
+    buf = bytearray(plain)
+    view = memoryview(buf)
+    # in place, with unaligned chunks
+    assert cipher.update_into(view[:100], view[:100]) == 100
+    assert cipher.update_into(view[100:], view[100:]) == len(plain) - 100
+    assert bytes(buf) != plain
+    out = bytearray(len(plain))
+    assert decipher.update_into(bytes(buf), memoryview(out)) == len(plain)
+    assert bytes(out) == plain
+
+
 if __name__ == '__main__':
     test_aes_128_cfb()
@@ -17,24 +17,22 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-from ctypes import c_char_p, c_int, c_ulonglong, byref, \
-    create_string_buffer, c_void_p
+from ctypes import c_char_p, c_int, c_ulonglong, byref, c_void_p, \
+    c_char, addressof, string_at, cast, create_string_buffer, memmove
 
-from shadowsocks.crypto import util
+from shadowsocks.crypto import util, aead
 
 __all__ = ['ciphers']
 
 libsodium = None
 loaded = False
 
-buf_size = 2048
-
 # for salsa20 and chacha20
 BLOCK_SIZE = 64
 
 
 def load_libsodium():
-    global loaded, libsodium, buf
+    global loaded, libsodium
 
     libsodium = util.find_library('sodium', 'crypto_stream_salsa20_xor_ic',
                                   'libsodium')
@@ -42,17 +40,26 @@ def load_libsodium():
         raise Exception('libsodium not found')
 
     libsodium.crypto_stream_salsa20_xor_ic.restype = c_int
-    libsodium.crypto_stream_salsa20_xor_ic.argtypes = (c_void_p, c_char_p,
+    libsodium.crypto_stream_salsa20_xor_ic.argtypes = (c_void_p, c_void_p,
                                                        c_ulonglong,
                                                        c_char_p, c_ulonglong,
                                                        c_char_p)
     libsodium.crypto_stream_chacha20_xor_ic.restype = c_int
-    libsodium.crypto_stream_chacha20_xor_ic.argtypes = (c_void_p, c_char_p,
+    libsodium.crypto_stream_chacha20_xor_ic.argtypes = (c_void_p, c_void_p,
                                                         c_ulonglong,
                                                         c_char_p, c_ulonglong,
                                                         c_char_p)
 
-    buf = create_string_buffer(buf_size)
+    if hasattr(libsodium, 'crypto_aead_chacha20poly1305_ietf_encrypt'):
+        libsodium.crypto_aead_chacha20poly1305_ietf_encrypt.restype = c_int
+        libsodium.crypto_aead_chacha20poly1305_ietf_encrypt.argtypes = \
+            (c_void_p, c_void_p, c_char_p, c_ulonglong, c_char_p,
+             c_ulonglong, c_char_p, c_char_p, c_char_p)
+        libsodium.crypto_aead_chacha20poly1305_ietf_decrypt.restype = c_int
+        libsodium.crypto_aead_chacha20poly1305_ietf_decrypt.argtypes = \
+            (c_void_p, c_void_p, c_char_p, c_char_p, c_ulonglong,
+             c_char_p, c_ulonglong, c_char_p, c_char_p)
+
     loaded = True
 
 
@@ -72,31 +79,113 @@ class SodiumCrypto(object):
             raise Exception('Unknown cipher')
         # byte counter, not block counter
         self.counter = 0
+        # where we finish a block that was started by the last update
+        self._block = create_string_buffer(BLOCK_SIZE)
+        self._block_ptr = addressof(self._block)
+
+    def reset(self, iv):
+        # start over with a new IV
+        self.iv = iv
+        self.iv_ptr = c_char_p(iv)
+        self.counter = 0
 
     def update(self, data):
-        global buf_size, buf
         l = len(data)
-
-        # we can only prepend some padding to make the encryption align to
-        # blocks
-        padding = self.counter % BLOCK_SIZE
-        if buf_size < padding + l:
-            buf_size = (padding + l) * 2
-            buf = create_string_buffer(buf_size)
-
-        if padding:
-            data = (b'\0' * padding) + data
-        self.cipher(byref(buf), c_char_p(data), padding + l,
-                    self.iv_ptr, int(self.counter / BLOCK_SIZE), self.key_ptr)
+        offset = self.counter % BLOCK_SIZE
+        buf = util.get_buffer(offset + l)
+        buf_ptr = addressof(buf)
+        if offset:
+            # we have to copy data into the output buffer anyway, put it at
+            # the same offset in the block, then it can be done in one call
+            memmove(buf_ptr + offset, data, l)
+            self.cipher(buf_ptr, buf_ptr, offset + l, self.iv_ptr,
+                        self.counter // BLOCK_SIZE, self.key_ptr)
+            self.counter += l
+        else:
+            self._xor(data, buf_ptr, l)
+        # copy only the output to a str object, not the whole buffer
+        return string_at(buf_ptr + offset, l)
+
+    def update_into(self, src, dst):
+        # process src and write the result into dst, which must be a
+        # writable buffer, like a memoryview of a bytearray
+        # src and dst can be the same buffer, so it is done in place
+        l = len(src)
+        if not l:
+            return 0
+        dst_ptr = addressof(c_char.from_buffer(dst))
+        if src is dst:
+            src = dst_ptr
+        elif type(src) != bytes:
+            src = addressof(c_char.from_buffer(src))
+        self._xor(src, dst_ptr, l)
+        return l
+
+    def _xor(self, src, dst_ptr, l):
+        # src is either bytes or an address
+        # the ciphers only start at a block boundary, so if the last update
+        # stopped inside a block, finish that block in self._block, at the
+        # same offset, instead of prepending padding to the whole data
+        offset = self.counter % BLOCK_SIZE
+        head = 0
+        if offset:
+            head = min(BLOCK_SIZE - offset, l)
+            memmove(self._block_ptr + offset, src, head)
+            self.cipher(self._block_ptr, self._block_ptr, BLOCK_SIZE,
+                        self.iv_ptr, self.counter // BLOCK_SIZE, self.key_ptr)
+            memmove(dst_ptr, self._block_ptr + offset, head)
+            if type(src) == bytes:
+                # the address is valid as long as the caller keeps src
+                src = cast(c_char_p(src), c_void_p).value
+            src += head
+        if l > head:
+            # the rest starts at a block boundary
+            self.cipher(dst_ptr + head, src, l - head, self.iv_ptr,
+                        (self.counter + head) // BLOCK_SIZE, self.key_ptr)
         self.counter += l
-        # buf is copied to a str object when we access buf.raw
-        # strip off the padding
-        return buf.raw[padding:padding + l]
+
+
+class SodiumAeadCrypto(aead.AeadCryptoBase):
+    def __init__(self, cipher_name, key, iv, op):
+        if not loaded:
+            load_libsodium()
+        if cipher_name != 'chacha20-ietf-poly1305':
+            raise Exception('Unknown cipher')
+        if not hasattr(libsodium, 'crypto_aead_chacha20poly1305_ietf_encrypt'):
+            raise Exception('chacha20-ietf-poly1305 requires libsodium '
+                            '1.0.4+')
+        aead.AeadCryptoBase.__init__(self, cipher_name, key, iv, op)
+        self.cipher_init(self._subkey)
+
+    def cipher_init(self, key):
+        self.key_ptr = c_char_p(key)
+
+    def aead_encrypt(self, data):
+        l = len(data)
+        buf = util.get_buffer(l + aead.TAG_SIZE)
+        out_len = c_ulonglong(0)
+        libsodium.crypto_aead_chacha20poly1305_ietf_encrypt(
+            byref(buf), byref(out_len), c_char_p(data), l, None, 0, None,
+            self.nonce(), self.key_ptr)
+        return string_at(buf, out_len.value)
+
+    def aead_decrypt(self, data):
+        # returns None if the tag doesn't match
+        l = len(data)
+        buf = util.get_buffer(l)
+        out_len = c_ulonglong(0)
+        r = libsodium.crypto_aead_chacha20poly1305_ietf_decrypt(
+            byref(buf), byref(out_len), None, c_char_p(data), l, None, 0,
+            self.nonce(), self.key_ptr)
+        if r != 0:
+            return None
+        return string_at(buf, out_len.value)
 
 
 ciphers = {
     'salsa20': (32, 8, SodiumCrypto),
     'chacha20': (32, 8, SodiumCrypto),
+    'chacha20-ietf-poly1305': (32, 32, SodiumAeadCrypto),
 }
 
 
@@ -115,6 +204,38 @@ def test_chacha20():
     util.run_cipher(cipher, decipher)
 
 
+def test_update_into():
+    from os import urandom
+
+    plain = urandom(1000)
+    cipher = SodiumCrypto('chacha20', b'k' * 32, b'i' * 16, 1)
+    expected = cipher.update(plain)
+    for sizes in ((1000,), (1, 63, 64, 65, 807), (30, 30, 940)):
+        cipher.reset(b'i' * 16)
+        buf = bytearray(plain)
+        view = memoryview(buf)
+        pos = 0
+        for size in sizes:
+            assert cipher.update_into(view[pos:pos + size],
+                                      view[pos:pos + size]) == size
+            pos += size
+        assert bytes(buf) == expected
+    cipher.reset(b'i' * 16)
+    assert cipher.update(plain[:30]) + cipher.update(plain[30:100]) + \
+        cipher.update(plain[100:]) == expected
+
+
+def test_chacha20_ietf_poly1305():
+    cipher = SodiumAeadCrypto('chacha20-ietf-poly1305', b'k' * 32,
+                              b'i' * 32, 1)
+    decipher = SodiumAeadCrypto('chacha20-ietf-poly1305', b'k' * 32,
+                                b'i' * 32, 0)
+
+    aead.run_method(cipher, decipher)
+
+
 if __name__ == '__main__':
     test_chacha20()
+    test_update_into()
+    test_chacha20_ietf_poly1305()
     test_salsa20()
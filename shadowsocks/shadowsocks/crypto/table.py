@@ -17,15 +17,28 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
+import os
+import hmac
 import string
 import struct
 import hashlib
+import logging
+import tempfile
 
 
-__all__ = ['ciphers']
+__all__ = ['ciphers', 'set_cache_dir']
 
 cached_tables = {}
 
+# where the tables are saved, so we don't generate them again after restart
+cache_dir = None
+
+# each cache dir has a random salt, the file names are HMACs of the keys
+# with it, so they can't be looked up in a dictionary of password hashes
+SALT_FILE = 'salt'
+SALT_SIZE = 16
+cache_salt = None
+
 if hasattr(string, 'maketrans'):
     maketrans = string.maketrans
     translate = string.translate
@@ -39,16 +52,87 @@ def get_table(key):
     m.update(key)
     s = m.digest()
     a, b = struct.unpack('<QQ', s)
-    table = maketrans(b'', b'')
-    table = [table[i: i + 1] for i in range(len(table))]
+    # in round i, byte x is sorted by a % (x + i), so compute a % d for all
+    # the d we need at once, then the keys of round i are just a slice
+    mods = [a % d for d in range(1, 256 + 1023)]
+    table = list(range(0, 256))
     for i in range(1, 1024):
-        table.sort(key=lambda x: int(a % (ord(x) + i)))
-    return table
+        table.sort(key=mods[i - 1:i + 255].__getitem__)
+    table = bytes(bytearray(table))
+    return [table[i: i + 1] for i in range(len(table))]
+
+
+def set_cache_dir(path):
+    # raises OSError or IOError if we can't use path, ValueError if other
+    # users can get into it
+    global cache_dir, cache_salt
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    if os.name == 'posix' and os.stat(path).st_mode & 0o077:
+        raise ValueError('%s is accessible by other users, chmod 700 it' %
+                         path)
+    cache_salt = _load_salt(path)
+    cache_dir = path
+
+
+def _load_salt(path):
+    salt_path = os.path.join(path, SALT_FILE)
+    try:
+        with open(salt_path, 'rb') as f:
+            salt = f.read()
+        if len(salt) == SALT_SIZE:
+            return salt
+    except (OSError, IOError):
+        pass
+    # missing or broken, the tables saved with the old one are not found
+    # any more, and we generate them again
+    salt = os.urandom(SALT_SIZE)
+    fd, tmp_path = tempfile.mkstemp(dir=path)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(salt)
+    os.rename(tmp_path, salt_path)
+    return salt
+
+
+def _cache_path(key):
+    # the file name is a salted hash of the key, never the key itself
+    return os.path.join(cache_dir,
+                        hmac.new(cache_salt, key, hashlib.sha256).hexdigest())
+
+
+def _load_table(key):
+    try:
+        with open(_cache_path(key), 'rb') as f:
+            encrypt_table = f.read()
+    except (OSError, IOError):
+        return None
+    # it must be a permutation of all the bytes, or we generate it again
+    if sorted(bytearray(encrypt_table)) != list(range(0, 256)):
+        return None
+    return encrypt_table
+
+
+def _save_table(key, encrypt_table):
+    # the table is as secret as the password, so only we can read it
+    # write to a temp file and rename it, so we never load half a table
+    try:
+        fd, path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(encrypt_table)
+        os.rename(path, _cache_path(key))
+    except (OSError, IOError) as e:
+        logging.warn('can not save table to %s: %s' % (cache_dir, e))
 
 
 def init_table(key):
     if key not in cached_tables:
-        encrypt_table = b''.join(get_table(key))
+        encrypt_table = None
+        if cache_dir is not None:
+            encrypt_table = _load_table(key)
+        if encrypt_table is None:
+            encrypt_table = b''.join(get_table(key))
+            if cache_dir is not None:
+                _save_table(key, encrypt_table)
         decrypt_table = maketrans(encrypt_table, maketrans(b'', b''))
         cached_tables[key] = [encrypt_table, decrypt_table]
     return cached_tables[key]
@@ -59,6 +143,10 @@ class TableCipher(object):
         self._encrypt_table, self._decrypt_table = init_table(key)
         self._op = op
 
+    def reset(self, iv):
+        # there is no IV or state
+        pass
+
     def update(self, data):
         if self._op:
             return translate(data, self._encrypt_table)
@@ -160,6 +248,43 @@ def test_table_result():
         assert (target2[1][i] == ord(decrypt_table[i]))
 
 
+def test_cache_dir():
+    import shutil
+
+    global cache_dir, cache_salt
+    path = tempfile.mkdtemp()
+    try:
+        set_cache_dir(os.path.join(path, 'tables'))
+        cached_tables.pop(b'cached', None)
+        encrypt_table = init_table(b'cached')[0]
+        assert _load_table(b'cached') == encrypt_table
+        cached_tables.pop(b'cached', None)
+        assert init_table(b'cached')[0] == encrypt_table
+        # a broken file is ignored
+        with open(_cache_path(b'broken'), 'wb') as f:
+            f.write(b'\x00' * 256)
+        assert _load_table(b'broken') is None
+        # the salt is kept, another dir gets another one
+        name = _cache_path(b'cached')
+        set_cache_dir(os.path.join(path, 'tables'))
+        assert _cache_path(b'cached') == name
+        set_cache_dir(os.path.join(path, 'other'))
+        assert os.path.basename(_cache_path(b'cached')) != \
+            os.path.basename(name)
+        if os.name == 'posix':
+            os.chmod(path, 0o755)
+            try:
+                set_cache_dir(path)
+            except ValueError:
+                pass
+            else:
+                assert False
+    finally:
+        cache_dir = None
+        cache_salt = None
+        shutil.rmtree(path)
+
+
 def test_encryption():
     from shadowsocks.crypto import util
 
@@ -172,3 +297,4 @@ def test_encryption():
 if __name__ == '__main__':
     test_table_result()
     test_encryption()
+    test_cache_dir()
@@ -19,6 +19,14 @@ from __future__ import absolute_import, division, print_function, \
 
 import os
 import logging
+import threading
+from ctypes import create_string_buffer
+
+# each thread has its own output buffer for the ciphers, so that they can
+# be used from several threads
+_local = threading.local()
+
+MIN_BUFFER_SIZE = 2048
 
 
 def find_library_nt(name):
@@ -92,6 +100,16 @@ def find_library(possible_lib_names, search_symbol, library_name):
     return None
 
 
+def get_buffer(size):
+    # returns a ctypes buffer of at least size bytes for the current thread
+    # the content is only valid until the next call in the same thread
+    buf = getattr(_local, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = create_string_buffer(max(size * 2, MIN_BUFFER_SIZE))
+        _local.buf = buf
+    return buf
+
+
 def run_cipher(cipher, decipher):
     from os import urandom
     import random
@@ -122,6 +140,21 @@ def run_cipher(cipher, decipher):
     assert b''.join(results) == plain
 
 
+def test_get_buffer():
+    bufs = []
+
+    def get():
+        bufs.append(get_buffer(100))
+
+    get()
+    assert get_buffer(MIN_BUFFER_SIZE) is bufs[0]
+    assert len(get_buffer(MIN_BUFFER_SIZE + 1)) > MIN_BUFFER_SIZE
+    t = threading.Thread(target=get)
+    t.start()
+    t.join()
+    assert bufs[1] is not bufs[0]
+
+
 def test_find_library():
     assert find_library('c', 'strcpy', 'libc') is not None
     assert find_library(['c'], 'strcpy', 'libc') is not None
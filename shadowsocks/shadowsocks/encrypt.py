@@ -21,23 +21,104 @@ import os
 import sys
 import hashlib
 import logging
+import threading
 
-from shadowsocks import common
-from shadowsocks.crypto import rc4_md5, openssl, sodium, table
+from shadowsocks import common, buffers, lru_cache
+from shadowsocks.crypto import rc4_md5, openssl, sodium, table, \
+    cffi_backend
 
 
+# auto: cffi if it is installed, otherwise ctypes
+# the methods and the wire format are the same with either of them
+BACKENDS = ('auto', 'cffi', 'ctypes')
+
 method_supported = {}
-method_supported.update(rc4_md5.ciphers)
-method_supported.update(openssl.ciphers)
-method_supported.update(sodium.ciphers)
-method_supported.update(table.ciphers)
+
+
+def use_backend(name):
+    # selects how OpenSSL and libsodium are called, before any cipher is
+    # created
+    if name not in BACKENDS:
+        raise ValueError('unknown crypto backend %s' % name)
+    if name == 'cffi' and not cffi_backend.HAS_CFFI:
+        raise ValueError('crypto backend cffi requires cffi')
+    method_supported.clear()
+    method_supported.update(rc4_md5.ciphers)
+    method_supported.update(openssl.ciphers)
+    method_supported.update(sodium.ciphers)
+    method_supported.update(table.ciphers)
+    if name != 'ctypes':
+        method_supported.update(cffi_backend.ciphers)
+
+
+use_backend('auto')
+
+
+# IVs are cut from a pool of random bytes, so we call os.urandom() once every
+# RANDOM_POOL_SIZE bytes instead of once for each connection or UDP packet
+RANDOM_POOL_SIZE = 64 * 1024
+
+# with os.register_at_fork(), Python 3.7+, a forked child reseeds the pool
+# before it runs anything, otherwise get() compares the pid every time
+HAS_AT_FORK = hasattr(os, 'register_at_fork')
+
+
+class RandomPool(object):
+    """
+    the pool must never hand out the same bytes twice, so a forked child
+    drops the bytes it inherited from the parent, see reseed()
+
+    only use it for IVs and salts, they are sent in the clear anyway, keys
+    should come from os.urandom() directly
+    """
+
+    def __init__(self, size=RANDOM_POOL_SIZE):
+        self._size = size
+        self.reseed()
+
+    def reseed(self):
+        # the next get() refills the pool
+        # a new lock as well, the old one may be held by a thread of the
+        # parent which doesn't exist in the child
+        self._lock = threading.Lock()
+        self._buf = b''
+        self._pos = 0
+        self._pid = os.getpid()
+
+    def get(self, length):
+        if not HAS_AT_FORK and os.getpid() != self._pid:
+            self.reseed()
+        if length > self._size:
+            return os.urandom(length)
+        with self._lock:
+            pos = self._pos
+            if pos + length > len(self._buf):
+                self._buf = os.urandom(self._size)
+                pos = 0
+            self._pos = pos + length
+            return self._buf[pos:pos + length]
+
+
+_random_pool = RandomPool()
+
+if HAS_AT_FORK:
+    os.register_at_fork(after_in_child=_random_pool.reseed)
 
 
 def random_string(length):
-    return os.urandom(length)
+    return _random_pool.get(length)
+
+
+def reseed_random():
+    # call it in a forked child, in case os.register_at_fork() is missing
+    _random_pool.reseed()
 
 
-cached_keys = {}
+# the relays derive their keys only once, in CipherProfile, so this cache is
+# only for encrypt_all(), keep it small as the ports may come and go
+CACHED_KEYS_SIZE = 64
+
+cached_keys = lru_cache.LRUCache(max_entries=CACHED_KEYS_SIZE)
 
 
 def try_cipher(key, method=None):
@@ -47,7 +128,7 @@ def try_cipher(key, method=None):
 def EVP_BytesToKey(password, key_len, iv_len):
     # equivalent to OpenSSL's EVP_BytesToKey() with count 1
     # so that we make the same key and iv as nodejs version
-    cached_key = '%s-%d-%d' % (password, key_len, iv_len)
+    cached_key = (password, key_len, iv_len)
     r = cached_keys.get(cached_key, None)
     if r:
         return r
@@ -68,46 +149,71 @@ def EVP_BytesToKey(password, key_len, iv_len):
     return key, iv
 
 
+class CipherProfile(object):
+    """
+    what the ciphers of a port have in common: the method, the derived key,
+    and a keyed cipher for each direction to clone new ones from
+
+    the relays build one and share it with all their handlers, so that a
+    new connection doesn't derive the key or look up the method again
+    """
+
+    def __init__(self, password, method):
+        method = method.lower()
+        m = method_supported.get(method)
+        if not m:
+            logging.error('method %s not supported' % method)
+            sys.exit(1)
+        self.method = method
+        self.key_len, self.iv_len, self._m = m
+        self.aead = getattr(self._m, 'aead', False)
+        password = common.to_bytes(password)
+        if self.key_len > 0:
+            self.key = EVP_BytesToKey(password, self.key_len,
+                                      self.iv_len)[0]
+        else:
+            # key_length == 0 indicates we should use the key directly
+            self.key = password
+        # op: the template, or None if the cipher can't be cloned
+        self._templates = {}
+
+    def create(self, iv, op):
+        # returns a new cipher for iv
+        template = self._templates.get(op, False)
+        if template is False:
+            template = self._m(self.method, self.key, iv, op)
+            if not hasattr(template, 'clone'):
+                self._templates[op] = None
+                return template
+            # the template itself is never used
+            self._templates[op] = template
+        if template is None:
+            return self._m(self.method, self.key, iv, op)
+        return template.clone(iv)
+
+
 class Encryptor(object):
-    def __init__(self, key, method):
+    def __init__(self, key, method, profile=None):
+        # profile is the CipherProfile of the port, if there is one
+        if profile is None:
+            profile = CipherProfile(key, method)
+        self._profile = profile
         self.key = key
-        self.method = method
+        self.method = profile.method
         self.iv = None
         self.iv_sent = False
-        self.cipher_iv = b''
         self.decipher = None
-        method = method.lower()
-        self._method_info = self.get_method_info(method)
-        if self._method_info:
-            self.cipher = self.get_cipher(key, method, 1,
-                                          random_string(self._method_info[1]))
-        else:
-            logging.error('method %s not supported' % method)
-            sys.exit(1)
-
-    def get_method_info(self, method):
-        method = method.lower()
-        m = method_supported.get(method)
-        return m
+        # the IV received so far, it may come in more than one piece
+        self._decipher_iv = b''
+        self.cipher_iv = random_string(profile.iv_len)
+        self.cipher = profile.create(self.cipher_iv, 1)
+        # whether we can encrypt and decrypt memoryviews in place
+        self.inplace = buffers.ZERO_COPY and \
+            hasattr(self.cipher, 'update_into')
 
     def iv_len(self):
         return len(self.cipher_iv)
 
-    def get_cipher(self, password, method, op, iv):
-        password = common.to_bytes(password)
-        m = self._method_info
-        if m[0] > 0:
-            key, iv_ = EVP_BytesToKey(password, m[0], m[1])
-        else:
-            # key_length == 0 indicates we should use the key directly
-            key, iv = password, b''
-
-        iv = iv[:m[1]]
-        if op == 1:
-            # this iv is for cipher not decipher
-            self.cipher_iv = iv[:m[1]]
-        return m[2](method, key, iv, op)
-
     def encrypt(self, buf):
         if len(buf) == 0:
             return buf
@@ -121,15 +227,48 @@ class Encryptor(object):
         if len(buf) == 0:
             return buf
         if self.decipher is None:
-            decipher_iv_len = self._method_info[1]
-            decipher_iv = buf[:decipher_iv_len]
-            self.decipher = self.get_cipher(self.key, self.method, 0,
-                                            iv=decipher_iv)
+            iv_len = self._profile.iv_len
+            decipher_iv_len = iv_len - len(self._decipher_iv)
+            self._decipher_iv += buf[:decipher_iv_len]
             buf = buf[decipher_iv_len:]
+            if len(self._decipher_iv) < iv_len:
+                return b''
+            self.decipher = self._profile.create(self._decipher_iv, 0)
             if len(buf) == 0:
                 return buf
         return self.decipher.update(buf)
 
+    def encrypt_inplace(self, view):
+        # encrypt a writable memoryview in place
+        # returns the encrypted data, which is view itself unless we have
+        # to send the IV first
+        if len(view) == 0:
+            return view
+        if self.iv_sent and self.inplace:
+            self.cipher.update_into(view, view)
+            return view
+        return self.encrypt(view.tobytes())
+
+    def decrypt_inplace(self, view):
+        # decrypt a writable memoryview in place
+        # returns the decrypted data, a slice of view if it begins with IV
+        if len(view) == 0:
+            return view
+        if self.decipher is None:
+            iv_len = self._profile.iv_len
+            decipher_iv_len = iv_len - len(self._decipher_iv)
+            self._decipher_iv += view[:decipher_iv_len].tobytes()
+            view = view[decipher_iv_len:]
+            if len(self._decipher_iv) < iv_len:
+                return view
+            self.decipher = self._profile.create(self._decipher_iv, 0)
+            if len(view) == 0:
+                return view
+        if self.inplace:
+            self.decipher.update_into(view, view)
+            return view
+        return self.decipher.update(view.tobytes())
+
 
 def encrypt_all(password, method, op, data):
     result = []
@@ -146,10 +285,52 @@ def encrypt_all(password, method, op, data):
         iv = data[:iv_len]
         data = data[iv_len:]
     cipher = m(method, key, iv, op)
-    result.append(cipher.update(data))
+    if getattr(m, 'aead', False):
+        # each packet is sealed on its own, without chunks
+        result.append(cipher.packet(data))
+    else:
+        result.append(cipher.update(data))
     return b''.join(result)
 
 
+class CipherEngine(object):
+    """encrypts and decrypts whole packets for UDP, each with its own IV"""
+
+    def __init__(self, password, method, profile=None):
+        # the key is derived only once in the profile, not for every packet
+        if profile is None:
+            profile = CipherProfile(password, method)
+        self._profile = profile
+        self.method = profile.method
+        self.iv_len = profile.iv_len
+        self._aead = profile.aead
+        # the cipher contexts are reused with only a new IV for each packet
+        self._cipher = None
+        self._decipher = None
+
+    def seal(self, iv, data):
+        # returns the IV followed by the encrypted data
+        if self._cipher is None:
+            self._cipher = self._profile.create(iv, 1)
+        else:
+            self._cipher.reset(iv)
+        if self._aead:
+            return iv + self._cipher.packet(data)
+        return iv + self._cipher.update(data)
+
+    def open(self, data):
+        # returns the data decrypted with the IV in front of it
+        iv = data[:self.iv_len]
+        data = data[self.iv_len:]
+        if self._decipher is None:
+            self._decipher = self._profile.create(iv, 0)
+        else:
+            self._decipher.reset(iv)
+        if self._aead:
+            return self._decipher.packet(data)
+        return self._decipher.update(data)
+
+
 CIPHERS_TO_TEST = [
     'aes-128-cfb',
     'aes-256-cfb',
@@ -157,6 +338,8 @@ CIPHERS_TO_TEST = [
     'salsa20',
     'chacha20',
     'table',
+    'aes-256-gcm',
+    'chacha20-ietf-poly1305',
 ]
 
 
@@ -172,6 +355,91 @@ def test_encryptor():
         assert plain == plain2
 
 
+def test_encrypt_inplace():
+    from os import urandom
+    plain = urandom(10240)
+    for method in CIPHERS_TO_TEST:
+        logging.warn(method)
+        encryptor = Encryptor(b'key', method)
+        decryptor = Encryptor(b'key', method)
+        results = []
+        for i in range(0, len(plain), 1000):
+            view = memoryview(bytearray(plain[i:i + 1000]))
+            results.append(bytes(encryptor.encrypt_inplace(view)))
+        cipher = b''.join(results)
+        buf = bytearray(cipher)
+        # the IV may be split as well
+        plain2 = b''
+        for i, j in ((0, 10), (10, 40), (40, len(buf))):
+            plain2 += bytes(decryptor.decrypt_inplace(memoryview(buf)[i:j]))
+        assert plain == plain2
+
+
+def test_cipher_profile():
+    for method in CIPHERS_TO_TEST:
+        profile = CipherProfile(b'key', method)
+        plain = b'hello world'
+        # the handlers of a port share the profile
+        for i in range(0, 3):
+            encryptor = Encryptor(b'key', method, profile)
+            decryptor = Encryptor(b'key', method, profile)
+            cipher = encryptor.encrypt(plain)
+            assert decryptor.decrypt(cipher) == plain
+            assert Encryptor(b'key', method).decrypt(cipher) == plain
+
+    for i in range(0, CACHED_KEYS_SIZE * 2):
+        EVP_BytesToKey(common.to_bytes('key%d' % i), 32, 16)
+    assert len(cached_keys) == CACHED_KEYS_SIZE
+
+
+def test_random_pool():
+    pool = RandomPool(64)
+    a = pool.get(16)
+    b = pool.get(48)
+    c = pool.get(16)
+    assert len(a) == 16 and len(b) == 48 and len(c) == 16
+    assert len(set([a, b[:16], b[16:32], b[32:], c])) == 5
+    assert len(pool.get(100)) == 100
+
+    if not hasattr(os, 'fork'):
+        return
+    # fill the pool before fork()
+    random_string(16)
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the child must not get the bytes the parent gets next
+        os.write(w, random_string(16))
+        os._exit(0)
+    os.waitpid(pid, 0)
+    from_child = os.read(r, 16)
+    os.close(r)
+    os.close(w)
+    assert len(from_child) == 16 and from_child != random_string(16)
+
+
+def test_backends():
+    plain = os.urandom(10240)
+    results = []
+    for name in ('ctypes', 'auto'):
+        use_backend(name)
+        for method in ('aes-256-cfb', 'chacha20', 'aes-128-gcm'):
+            encryptor = Encryptor(b'key', method)
+            encryptor.cipher_iv = b'i' * len(encryptor.cipher_iv)
+            encryptor.cipher = encryptor._profile.create(encryptor.cipher_iv,
+                                                         1)
+            results.append(encryptor.encrypt(plain))
+    use_backend('auto')
+    # the same wire format
+    assert results[:3] == results[3:]
+    try:
+        use_backend('none')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
 def test_encrypt_all():
     from os import urandom
     plain = urandom(10240)
@@ -182,6 +450,25 @@ def test_encrypt_all():
         assert plain == plain2
 
 
+def test_cipher_engine():
+    from os import urandom
+    for method in CIPHERS_TO_TEST:
+        logging.warn(method)
+        engine = CipherEngine(b'key', method)
+        for i in range(0, 3):
+            plain = urandom(1000 + i)
+            cipher = engine.seal(random_string(engine.iv_len), plain)
+            # compatible with encrypt_all()
+            assert encrypt_all(b'key', method, 0, cipher) == plain
+            cipher = encrypt_all(b'key', method, 1, plain)
+            assert engine.open(cipher) == plain
+
+
 if __name__ == '__main__':
     test_encrypt_all()
+    test_cipher_engine()
     test_encryptor()
+    test_encrypt_inplace()
+    test_random_pool()
+    test_cipher_profile()
+    test_backends()
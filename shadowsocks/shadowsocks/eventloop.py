@@ -26,14 +26,16 @@ import time
 import socket
 import select
 import errno
+import heapq
 import logging
-from collections import defaultdict
+import itertools
+from collections import defaultdict, deque
 
-from shadowsocks import shell
+from shadowsocks import shell, buffers, executor
 
 
 __all__ = ['EventLoop', 'POLL_NULL', 'POLL_IN', 'POLL_OUT', 'POLL_ERR',
-           'POLL_HUP', 'POLL_NVAL', 'EVENT_NAMES']
+           'POLL_HUP', 'POLL_NVAL', 'POLL_ET', 'EVENT_NAMES']
 
 POLL_NULL = 0x00
 POLL_IN = 0x01
@@ -41,6 +43,9 @@ POLL_OUT = 0x04
 POLL_ERR = 0x08
 POLL_HUP = 0x10
 POLL_NVAL = 0x20
+# edge-triggered flag, same value as EPOLLET
+# only honored by epoll, other models ignore it and stay level-triggered
+POLL_ET = 0x80000000
 
 
 EVENT_NAMES = {
@@ -55,6 +60,16 @@ EVENT_NAMES = {
 # we check timeouts every TIMEOUT_PRECISION seconds
 TIMEOUT_PRECISION = 10
 
+# rebuild the timer heap when there are more than this many cancelled timers
+# and they take up more than half of the heap
+TIMERS_CLEAN_SIZE = 512
+
+# timers use a monotonic clock, so they are not affected by system time changes
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+else:
+    monotonic = time.time
+
 # Kqueue 适用于 BSD
 # https://developer.apple.com/library/mac/documentation/Darwin/Reference/ManPages/man2/kqueue.2.html
 class KqueueLoop(object):
@@ -174,6 +189,19 @@ class SelectLoop(object):
         pass
 
 
+class Timer(object):
+    """
+    call_later() 返回的句柄，可以传给 cancel() 取消
+    """
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
 class EventLoop(object):
     """
     EventLoop 是对 SelectLoop，EpollLoop 和 KqueueLoop 的抽象
@@ -197,8 +225,21 @@ class EventLoop(object):
             raise Exception('can not find any available functions in select '
                             'package')
         self._fdmap = {}  # (f, handler)
-        self._last_time = time.time()
+        # only epoll supports POLL_ET, strip it for other models
+        self.support_edge_triggered = model == 'epoll'
+        self._last_time = monotonic()
         self._periodic_callbacks = []
+        # a heap of (deadline, seq, timer), seq keeps the order of timers
+        # with the same deadline
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._cancelled_timers = 0
+        self._buffer_pools = {}
+        self._executor = None
+        # callbacks from other threads, and the socket pair to wake us up
+        self._thread_callbacks = deque()
+        self._waker = None
+        self._waker_notified = False
         self._stopping = False
         logging.debug('using event model: %s', model)
 
@@ -219,7 +260,7 @@ class EventLoop(object):
         # 在该实例中存储以文件描述符为键，文件对象和 handler 的元祖为值的字典
         self._fdmap[fd] = (f, handler)
         # 在 fdmap 中存储后注册该文件描述符和事件类型
-        self._impl.register(fd, mode)
+        self._impl.register(fd, self._filter_mode(mode))
 
     # 删除事件
     def remove(self, f):
@@ -236,10 +277,125 @@ class EventLoop(object):
     def remove_periodic(self, callback):
         self._periodic_callbacks.remove(callback)
 
+    # 注册定时事件，delay 秒后调用 callback(*args)，只调用一次
+    def call_later(self, delay, callback, *args):
+        timer = Timer(monotonic() + delay, callback, args)
+        heapq.heappush(self._timers,
+                       (timer.deadline, next(self._timer_seq), timer))
+        return timer
+
+    # 取消定时事件
+    # lazy deletion: the timer stays in the heap until it is popped
+    def cancel(self, timer):
+        if timer is None or timer.cancelled:
+            return
+        timer.cancelled = True
+        timer.callback = None
+        timer.args = None
+        self._cancelled_timers += 1
+        if self._cancelled_timers > TIMERS_CLEAN_SIZE and \
+                self._cancelled_timers > len(self._timers) >> 1:
+            self._timers = [t for t in self._timers if not t[2].cancelled]
+            heapq.heapify(self._timers)
+            self._cancelled_timers = 0
+
+    def _pop_cancelled_timers(self):
+        timers = self._timers
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+            self._cancelled_timers -= 1
+
+    # poll 的超时时间由最近的定时事件决定
+    def _poll_timeout(self):
+        self._pop_cancelled_timers()
+        if not self._timers:
+            return TIMEOUT_PRECISION
+        timeout = self._timers[0][0] - monotonic()
+        return max(0, min(timeout, TIMEOUT_PRECISION))
+
+    # 调用所有已到期的定时事件，O(到期数 * log n)
+    def _run_timers(self):
+        now = monotonic()
+        timers = self._timers
+        while timers and timers[0][0] <= now:
+            timer = heapq.heappop(timers)[2]
+            if timer.cancelled:
+                self._cancelled_timers -= 1
+                continue
+            callback, args = timer.callback, timer.args
+            # a fired timer can be cancelled again safely
+            timer.cancelled = True
+            timer.callback = None
+            timer.args = None
+            try:
+                callback(*args)
+            except (OSError, IOError) as e:
+                shell.print_exception(e)
+
+    # 获取该事件循环中指定大小的缓冲池，同一个循环中的 handler 共享
+    def buffer_pool(self, size):
+        pool = self._buffer_pools.get(size, None)
+        if pool is None:
+            pool = buffers.BufferPool(size)
+            self._buffer_pools[size] = pool
+        return pool
+
+    # 获取该事件循环的线程池，只在第一次调用时创建
+    def executor(self, threads):
+        if self._executor is None:
+            self._add_waker()
+            self._executor = executor.Executor(self, threads)
+        return self._executor
+
+    def _add_waker(self):
+        if self._waker is not None:
+            return
+        self._waker = socket.socketpair()
+        for sock in self._waker:
+            sock.setblocking(False)
+        self.add(self._waker[0], POLL_IN, self)
+
+    # 在其他线程中调用，让事件循环线程调用 callback(*args)
+    # only available once the waker is added, see executor()
+    def call_soon_threadsafe(self, callback, *args):
+        self._thread_callbacks.append((callback, args))
+        # wake up the loop only once until it has run the callbacks
+        if not self._waker_notified:
+            self._waker_notified = True
+            try:
+                self._waker[1].send(b'\x00')
+            except (OSError, IOError):
+                # the socket buffer is full, the loop will wake up anyway
+                pass
+
+    def handle_event(self, sock, fd, event):
+        # the waker is readable
+        try:
+            sock.recv(1024)
+        except (OSError, IOError):
+            pass
+        # clear the flag before running the callbacks, so a callback added
+        # after this will wake us up again
+        self._waker_notified = False
+        callbacks = self._thread_callbacks
+        while callbacks:
+            callback, args = callbacks.popleft()
+            try:
+                callback(*args)
+            except (OSError, IOError) as e:
+                shell.print_exception(e)
+
     # 修改已注册事件
+    # in edge-triggered mode, modify() also re-arms the fd: if it is still
+    # readable or writable, it will be reported again by the next poll()
     def modify(self, f, mode):
         fd = f.fileno()
-        self._impl.modify(fd, mode)
+        self._impl.modify(fd, self._filter_mode(mode))
+
+    def _filter_mode(self, mode):
+        if mode & POLL_ET and not self.support_edge_triggered:
+            return mode & ~POLL_ET
+        return mode
 
     # 停止事件循环
     def stop(self):
@@ -254,7 +410,7 @@ class EventLoop(object):
             asap = False
             try:
                 # 获取事件，返回给 events
-                events = self.poll(TIMEOUT_PRECISION)
+                events = self.poll(self._poll_timeout())
             except (OSError, IOError) as e:
                 if errno_from_exception(e) in (errno.EPIPE, errno.EINTR):
                     # EPIPE: Happens when the client closes the connection
@@ -280,7 +436,8 @@ class EventLoop(object):
                         handler.handle_event(sock, fd, event)
                     except (OSError, IOError) as e:
                         shell.print_exception(e)
-            now = time.time()
+            self._run_timers()
+            now = monotonic()
             # 如果 asap 或者 距离上次事件相差大于 TIMEOUT_PRECISION，就进行周期回调
             if asap or now - self._last_time >= TIMEOUT_PRECISION:
                 # 逐个回调
@@ -289,6 +446,11 @@ class EventLoop(object):
                 self._last_time = now
 
     def __del__(self):
+        if self._executor is not None:
+            self._executor.close()
+        if self._waker is not None:
+            for sock in self._waker:
+                sock.close()
         self._impl.close()
 
 
@@ -317,3 +479,53 @@ def errno_from_exception(e):
 def get_sock_error(sock):
     error_number = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
     return socket.error(error_number, os.strerror(error_number))
+
+
+def test_edge_triggered():
+    loop = EventLoop()
+    if not loop.support_edge_triggered:
+        return
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    events = []
+
+    class Handler(object):
+        def handle_event(self, sock, fd, event):
+            events.append(event)
+
+    loop.add(a, POLL_IN | POLL_ET, Handler())
+    b.send(b'x' * 16)
+    for sock, fd, event in loop.poll(0):
+        loop._fdmap[fd][1].handle_event(sock, fd, event)
+    assert events == [POLL_IN]
+    # not drained, but no new data arrived: nothing is reported again
+    assert not loop.poll(0)
+    # modify() re-arms the fd
+    loop.modify(a, POLL_IN | POLL_ET)
+    assert len(loop.poll(0)) == 1
+    loop.remove(a)
+    a.close()
+    b.close()
+
+
+def test_timers():
+    loop = EventLoop()
+    fired = []
+    loop.call_later(0.2, fired.append, 2)
+    loop.call_later(0.1, fired.append, 1)
+    timer = loop.call_later(0.1, fired.append, 3)
+    loop.call_later(0.3, loop.stop)
+    loop.cancel(timer)
+    start = monotonic()
+    loop.run()
+    assert fired == [1, 2]
+    # the loop wakes up for the timers instead of polling for 10 seconds
+    assert monotonic() - start < 1
+    assert not loop._timers
+    # cancel a fired timer does nothing
+    loop.cancel(timer)
+
+
+if __name__ == '__main__':
+    test_edge_triggered()
+    test_timers()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# run the ciphers in a thread pool, ctypes releases the GIL while OpenSSL or
+# libsodium is encrypting, so the threads can use more than one CPU
+# 在线程池中加解密，结果通过事件循环的唤醒 fd 交回事件循环线程
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+__all__ = ['Executor']
+
+
+class Executor(object):
+    """
+    submit() must be called in the loop thread, callbacks are called there
+    as well, in the order the jobs finish
+
+    jobs can run in any order, so a caller that needs ordering, like the
+    cipher of a connection, must wait for its job before submitting another
+    """
+
+    def __init__(self, loop, threads):
+        self._loop = loop
+        self._jobs = queue.Queue()
+        self._threads = []
+        for i in range(0, threads):
+            t = threading.Thread(target=self._work,
+                                 name='executor-%d' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        logging.debug('started %d executor threads', threads)
+
+    def submit(self, func, data, callback):
+        # calls func(data) in a thread, then callback(result, error) in the
+        # loop thread, error is the exception raised by func or None
+        self._jobs.put((func, data, callback))
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            func, data, callback = job
+            try:
+                result, error = func(data), None
+            except Exception as e:
+                result, error = None, e
+            self._loop.call_soon_threadsafe(callback, result, error)
+
+    def close(self):
+        # the threads exit once they have finished the submitted jobs
+        for t in self._threads:
+            self._jobs.put(None)
+        self._threads = []
+
+
+def test_executor():
+    from shadowsocks import eventloop
+
+    loop = eventloop.EventLoop()
+    executor = loop.executor(4)
+    assert loop.executor(2) is executor
+    results = []
+
+    def fail(data):
+        raise ValueError(data)
+
+    def on_done(result, error):
+        results.append((result, error))
+        if len(results) == 2:
+            loop.stop()
+
+    executor.submit(lambda data: data.upper(), b'hello', on_done)
+    executor.submit(fail, b'oops', on_done)
+    # don't wait forever if the loop is never woken up
+    loop.call_later(5, loop.stop)
+    loop.run()
+    executor.close()
+    assert (b'HELLO', None) in results
+    error = [e for r, e in results if e is not None][0]
+    assert type(error) == ValueError
+
+
+if __name__ == '__main__':
+    test_executor()
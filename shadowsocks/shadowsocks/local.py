@@ -24,7 +24,8 @@ import logging
 import signal
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
-from shadowsocks import shell, daemon, eventloop, tcprelay, udprelay, asyncdns
+from shadowsocks import shell, daemon, eventloop, tcprelay, udprelay, \
+    asyncdns, balancer
 
 
 def main():
@@ -45,8 +46,12 @@ def main():
                      (config['local_address'], config['local_port']))
 
         dns_resolver = asyncdns.DNSResolver()
-        tcp_server = tcprelay.TCPRelay(config, dns_resolver, True)
-        udp_server = udprelay.UDPRelay(config, dns_resolver, True)
+        # TCP and UDP choose from the same servers
+        server_balancer = balancer.Balancer.from_config(config)
+        tcp_server = tcprelay.TCPRelay(config, dns_resolver, True,
+                                       server_balancer=server_balancer)
+        udp_server = udprelay.UDPRelay(config, dns_resolver, True,
+                                       server_balancer=server_balancer)
         loop = eventloop.EventLoop()
         dns_resolver.add_to_loop(loop)
         tcp_server.add_to_loop(loop)
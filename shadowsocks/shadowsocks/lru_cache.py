@@ -18,52 +18,93 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-import collections
 import logging
 import time
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
 
 # this LRUCache is optimized for concurrency, not QPS
 # n: concurrency, keys stored in the cache
-# m: visits not timed out, proportional to QPS * timeout
-# get & set is O(1), not O(n). thus we can support very large n
-# TODO: if timeout or QPS is too large, then this cache is not very efficient,
-#       as sweep() causes long pause
+# keys are kept in a doubly linked list in the order of their last visits,
+# the least recently visited at the head
+# get & set & delete is O(1), not O(n). thus we can support very large n
+# sweep() only looks at the expired keys at the head, so it's O(expired)
+
+# items don't expire when the system time is changed
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+else:
+    monotonic = time.time
+
+
+class _Node(object):
+    __slots__ = ('prev', 'next', 'key', 'value', 'last_visit')
 
 
-class LRUCache(collections.MutableMapping):
+class LRUCache(MutableMapping):
     """This class is not thread safe"""
 
-    def __init__(self, timeout=60, close_callback=None, *args, **kwargs):
+    def __init__(self, timeout=60, close_callback=None, max_entries=0,
+                 *args, **kwargs):
         self.timeout = timeout
         self.close_callback = close_callback
-        self._store = {}
-        self._time_to_keys = collections.defaultdict(list)
-        self._keys_to_last_time = {}
-        self._last_visits = collections.deque()
-        self._closed_values = set()
+        # if max_entries > 0, the least recently used key is evicted when
+        # there are more keys than that, close_callback is called for it
+        self.max_entries = max_entries
+        self._store = {}  # key: node
+        # the sentinel of the circular linked list
+        self._root = root = _Node()
+        root.prev = root.next = root
         self.update(dict(*args, **kwargs))  # use the free update to set keys
 
+    def _unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    def _append(self, node):
+        # move node to the tail, which is the most recently visited
+        root = self._root
+        last = root.prev
+        node.prev = last
+        node.next = root
+        last.next = root.prev = node
+        node.last_visit = monotonic()
+
     def __getitem__(self, key):
         # O(1)
-        t = time.time()
-        self._keys_to_last_time[key] = t
-        self._time_to_keys[t].append(key)
-        self._last_visits.append(t)
-        return self._store[key]
+        node = self._store[key]
+        self._unlink(node)
+        self._append(node)
+        return node.value
 
     def __setitem__(self, key, value):
         # O(1)
-        t = time.time()
-        self._keys_to_last_time[key] = t
-        self._store[key] = value
-        self._time_to_keys[t].append(key)
-        self._last_visits.append(t)
+        node = self._store.get(key, None)
+        if node is not None:
+            self._unlink(node)
+        else:
+            node = _Node()
+            node.key = key
+            self._store[key] = node
+        node.value = value
+        self._append(node)
+        if 0 < self.max_entries < len(self._store):
+            head = self._root.next
+            self._evict(head)
+            logging.debug('evicted least recently used key')
 
     def __delitem__(self, key):
         # O(1)
-        del self._store[key]
-        del self._keys_to_last_time[key]
+        node = self._store.pop(key)
+        self._unlink(node)
+
+    def __contains__(self, key):
+        # doesn't count as a visit
+        return key in self._store
 
     def __iter__(self):
         return iter(self._store)
@@ -71,33 +112,46 @@ class LRUCache(collections.MutableMapping):
     def __len__(self):
         return len(self._store)
 
-    def sweep(self):
-        # O(m)
-        now = time.time()
+    def touch(self, key):
+        # mark key as visited just now, without fetching it
+        node = self._store[key]
+        self._unlink(node)
+        self._append(node)
+
+    def next_expiry(self):
+        # when the least recently visited key expires, on the monotonic
+        # clock, None if the cache is empty
+        head = self._root.next
+        if head is self._root:
+            return None
+        return head.last_visit + self.timeout
+
+    def _evict(self, node):
+        del self._store[node.key]
+        self._unlink(node)
+        if self.close_callback is not None:
+            self.close_callback(node.value)
+
+    def sweep(self, budget=0):
+        # remove the keys not visited in timeout seconds
+        # if budget > 0, remove at most budget keys, the rest will be swept
+        # next time
+        # O(expired)
+        now = monotonic()
+        root = self._root
+        timeout = self.timeout
         c = 0
-        while len(self._last_visits) > 0:
-            least = self._last_visits[0]
-            if now - least <= self.timeout:
+        while root.next is not root:
+            if 0 < budget <= c:
                 break
-            if self.close_callback is not None:
-                for key in self._time_to_keys[least]:
-                    if key in self._store:
-                        if now - self._keys_to_last_time[key] > self.timeout:
-                            value = self._store[key]
-                            if value not in self._closed_values:
-                                self.close_callback(value)
-                                self._closed_values.add(value)
-            for key in self._time_to_keys[least]:
-                self._last_visits.popleft()
-                if key in self._store:
-                    if now - self._keys_to_last_time[key] > self.timeout:
-                        del self._store[key]
-                        del self._keys_to_last_time[key]
-                        c += 1
-            del self._time_to_keys[least]
+            head = root.next
+            if now - head.last_visit <= timeout:
+                break
+            self._evict(head)
+            c += 1
         if c:
-            self._closed_values.clear()
             logging.debug('%d keys swept' % c)
+        return c
 
 
 def test():
@@ -145,6 +199,56 @@ def test():
     c['s']
     time.sleep(0.3)
     c.sweep()
+    assert close_cb_called
+
+
+def test_max_entries():
+    closed = []
+    c = LRUCache(timeout=60, close_callback=closed.append, max_entries=2)
+    c['a'] = 1
+    c['b'] = 2
+    c['a']
+    c['c'] = 3
+    # b is the least recently used one
+    assert closed == [2]
+    assert 'b' not in c and len(c) == 2
+    c.touch('a')
+    c['d'] = 4
+    assert closed == [2, 3]
+    assert sorted(c.keys()) == ['a', 'd']
+    del c['a']
+    c['e'] = 5
+    assert closed == [2, 3]
+
+
+def test_next_expiry():
+    c = LRUCache(timeout=10)
+    assert c.next_expiry() is None
+    c['a'] = 1
+    t = c.next_expiry()
+    assert 0 < t - monotonic() <= 10
+    c['b'] = 2
+    assert c.next_expiry() == t
+    del c['a']
+    assert c.next_expiry() > t
+
+
+def test_sweep_budget():
+    c = LRUCache(timeout=0.1)
+    for i in range(0, 10):
+        c[i] = i
+    c[0]
+    time.sleep(0.2)
+    c[9]
+    assert c.sweep(budget=3) == 3
+    # 0 was visited after the others, so it goes later
+    assert 0 in c and 3 not in c and 4 in c
+    assert c.sweep() == 6
+    assert list(c.keys()) == [9]
+
 
 if __name__ == '__main__':
     test()
+    test_max_entries()
+    test_next_expiry()
+    test_sweep_budget()
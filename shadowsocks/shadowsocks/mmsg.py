@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# batched UDP IO with recvmmsg() and sendmmsg(), Linux 3.0+ only
+# 一次系统调用收发多个 UDP 数据包
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import errno
+import socket
+import struct
+import logging
+from ctypes import CDLL, Structure, POINTER, c_void_p, c_size_t, c_uint, \
+    c_uint32, c_int, c_char_p, c_char, cast, addressof, string_at, get_errno
+
+__all__ = ['HAS_MMSG', 'BatchReceiver', 'get_receiver', 'send_batch']
+
+# a sockaddr_storage is big enough for any address
+SOCKADDR_SIZE = 128
+
+
+class iovec(Structure):
+    _fields_ = [('iov_base', c_void_p),
+                ('iov_len', c_size_t)]
+
+
+class msghdr(Structure):
+    _fields_ = [('msg_name', c_void_p),
+                ('msg_namelen', c_uint32),
+                ('msg_iov', POINTER(iovec)),
+                ('msg_iovlen', c_size_t),
+                ('msg_control', c_void_p),
+                ('msg_controllen', c_size_t),
+                ('msg_flags', c_int)]
+
+
+class mmsghdr(Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', c_uint)]
+
+
+libc = None
+
+
+def load_libc():
+    global libc
+    libc = CDLL(None, use_errno=True)
+    libc.recvmmsg.restype = c_int
+    libc.recvmmsg.argtypes = (c_int, POINTER(mmsghdr), c_uint, c_int,
+                              c_void_p)
+    libc.sendmmsg.restype = c_int
+    libc.sendmmsg.argtypes = (c_int, POINTER(mmsghdr), c_uint, c_int)
+
+
+HAS_MMSG = False
+if sys.platform.startswith('linux'):
+    try:
+        load_libc()
+        HAS_MMSG = True
+    except (OSError, AttributeError):
+        logging.debug('recvmmsg/sendmmsg not available')
+
+
+def parse_sockaddr(raw):
+    # returns the address in the same form as socket.recvfrom()
+    family = struct.unpack('=H', raw[:2])[0]
+    port = struct.unpack('>H', raw[2:4])[0]
+    if family == socket.AF_INET:
+        return socket.inet_ntop(socket.AF_INET, raw[4:8]), port
+    elif family == socket.AF_INET6:
+        flowinfo = struct.unpack('>I', raw[4:8])[0]
+        scope_id = struct.unpack('=I', raw[24:28])[0]
+        return (socket.inet_ntop(socket.AF_INET6, raw[8:24]), port,
+                flowinfo, scope_id)
+    return None
+
+
+def pack_sockaddr(family, addr):
+    if family == socket.AF_INET:
+        return struct.pack('=H', family) + struct.pack('>H', addr[1]) + \
+            socket.inet_pton(family, addr[0]) + b'\x00' * 8
+    flowinfo = 0
+    scope_id = 0
+    if len(addr) == 4:
+        flowinfo, scope_id = addr[2], addr[3]
+    return struct.pack('=H', family) + \
+        struct.pack('>HI', addr[1], flowinfo) + \
+        socket.inet_pton(family, addr[0]) + struct.pack('=I', scope_id)
+
+
+def raise_errno():
+    err = get_errno()
+    raise OSError(err, os.strerror(err))
+
+
+class BatchReceiver(object):
+    """This class is not thread safe"""
+
+    def __init__(self, size, buf_size):
+        # receive at most size datagrams of buf_size bytes each time
+        self.size = size
+        self._bufs = (c_char * (buf_size * size))()
+        self._names = (c_char * (SOCKADDR_SIZE * size))()
+        self._iovecs = (iovec * size)()
+        self._msgs = (mmsghdr * size)()
+        bufs = addressof(self._bufs)
+        names = addressof(self._names)
+        for i in range(0, size):
+            self._iovecs[i].iov_base = bufs + buf_size * i
+            self._iovecs[i].iov_len = buf_size
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = names + SOCKADDR_SIZE * i
+            hdr.msg_iov = cast(addressof(self._iovecs[i]), POINTER(iovec))
+            hdr.msg_iovlen = 1
+
+    def recv(self, sock):
+        # returns a list of (data, addr), like calling recvfrom() many times
+        # socket errors other than EAGAIN are raised
+        msgs = self._msgs
+        for i in range(0, self.size):
+            msgs[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+        n = libc.recvmmsg(sock.fileno(), msgs, self.size, 0, None)
+        if n < 0:
+            if get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise_errno()
+        result = []
+        for i in range(0, n):
+            hdr = msgs[i].msg_hdr
+            data = string_at(self._iovecs[i].iov_base, msgs[i].msg_len)
+            addr = parse_sockaddr(string_at(hdr.msg_name, hdr.msg_namelen))
+            result.append((data, addr))
+        return result
+
+
+_receivers = {}
+
+
+def get_receiver(size, buf_size):
+    # the received data are copied out of the buffers, so all the relays in
+    # the process can share one receiver, as they run in the same thread
+    key = (size, buf_size)
+    receiver = _receivers.get(key, None)
+    if receiver is None:
+        receiver = BatchReceiver(size, buf_size)
+        _receivers[key] = receiver
+    return receiver
+
+
+def send_batch(sock, packets):
+    # sends a list of (data, addr) with one syscall, like calling sendto()
+    # many times, returns the number of datagrams sent
+    # when the socket buffer is full, the rest are dropped, as UDP does
+    n = len(packets)
+    if not n:
+        return 0
+    msgs = (mmsghdr * n)()
+    iovecs = (iovec * n)()
+    # keep references to the buffers until sendmmsg() returns
+    refs = []
+    for i in range(0, n):
+        data, addr = packets[i]
+        name = pack_sockaddr(sock.family, addr)
+        name_p = c_char_p(name)
+        data_p = c_char_p(data)
+        refs.append((name_p, data_p))
+        iovecs[i].iov_base = cast(data_p, c_void_p)
+        iovecs[i].iov_len = len(data)
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = cast(name_p, c_void_p)
+        hdr.msg_namelen = len(name)
+        hdr.msg_iov = cast(addressof(iovecs[i]), POINTER(iovec))
+        hdr.msg_iovlen = 1
+    sent = 0
+    while sent < n:
+        r = libc.sendmmsg(sock.fileno(), cast(addressof(msgs[sent]),
+                                              POINTER(mmsghdr)),
+                          n - sent, 0)
+        if r < 0:
+            if get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            raise_errno()
+        sent += r
+    return sent
+
+
+def test_batch():
+    if not HAS_MMSG:
+        return
+    a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    a.bind(('127.0.0.1', 0))
+    a.setblocking(False)
+    b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    b.bind(('127.0.0.1', 0))
+    b.setblocking(False)
+    receiver = BatchReceiver(4, 2048)
+    assert receiver.recv(a) == []
+    for i in range(0, 6):
+        b.sendto(b'packet' + str(i).encode('ascii'), a.getsockname())
+    packets = receiver.recv(a)
+    assert len(packets) == 4
+    assert packets[0] == (b'packet0', b.getsockname())
+    packets += receiver.recv(a)
+    assert [data for data, addr in packets] == \
+        [b'packet' + str(i).encode('ascii') for i in range(0, 6)]
+    assert send_batch(a, [(data.upper(), addr) for data, addr in packets]) \
+        == 6
+    assert b.recvfrom(2048) == (b'PACKET0', a.getsockname())
+    assert [data for data, addr in receiver.recv(b)] == \
+        [b'PACKET' + str(i).encode('ascii') for i in range(1, 5)]
+    a.close()
+    b.close()
+
+
+if __name__ == '__main__':
+    test_batch()
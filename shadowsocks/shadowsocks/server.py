@@ -20,12 +20,22 @@ from __future__ import absolute_import, division, print_function, \
 
 import sys
 import os
+import time
+import errno
 import logging
 import signal
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
 from shadowsocks import shell, daemon, eventloop, tcprelay, udprelay, \
-    asyncdns, manager
+    asyncdns, manager, encrypt
+
+# if a worker exits within WORKER_RESTART_DELAY seconds after it's started,
+# wait that long before starting it again, so we won't fork too fast
+WORKER_RESTART_DELAY = 1
+
+# a worker that exits that soon WORKER_MAX_FAILURES times in a row can't
+# start at all, like when it can't bind the port, so we stop restarting it
+WORKER_MAX_FAILURES = 5
 
 
 def main():
@@ -104,17 +114,30 @@ def main():
     port_password = config['port_password']
     # 后面用 port_password 中每一项分别生成一份配置，所以 config['port_password'] 就用不着了
     del config['port_password']
-    # 循环每一对端口和密码
-    for port, password in port_password.items():
-        # dict.copy() 创建了一个新的字典对象，内容一样
-        a_config = config.copy()
-        a_config['server_port'] = int(port)
-        a_config['password'] = password
-        logging.info("starting server at %s:%d" %
-                     (a_config['server'], int(port)))
-        # 用每一对端口和密码产生一对 TCP 和 UDP 的 Relay 实例
-        tcp_servers.append(tcprelay.TCPRelay(a_config, dns_resolver, False))
-        udp_servers.append(udprelay.UDPRelay(a_config, dns_resolver, False))
+
+    def create_servers():
+        # 循环每一对端口和密码
+        for port, password in port_password.items():
+            # dict.copy() 创建了一个新的字典对象，内容一样
+            a_config = config.copy()
+            a_config['server_port'] = int(port)
+            a_config['password'] = password
+            logging.info("starting server at %s:%d" %
+                         (a_config['server'], int(port)))
+            # 用每一对端口和密码产生一对 TCP 和 UDP 的 Relay 实例
+            tcp_servers.append(tcprelay.TCPRelay(a_config, dns_resolver,
+                                                 False))
+            udp_servers.append(udprelay.UDPRelay(a_config, dns_resolver,
+                                                 False))
+
+    workers = int(config['workers'])
+    # with reuse_port, each worker creates its own listening sockets after
+    # fork, instead of sharing the ones created here, so the kernel can
+    # spread connections among them, and we can restart crashed workers
+    reuse_port = config['reuse_port'] and workers > 1 and os.name == 'posix'
+    config['reuse_port'] = reuse_port
+    if not reuse_port:
+        create_servers()
 
     def run_server():
         def child_handler(signum, _):
@@ -136,6 +159,8 @@ def main():
         signal.signal(signal.SIGINT, int_handler)
 
         try:
+            if reuse_port:
+                create_servers()
             # 定义新事件循环
             loop = eventloop.EventLoop()
             # 添加 dns 解析器到事件循环中
@@ -150,50 +175,102 @@ def main():
             shell.print_exception(e)
             sys.exit(1)
 
+    def set_cpu_affinity(index):
+        # pin worker index to one of the CPUs, round robin
+        if not hasattr(os, 'sched_setaffinity'):
+            logging.warn('cpu affinity is only available on Linux with '
+                         'Python 3.3+')
+            return
+        cpus = sorted(os.sched_getaffinity(0))
+        cpu = cpus[index % len(cpus)]
+        os.sched_setaffinity(0, [cpu])
+        logging.info('worker %d pinned to CPU %d' % (index, cpu))
+
+    def start_worker(index):
+        # fork a worker, returns its pid in the master
+        # the worker never returns from here
+        pid = os.fork()
+        if pid == 0:
+            logging.info('worker started')
+            # never send the IVs the master or other workers may send
+            encrypt.reseed_random()
+            # don't inherit the handler of the master
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if config['cpu_affinity']:
+                set_cpu_affinity(index)
+            run_server()
+            sys.exit(0)
+        return pid
+
     # 如果 workers 为 1 则直接启动 server，否则进行 fork()
-    if int(config['workers']) > 1:
+    if workers > 1:
         if os.name == 'posix':
-            children = []
-            is_child = False
-            for i in range(0, int(config['workers'])):
-                r = os.fork()
-                # 如果执行这段代码的进程为子进程，输出启动信息，然后运行 run_server()
-                if r == 0:
-                    logging.info('worker started')
-                    is_child = True
-                    run_server()
-                    break
+            # pid: (worker index, start time)
+            children = {}
+            # worker index: how many times in a row it exited right after
+            # it was started
+            failures = {}
+            for i in range(0, workers):
+                children[start_worker(i)] = (i, time.time())
+
+            def stop_workers(signum):
+                for pid in list(children.keys()):
+                    try:
+                        os.kill(pid, signum)
+                        os.waitpid(pid, 0)
+                    except OSError:  # child may already exited
+                        pass
+
+            def handler(signum, _):
+                stop_workers(signum)
+                sys.exit()
+            # 当收到中断或者终止信号时，向每个子进程 pid 发出终止信号
+            signal.signal(signal.SIGTERM, handler)
+            signal.signal(signal.SIGQUIT, handler)
+            signal.signal(signal.SIGINT, handler)
+
+            # master
+            # 关闭所有 tcp_server，udp_server 和 dns 解析器
+            # close 方法从 eventloop 中移除了每个注册的事件
+            for a_tcp_server in tcp_servers:
+                a_tcp_server.close()
+            for a_udp_server in udp_servers:
+                a_udp_server.close()
+            dns_resolver.close()
+
+            # 等待子进程结束，在 reuse_port 模式下重启异常退出的子进程
+            while children:
+                try:
+                    pid, status = os.waitpid(-1, 0)
+                except OSError as e:
+                    if eventloop.errno_from_exception(e) == errno.EINTR:
+                        continue
+                    raise
+                if pid not in children:
+                    continue
+                index, started = children.pop(pid)
+                if not reuse_port:
+                    # the listening sockets are closed in the master, so
+                    # a new worker would have nothing to serve
+                    continue
+                if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                    # shut down gracefully
+                    continue
+                quick = time.time() - started < WORKER_RESTART_DELAY
+                if quick:
+                    failures[index] = failures.get(index, 0) + 1
                 else:
-                    # 如果为父进程，添加到 pid 到子进程列表中
-                    children.append(r)
-            # 如果是父进程
-            if not is_child:
-                def handler(signum, _):
-                    for pid in children:
-                        try:
-                            os.kill(pid, signum)
-                            os.waitpid(pid, 0)
-                        except OSError:  # child may already exited
-                            pass
-                    sys.exit()
-                # 当收到中断或者终止信号时，向每个子进程 pid 发出终止信号
-                signal.signal(signal.SIGTERM, handler)
-                signal.signal(signal.SIGQUIT, handler)
-                signal.signal(signal.SIGINT, handler)
-
-                # master
-                # 关闭所有 tcp_server，udp_server 和 dns 解析器
-                # close 方法从 eventloop 中移除了每个注册的事件
-                for a_tcp_server in tcp_servers:
-                    a_tcp_server.close()
-                for a_udp_server in udp_servers:
-                    a_udp_server.close()
-                dns_resolver.close()
-
-                for child in children:
-                    # TODO 待测试
-                    # 等待子进程结束，当子进程结束时返回
-                    os.waitpid(child, 0)
+                    failures[index] = 0
+                if failures[index] >= WORKER_MAX_FAILURES:
+                    logging.error('worker %d failed to start %d times, '
+                                  'exiting' % (index, failures[index]))
+                    stop_workers(signal.SIGTERM)
+                    sys.exit(1)
+                logging.error('worker %d exited unexpectedly with status %d, '
+                              'restarting' % (index, status))
+                if quick:
+                    time.sleep(WORKER_RESTART_DELAY)
+                children[start_worker(index)] = (index, time.time())
         else:
             logging.warn('worker is only available on Unix/Linux')
             run_server()
@@ -24,7 +24,8 @@ import sys
 import getopt
 import logging
 from shadowsocks.common import to_bytes, to_str, IPNetwork
-from shadowsocks import encrypt
+from shadowsocks import encrypt, buffers
+from shadowsocks.crypto import table
 
 
 VERBOSE_LEVEL = 5
@@ -113,6 +114,10 @@ def check_config(config, is_local):
     if config.get('timeout', 300) > 600:
         logging.warn('warning: your timeout %d seems too long' %
                      int(config.get('timeout')))
+    if config.get('low_watermark', 0) > config.get('high_watermark', 0):
+        logging.error('low watermark %d is higher than high watermark %d' %
+                      (config['low_watermark'], config['high_watermark']))
+        sys.exit(2)
     if config.get('password') in [b'mypassword']:
         logging.error('DON\'T USE DEFAULT PASSWORD! Please change it in your '
                       'config.json!')
@@ -122,6 +127,17 @@ def check_config(config, is_local):
             logging.error('user can be used only on Unix')
             sys.exit(1)
 
+    try:
+        encrypt.use_backend(config.get('crypto_backend', 'auto'))
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(2)
+    if config.get('table_cache', None):
+        try:
+            table.set_cache_dir(config['table_cache'])
+        except (OSError, IOError, ValueError) as e:
+            logging.error('can not use table cache: %s' % e)
+            sys.exit(2)
     encrypt.try_cipher(config['password'], config['method'])
 
 
@@ -133,11 +149,17 @@ def get_config(is_local):
     if is_local:
         shortopts = 'hd:s:b:p:k:l:m:c:t:vq'
         longopts = ['help', 'fast-open', 'pid-file=', 'log-file=', 'user=',
-                    'version']
+                    'version', 'edge-triggered', 'high-watermark=',
+                    'low-watermark=', 'memory-budget=', 'crypto-threads=',
+                    'crypto-threshold=', 'crypto-backend=', 'prewarm=']
     else:
         shortopts = 'hd:s:p:k:m:c:t:vq'
         longopts = ['help', 'fast-open', 'pid-file=', 'log-file=', 'workers=',
-                    'forbidden-ip=', 'user=', 'manager-address=', 'version']
+                    'forbidden-ip=', 'user=', 'manager-address=', 'version',
+                    'edge-triggered', 'high-watermark=', 'low-watermark=',
+                    'memory-budget=', 'reuse-port', 'cpu-affinity',
+                    'crypto-threads=', 'crypto-threshold=', 'crypto-backend=',
+                    'table-cache=', 'remote-fast-open']
     try:
         # 寻找 config.json
         config_path = find_config()
@@ -182,8 +204,32 @@ def get_config(is_local):
                 config['timeout'] = int(value)
             elif key == '--fast-open':
                 config['fast_open'] = True
+            elif key == '--remote-fast-open':
+                config['remote_fast_open'] = True
+            elif key == '--edge-triggered':
+                config['edge_triggered'] = True
+            elif key == '--high-watermark':
+                config['high_watermark'] = int(value)
+            elif key == '--low-watermark':
+                config['low_watermark'] = int(value)
+            elif key == '--memory-budget':
+                config['memory_budget'] = int(value)
+            elif key == '--crypto-threads':
+                config['crypto_threads'] = int(value)
+            elif key == '--crypto-threshold':
+                config['crypto_threshold'] = int(value)
+            elif key == '--crypto-backend':
+                config['crypto_backend'] = to_str(value)
+            elif key == '--prewarm':
+                config['prewarm'] = int(value)
             elif key == '--workers':
                 config['workers'] = int(value)
+            elif key == '--reuse-port':
+                config['reuse_port'] = True
+            elif key == '--cpu-affinity':
+                config['cpu_affinity'] = True
+            elif key == '--table-cache':
+                config['table_cache'] = to_str(value)
             elif key == '--manager-address':
                 config['manager_address'] = value
             elif key == '--user':
@@ -223,7 +269,21 @@ def get_config(is_local):
     config['port_password'] = config.get('port_password', None)
     config['timeout'] = int(config.get('timeout', 300))
     config['fast_open'] = config.get('fast_open', False)
+    config['remote_fast_open'] = config.get('remote_fast_open', False)
+    config['edge_triggered'] = config.get('edge_triggered', False)
+    config['high_watermark'] = int(config.get('high_watermark',
+                                              buffers.HIGH_WATERMARK))
+    config['low_watermark'] = int(config.get('low_watermark',
+                                             buffers.LOW_WATERMARK))
+    config['memory_budget'] = int(config.get('memory_budget', 0))
+    config['crypto_threads'] = int(config.get('crypto_threads', 0))
+    config['crypto_threshold'] = int(config.get('crypto_threshold', 16384))
+    config['crypto_backend'] = to_str(config.get('crypto_backend', 'auto'))
+    config['prewarm'] = int(config.get('prewarm', 0))
     config['workers'] = config.get('workers', 1)
+    config['reuse_port'] = config.get('reuse_port', False)
+    config['cpu_affinity'] = config.get('cpu_affinity', False)
+    config['table_cache'] = config.get('table_cache', None)
     config['pid-file'] = config.get('pid-file', '/var/run/shadowsocks.pid')
     config['log-file'] = config.get('log-file', '/var/log/shadowsocks.log')
     config['verbose'] = config.get('verbose', False)
@@ -291,6 +351,16 @@ Proxy options:
   -m METHOD              encryption method, default: aes-256-cfb
   -t TIMEOUT             timeout in seconds, default: 300
   --fast-open            use TCP_FASTOPEN, requires Linux 3.7+
+  --edge-triggered       use edge-triggered epoll for TCP, Linux only
+  --high-watermark BYTES pause reading above this, default: 131072
+  --low-watermark BYTES  resume reading below this, default: 32768
+  --memory-budget BYTES  limit of all write buffers, default: 0, unlimited
+  --crypto-threads N     encrypt in N threads besides the loop, default: 0
+  --crypto-threshold BYTES
+                         only chunks this large use them, default: 16384
+  --crypto-backend NAME  call OpenSSL and libsodium through cffi or ctypes,
+                         default: auto, cffi if it is installed
+  --prewarm N            keep N idle connections to each server, default: 0
 
 General options:
   -h, --help             show this help message and exit
@@ -320,7 +390,20 @@ Proxy options:
   -m METHOD              encryption method, default: aes-256-cfb
   -t TIMEOUT             timeout in seconds, default: 300
   --fast-open            use TCP_FASTOPEN, requires Linux 3.7+
+  --remote-fast-open     use TCP_FASTOPEN to destinations, requires Linux 3.7+
+  --edge-triggered       use edge-triggered epoll for TCP, Linux only
+  --high-watermark BYTES pause reading above this, default: 131072
+  --low-watermark BYTES  resume reading below this, default: 32768
+  --memory-budget BYTES  limit of all write buffers, default: 0, unlimited
+  --crypto-threads N     encrypt in N threads besides the loop, default: 0
+  --crypto-threshold BYTES
+                         only chunks this large use them, default: 16384
+  --crypto-backend NAME  call OpenSSL and libsodium through cffi or ctypes,
+                         default: auto, cffi if it is installed
   --workers WORKERS      number of workers, available on Unix/Linux
+  --reuse-port           each worker has its own sockets, requires Linux 3.9+
+  --cpu-affinity         pin each worker to a CPU, Linux only
+  --table-cache DIR      save the tables of the table method in DIR
   --forbidden-ip IPLIST  comma seperated IP list forbidden to connect
   --manager-address ADDR optional server manager UDP address, see wiki
 
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# parses what a SOCKS5 client sends to sslocal before its data, rfc1928
+# a client may send the greeting, the request and its first data at once
+# without waiting for our replies, or send them in pieces
+# 客户端可能一次发来问候、请求和数据，也可能分几次发来
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+from shadowsocks import common
+from shadowsocks.common import ADDRTYPE_IPV4, ADDRTYPE_IPV6, ADDRTYPE_HOST
+
+__all__ = ['Socks5Parser', 'Socks5Error']
+
+SOCKS_VERSION = 5
+
+METHOD_NO_AUTH = b'\x00'
+
+# what we reply before closing the connection if the client doesn't offer
+# no authentication, rfc1928 section 3
+REPLY_NO_ACCEPTABLE_METHODS = b'\x05\xff'
+
+STATE_GREETING = 0
+STATE_REQUEST = 1
+STATE_DONE = 2
+
+
+class Socks5Error(Exception):
+    def __init__(self, message, reply=None):
+        Exception.__init__(self, message)
+        # sent to the client before we close the connection, if not None
+        self.reply = reply
+
+
+class Socks5Parser(object):
+    """
+    feed() it the data from the client as it arrives, once it returns True,
+    cmd, header and rest are set
+
+    header is ATYP DST.ADDR DST.PORT of the request, the same as the header
+    that sslocal sends to ssserver, rest is what the client sent after the
+    request
+    """
+
+    def __init__(self):
+        self._data = b''
+        self._state = STATE_GREETING
+        self.cmd = None
+        self.header = None
+        self.rest = None
+
+    @property
+    def greeted(self):
+        # whether we have the whole greeting, and should reply to it
+        return self._state != STATE_GREETING
+
+    def feed(self, data):
+        # returns True once we have the whole request
+        self._data += data
+        if self._state == STATE_GREETING and not self._parse_greeting():
+            return False
+        if self._state == STATE_REQUEST and not self._parse_request():
+            return False
+        return True
+
+    def _parse_greeting(self):
+        # VER NMETHODS METHODS
+        data = self._data
+        if len(data) < 2:
+            return False
+        self._check_version(data)
+        end = 2 + common.ord(data[1])
+        if len(data) < end:
+            return False
+        if METHOD_NO_AUTH not in data[2:end]:
+            raise Socks5Error('the client doesn\'t offer no authentication, '
+                              'the only method we support',
+                              REPLY_NO_ACCEPTABLE_METHODS)
+        self._data = data[end:]
+        self._state = STATE_REQUEST
+        return True
+
+    def _parse_request(self):
+        # VER CMD RSV ATYP DST.ADDR DST.PORT
+        data = self._data
+        if len(data) < 5:
+            return False
+        self._check_version(data)
+        addrtype = common.ord(data[3])
+        if addrtype == ADDRTYPE_IPV4:
+            end = 4 + 4 + 2
+        elif addrtype == ADDRTYPE_IPV6:
+            end = 4 + 16 + 2
+        elif addrtype == ADDRTYPE_HOST:
+            end = 4 + 1 + common.ord(data[4]) + 2
+        else:
+            raise Socks5Error('unsupported addrtype %d' % addrtype)
+        if len(data) < end:
+            return False
+        self.cmd = common.ord(data[1])
+        self.header = data[3:end]
+        self.rest = data[end:]
+        self._data = b''
+        self._state = STATE_DONE
+        return True
+
+    def _check_version(self, data):
+        version = common.ord(data[0])
+        if version != SOCKS_VERSION:
+            raise Socks5Error('unsupported SOCKS version %d' % version)
+
+
+GREETING = b'\x05\x02\x00\x01'
+REQUEST = b'\x05\x01\x00\x03\x0bexample.com\x00\x50'
+
+
+def test_pipelined():
+    parser = Socks5Parser()
+    assert parser.feed(GREETING + REQUEST + b'GET / HTTP/1.1\r\n')
+    assert parser.greeted
+    assert parser.cmd == 1
+    assert parser.header == b'\x03\x0bexample.com\x00\x50'
+    assert common.parse_header(parser.header) == \
+        (ADDRTYPE_HOST, b'example.com', 80, len(parser.header))
+    assert parser.rest == b'GET / HTTP/1.1\r\n'
+
+
+def test_pieces():
+    data = GREETING + REQUEST
+    parser = Socks5Parser()
+    for i in range(0, len(data) - 1):
+        assert not parser.feed(data[i:i + 1])
+        # the whole greeting is there
+        assert parser.greeted == (i >= len(GREETING) - 1)
+    assert parser.feed(data[-1:])
+    assert parser.header == b'\x03\x0bexample.com\x00\x50'
+    assert parser.rest == b''
+
+    parser = Socks5Parser()
+    assert not parser.feed(GREETING)
+    assert parser.greeted
+    assert parser.feed(b'\x05\x03\x00\x04' + b'\x00' * 15 + b'\x01\x00\x35')
+    assert parser.cmd == 3
+    assert common.parse_header(parser.header)[1:3] == (b'::1', 53)
+
+
+def test_errors():
+    for data, reply in ((b'\x04\x01\x00', None),
+                        (b'\x05\x01\x02', REPLY_NO_ACCEPTABLE_METHODS),
+                        (GREETING + b'\x05\x01\x00\x05\x00', None)):
+        parser = Socks5Parser()
+        try:
+            parser.feed(data)
+        except Socks5Error as e:
+            assert e.reply == reply
+        else:
+            assert False, data
+
+
+if __name__ == '__main__':
+    test_pipelined()
+    test_pieces()
+    test_errors()
@@ -18,19 +18,18 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-import time
+import sys
 import socket
 import errno
 import struct
 import logging
 import traceback
-import random
+import collections
 
-from shadowsocks import encrypt, eventloop, shell, common
+from shadowsocks import encrypt, eventloop, shell, common, buffers, \
+    connpool, balancer, lru_cache, socks5
 from shadowsocks.common import parse_header
-
-# we clear at most TIMEOUTS_CLEAN_SIZE timeouts each time
-TIMEOUTS_CLEAN_SIZE = 512
+from shadowsocks.crypto.aead import AeadDecryptError
 
 MSG_FASTOPEN = 0x20000000
 
@@ -113,11 +112,59 @@ WAIT_STATUS_READWRITING = WAIT_STATUS_READING | WAIT_STATUS_WRITING
 
 BUF_SIZE = 32 * 1024
 
+# in edge-triggered mode, we read a socket at most READ_BUDGET times for each
+# event, then re-arm it so that other connections can get their turn
+READ_BUDGET = 16
+
+# we accept at most ACCEPT_BUDGET connections for each event on the server
+# socket, it is level-triggered, so the rest are accepted in the next round,
+# after the connections we already have get their turn
+ACCEPT_BUDGET = 64
+
+# accepted sockets inherit TCP_NODELAY from the server socket on these
+# systems, so we set it once instead of once for each connection
+NODELAY_INHERITED = sys.platform.startswith(('linux', 'darwin', 'freebsd'))
+
+# with --crypto-threads, chunks at least this large are encrypted or
+# decrypted in the executor threads, smaller ones are not worth the round trip
+CRYPTO_THRESHOLD = 16 * 1024
+
+# happy eyeballs: when the remote has more than one address, we start to
+# connect to the next one if the last attempt hasn't connected in this many
+# seconds, keep the one that connects first and close the others, RFC 8305
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+# ssserver with remote_fast_open, we stop sending data in the SYN to a
+# destination that didn't take it FAST_OPEN_MAX_MISSES times in a row, until
+# we haven't connected to it for FAST_OPEN_CACHE_TIMEOUT seconds
+FAST_OPEN_MAX_MISSES = 2
+FAST_OPEN_CACHE_TIMEOUT = 600
+FAST_OPEN_CACHE_SIZE = 4096
+
+# Linux, tcpi_options of struct tcp_info, the data in our SYN was acked
+TCP_INFO = getattr(socket, 'TCP_INFO', None)
+TCPI_OPT_SYN_DATA = 32
+
+
+def syn_data_acked(sock):
+    # whether the destination took the data we sent in the SYN, True if we
+    # can't tell
+    if TCP_INFO is None:
+        return True
+    try:
+        # tcpi_state, tcpi_ca_state, tcpi_retransmits, tcpi_probes,
+        # tcpi_backoff, tcpi_options
+        info = sock.getsockopt(socket.SOL_TCP, TCP_INFO, 8)
+    except (OSError, IOError):
+        return True
+    return common.ord(info[5]) & TCPI_OPT_SYN_DATA != 0
+
 
 class TCPRelayHandler(object):
     def __init__(self, server, fd_to_handlers, loop, local_sock, config,
-                 dns_resolver, is_local):
+                 dns_resolver, is_local, client_address=None):
         # server 为 TCPHandler 实例
+        # client_address is what accept() returned, if we have it
         self._server = server
         self._fd_to_handlers = fd_to_handlers
         self._loop = loop
@@ -129,16 +176,61 @@ class TCPRelayHandler(object):
         # TCP Relay works as either sslocal or ssserver
         # if is_local, this is sslocal
         self._is_local = is_local
+        self._edge_triggered = server.edge_triggered
+        if self._edge_triggered:
+            self._poll_et = eventloop.POLL_ET
+        else:
+            self._poll_et = 0
         self._stage = STAGE_INIT
         self._encryptor = encrypt.Encryptor(config['password'],
-                                            config['method'])
+                                            config['method'],
+                                            server.cipher_profile)
+        # if the cipher works in place, we recv into pooled buffers, so each
+        # chunk is copied only once, from the kernel into the buffer
+        if self._encryptor.inplace:
+            self._buffer_pool = loop.buffer_pool(BUF_SIZE)
+        else:
+            self._buffer_pool = None
         self._fastopen_connected = False
-        self._data_to_write_to_local = []
-        self._data_to_write_to_remote = []
+        # sslocal, the client sent data along with the request
+        self._early_data = False
+        if is_local:
+            self._socks5 = socks5.Socks5Parser()
+        else:
+            self._socks5 = None
+        # data waiting to be written, the queues keep memoryviews of the
+        # pooled buffers and send them with sendmsg() without joining them
+        self._memory_budget = server.memory_budget
+        self._data_to_write_to_local = \
+            buffers.WriteQueue(self._buffer_pool, self._memory_budget)
+        self._data_to_write_to_remote = \
+            buffers.WriteQueue(self._buffer_pool, self._memory_budget)
+        self._high_watermark = config.get('high_watermark',
+                                          buffers.HIGH_WATERMARK)
+        self._low_watermark = config.get('low_watermark',
+                                         buffers.LOW_WATERMARK)
         self._upstream_status = WAIT_STATUS_READING
         self._downstream_status = WAIT_STATUS_INIT
-        self._client_address = local_sock.getpeername()[:2]
+        self._executor = server.executor
+        self._crypto_threshold = config.get('crypto_threshold',
+                                            CRYPTO_THRESHOLD)
+        # whether a chunk of each stream is in the executor, we don't read
+        # that stream until it comes back, so the chunks stay in order
+        self._crypting = [False, False]
+        if client_address is None:
+            client_address = local_sock.getpeername()
+        self._client_address = client_address[:2]
         self._remote_address = None
+        # sslocal, when we started to connect to the server, until the
+        # connection is writable
+        self._connect_start = None
+        # the addresses we haven't tried yet, and the sockets still
+        # connecting, fd: (sock, sockaddr, bytes sent in the SYN or None),
+        # the first connected becomes _remote_sock
+        self._remote_ips = None
+        self._remote_port = None
+        self._attempts = {}
+        self._attempt_timer = None
         if 'forbidden_ip' in config:
             self._forbidden_iplist = config['forbidden_ip']
         else:
@@ -149,8 +241,10 @@ class TCPRelayHandler(object):
         # 这里直接对 TCPRelay 实例中的 _fd_to_handlers 赋值
         fd_to_handlers[local_sock.fileno()] = self
         local_sock.setblocking(False)
-        local_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-        loop.add(local_sock, eventloop.POLL_IN | eventloop.POLL_ERR,
+        if not NODELAY_INHERITED:
+            local_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        loop.add(local_sock,
+                 eventloop.POLL_IN | eventloop.POLL_ERR | self._poll_et,
                  self._server)
         self.last_activity = 0
         # 调用 TCPHandler 的 update_activity() 方法
@@ -169,14 +263,10 @@ class TCPRelayHandler(object):
     def remote_address(self):
         return self._remote_address
 
-    # 作为本地客户端运行时，随机选择一台服务器和服务端口
+    # 作为本地客户端运行时，选择一台服务器和服务端口
     def _get_a_server(self):
-        server = self._config['server']
-        server_port = self._config['server_port']
-        if type(server_port) == list:
-            server_port = random.choice(server_port)
-        if type(server) == list:
-            server = random.choice(server)
+        # released in destroy()
+        server, server_port = self._server.balancer.acquire()
         logging.debug('chosen server: %s:%d', server, server_port)
         return server, server_port
 
@@ -206,51 +296,84 @@ class TCPRelayHandler(object):
                 dirty = True
         if dirty:
             if self._local_sock:
-                event = eventloop.POLL_ERR
-                if self._downstream_status & WAIT_STATUS_WRITING:
-                    event |= eventloop.POLL_OUT
-                if self._upstream_status & WAIT_STATUS_READING:
-                    event |= eventloop.POLL_IN
-                self._loop.modify(self._local_sock, event)
+                self._loop.modify(self._local_sock,
+                                  self._get_event(self._local_sock))
             if self._remote_sock:
-                event = eventloop.POLL_ERR
-                if self._downstream_status & WAIT_STATUS_READING:
-                    event |= eventloop.POLL_IN
-                if self._upstream_status & WAIT_STATUS_WRITING:
-                    event |= eventloop.POLL_OUT
-                self._loop.modify(self._remote_sock, event)
-
-    def _write_to_sock(self, data, sock):
+                self._loop.modify(self._remote_sock,
+                                  self._get_event(self._remote_sock))
+
+    def _get_event(self, sock):
+        # events we are waiting for on sock, according to the stream status
+        event = eventloop.POLL_ERR | self._poll_et
+        if sock == self._local_sock:
+            if self._downstream_status & WAIT_STATUS_WRITING:
+                event |= eventloop.POLL_OUT
+            if self._upstream_status & WAIT_STATUS_READING and \
+                    not self._crypting[STREAM_UP]:
+                event |= eventloop.POLL_IN
+        elif sock == self._remote_sock:
+            if self._downstream_status & WAIT_STATUS_READING and \
+                    not self._crypting[STREAM_DOWN]:
+                event |= eventloop.POLL_IN
+            if self._upstream_status & WAIT_STATUS_WRITING:
+                event |= eventloop.POLL_OUT
+        return event
+
+    def _drain(self, sock, on_read):
+        # in level-triggered mode, read once and let the loop call us again
+        # in edge-triggered mode, we won't be notified again until new data
+        # arrives, so keep reading until the socket is drained
+        if not self._edge_triggered:
+            on_read()
+            return
+        for i in range(0, READ_BUDGET):
+            if not on_read():
+                # drained, paused or destroyed
+                return
+        # budget used up, re-arm it so the loop will report it again
+        self._loop.modify(sock, self._get_event(sock))
+
+    def _write_to_sock(self, data, sock, buf=None):
         # write data to sock
         # if only some of the data are written, put remaining in the buffer
         # and update the stream to wait for writing
-        if not data or not sock:
+        # if buf is given, data refers to that pooled buffer and the write
+        # queue takes it over, the caller must not put it back to the pool
+        if not sock:
+            if buf is not None:
+                self._buffer_pool.put(buf)
+            return False
+        if sock == self._local_sock:
+            queue = self._data_to_write_to_local
+        elif sock == self._remote_sock:
+            queue = self._data_to_write_to_remote
+        else:
+            logging.error('write_all_to_sock:unknown socket')
             return False
-        uncomplete = False
+        queue.append(data, buf)
+        if not queue:
+            return False
+        return self._flush_to_sock(queue, sock)
+
+    def _flush_to_sock(self, queue, sock):
+        # send as much queued data as we can with as few syscalls as possible
         try:
-            l = len(data)
-            s = sock.send(data)
-            if s < l:
-                data = data[s:]
-                uncomplete = True
+            queue.send(sock)
         except (OSError, IOError) as e:
-            error_no = eventloop.errno_from_exception(e)
-            if error_no in (errno.EAGAIN, errno.EINPROGRESS,
-                            errno.EWOULDBLOCK):
-                uncomplete = True
-            else:
-                shell.print_exception(e)
-                self.destroy()
-                return False
-        if uncomplete:
+            shell.print_exception(e)
+            if sock == self._remote_sock:
+                self.report_failure()
+            self.destroy()
+            return False
+        if queue:
+            # keep reading the other side until the queue hits the high
+            # watermark
             if sock == self._local_sock:
-                self._data_to_write_to_local.append(data)
-                self._update_stream(STREAM_DOWN, WAIT_STATUS_WRITING)
-            elif sock == self._remote_sock:
-                self._data_to_write_to_remote.append(data)
-                self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
+                self._update_stream(STREAM_DOWN,
+                                    self._wait_status(queue, STREAM_DOWN))
             else:
-                logging.error('write_all_to_sock:unknown socket')
+                self._update_stream(STREAM_UP,
+                                    self._wait_status(queue, STREAM_UP))
         else:
             if sock == self._local_sock:
                 self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
@@ -260,48 +383,103 @@ class TCPRelayHandler(object):
                 logging.error('write_all_to_sock:unknown socket')
         return True
 
+    def _wait_status(self, queue, stream):
+        # the status of a stream whose write queue is not empty
+        if stream == STREAM_DOWN:
+            status = self._downstream_status
+        else:
+            status = self._upstream_status
+        if self._memory_budget.exceeded:
+            # only pause, never resume, until we are back within the budget
+            # queue is not empty, so we'll get here again once it's writable
+            return WAIT_STATUS_WRITING
+        if status & WAIT_STATUS_READING:
+            limit = self._high_watermark
+        else:
+            # paused, wait until the queue drains
+            limit = self._low_watermark
+        # what the queue keeps in memory, not only the data waiting, as a
+        # small chunk may keep a whole pooled buffer
+        if queue.memory > limit:
+            return WAIT_STATUS_WRITING
+        return WAIT_STATUS_READWRITING
+
     def _handle_stage_connecting(self, data):
         if self._is_local:
             data = self._encryptor.encrypt(data)
         self._data_to_write_to_remote.append(data)
         if self._is_local and not self._fastopen_connected and \
                 self._config['fast_open']:
-            # for sslocal and fastopen, we basically wait for data and use
-            # sendto to connect
-            try:
-                # only connect once
-                self._fastopen_connected = True
-                remote_sock = \
-                    self._create_remote_socket(self._chosen_server[0],
-                                               self._chosen_server[1])
-                self._loop.add(remote_sock, eventloop.POLL_ERR, self._server)
-                data = b''.join(self._data_to_write_to_remote)
-                l = len(data)
-                s = remote_sock.sendto(data, MSG_FASTOPEN, self._chosen_server)
-                if s < l:
-                    data = data[s:]
-                    self._data_to_write_to_remote = [data]
-                else:
-                    self._data_to_write_to_remote = []
+            self._fast_open_connect()
+        if self._stage == STAGE_CONNECTING and self._data_to_write_to_remote:
+            # don't buffer too much from local while we are still connecting
+            status = self._wait_status(self._data_to_write_to_remote,
+                                       STREAM_UP)
+            self._update_stream(STREAM_UP, status)
+
+    def _fast_open_connect(self):
+        # for sslocal and fastopen, we basically wait for data and use
+        # sendto to connect
+        try:
+            # only connect once
+            self._fastopen_connected = True
+            remote_sock = \
+                self._create_remote_socket(self._chosen_server[0],
+                                           self._chosen_server[1])
+            self._loop.add(remote_sock,
+                           eventloop.POLL_ERR | self._poll_et,
+                           self._server)
+            data = self._data_to_write_to_remote.join()
+            s = remote_sock.sendto(data, MSG_FASTOPEN, self._chosen_server)
+            self._data_to_write_to_remote.consume(s)
+            self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) == errno.EINPROGRESS:
+                # in this case data is not sent at all
                 self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
-            except (OSError, IOError) as e:
-                if eventloop.errno_from_exception(e) == errno.EINPROGRESS:
-                    # in this case data is not sent at all
-                    self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
-                elif eventloop.errno_from_exception(e) == errno.ENOTCONN:
-                    logging.error('fast open not supported on this OS')
-                    self._config['fast_open'] = False
-                    self.destroy()
-                else:
-                    shell.print_exception(e)
-                    if self._config['verbose']:
-                        traceback.print_exc()
-                    self.destroy()
+            elif eventloop.errno_from_exception(e) == errno.ENOTCONN:
+                logging.error('fast open not supported on this OS')
+                self._config['fast_open'] = False
+                self.destroy()
+            else:
+                shell.print_exception(e)
+                if self._config['verbose']:
+                    traceback.print_exc()
+                self.report_failure()
+                self.destroy()
 
-    def _handle_stage_addr(self, data):
+    def _handle_socks5(self, data):
+        # sslocal, the greeting and the request may come in one read, with
+        # the first data of the client after them, or in pieces
+        try:
+            done = self._socks5.feed(data)
+        except socks5.Socks5Error as e:
+            self._log_error(e)
+            if e.reply:
+                self._write_to_sock(e.reply, self._local_sock)
+            self.destroy()
+            return
+        reply = b''
+        if self._stage == STAGE_INIT and self._socks5.greeted:
+            self._stage = STAGE_ADDR
+            # no authentication
+            reply = b'\x05\x00'
+        if not done:
+            if reply:
+                # the client waits for it before it sends the request
+                self._write_to_sock(reply, self._local_sock)
+            return
+        # the client didn't wait, so we reply to both at once
+        parser = self._socks5
+        self._socks5 = None
+        self._handle_stage_addr(parser.header + parser.rest, parser.cmd,
+                                reply)
+
+    def _handle_stage_addr(self, data, cmd=CMD_CONNECT, reply=b''):
+        # sslocal, data is the address in the request and the data after
+        # it, reply is what we haven't sent yet for the greeting
         try:
             if self._is_local:
-                cmd = common.ord(data[1])
                 if cmd == CMD_UDP_ASSOCIATE:
                     logging.debug('UDP associate')
                     if self._local_sock.family == socket.AF_INET6:
@@ -312,15 +490,12 @@ class TCPRelayHandler(object):
                     addr_to_send = socket.inet_pton(self._local_sock.family,
                                                     addr)
                     port_to_send = struct.pack('>H', port)
-                    self._write_to_sock(header + addr_to_send + port_to_send,
-                                        self._local_sock)
+                    self._write_to_sock(reply + header + addr_to_send +
+                                        port_to_send, self._local_sock)
                     self._stage = STAGE_UDP_ASSOC
                     # just wait for the client to disconnect
                     return
-                elif cmd == CMD_CONNECT:
-                    # just trim VER CMD RSV
-                    data = data[3:]
-                else:
+                elif cmd != CMD_CONNECT:
                     logging.error('unknown command %d', cmd)
                     self.destroy()
                     return
@@ -337,11 +512,18 @@ class TCPRelayHandler(object):
             self._stage = STAGE_DNS
             if self._is_local:
                 # forward address to remote
-                self._write_to_sock((b'\x05\x00\x00\x01'
-                                     b'\x00\x00\x00\x00\x10\x10'),
+                self._early_data = len(data) > header_length
+                self._write_to_sock(reply + (b'\x05\x00\x00\x01'
+                                             b'\x00\x00\x00\x00\x10\x10'),
                                     self._local_sock)
                 data_to_send = self._encryptor.encrypt(data)
                 self._data_to_write_to_remote.append(data_to_send)
+                remote_sock = self._server.take_connection(
+                    self._chosen_server)
+                if remote_sock:
+                    self._handle_connected(remote_sock)
+                    return
+                self._connect_start = eventloop.monotonic()
                 # notice here may go into _handle_dns_resolved directly
                 self._dns_resolver.resolve(self._chosen_server[0],
                                            self._handle_dns_resolved)
@@ -357,7 +539,8 @@ class TCPRelayHandler(object):
                 traceback.print_exc()
             self.destroy()
 
-    def _create_remote_socket(self, ip, port):
+    def _new_remote_socket(self, ip, port):
+        # returns (sock, sockaddr to connect to)
         addrs = socket.getaddrinfo(ip, port, 0, socket.SOCK_STREAM,
                                    socket.SOL_TCP)
         if len(addrs) == 0:
@@ -368,15 +551,140 @@ class TCPRelayHandler(object):
                 raise Exception('IP %s is in forbidden list, reject' %
                                 common.to_str(sa[0]))
         remote_sock = socket.socket(af, socktype, proto)
-        self._remote_sock = remote_sock
-        self._fd_to_handlers[remote_sock.fileno()] = self
         remote_sock.setblocking(False)
         remote_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        return remote_sock, sa
+
+    def _create_remote_socket(self, ip, port):
+        remote_sock = self._new_remote_socket(ip, port)[0]
+        self._remote_sock = remote_sock
+        self._fd_to_handlers[remote_sock.fileno()] = self
         return remote_sock
 
+    def _connect_next(self):
+        # start to connect to the next address, and to the one after it if
+        # this one doesn't connect soon
+        self._loop.cancel(self._attempt_timer)
+        self._attempt_timer = None
+        error = None
+        while self._remote_ips:
+            ip = self._remote_ips.popleft()
+            try:
+                remote_sock, sa = self._new_remote_socket(ip,
+                                                          self._remote_port)
+            except Exception as e:
+                error = e
+                continue
+            # the destination may take the data in the SYN even if that
+            # attempt loses, and the winner would send it again, so only send
+            # it when no other attempt is connecting, and don't start another
+            # one while it is in flight, see below
+            fast_open = not self._attempts and \
+                self._data_to_write_to_remote and \
+                self._server.remote_fast_open(sa[:2])
+            sent = None
+            try:
+                if fast_open:
+                    sent = self._fast_open(remote_sock, sa)
+                if sent is None:
+                    remote_sock.connect(sa)
+            except (OSError, IOError) as e:
+                if eventloop.errno_from_exception(e) != errno.EINPROGRESS:
+                    # like ENETUNREACH when we have no IPv6 route, try the
+                    # next one at once
+                    logging.debug('can not connect to %s: %s', sa[0], e)
+                    remote_sock.close()
+                    error = e
+                    continue
+            fd = remote_sock.fileno()
+            self._attempts[fd] = (remote_sock, sa, sent)
+            self._fd_to_handlers[fd] = self
+            self._loop.add(remote_sock,
+                           eventloop.POLL_ERR | eventloop.POLL_OUT |
+                           self._poll_et,
+                           self._server)
+            # if the data went in the SYN, we had a cookie from a recent
+            # connection to this address, so wait for it instead of racing,
+            # we still move on at once if it fails
+            if self._remote_ips and not sent:
+                self._attempt_timer = self._loop.call_later(
+                    CONNECTION_ATTEMPT_DELAY, self._connect_next)
+            return
+        if not self._attempts:
+            self._log_error(error)
+            self.report_failure()
+            self.destroy()
+
+    def _fast_open(self, remote_sock, sa):
+        # ssserver, connect and send the data we have in the SYN, returns
+        # how many bytes were sent, 0 if the kernel has no cookie for the
+        # destination yet and only asks for one, None if we should connect()
+        data = self._data_to_write_to_remote.join()
+        try:
+            return remote_sock.sendto(data, MSG_FASTOPEN, sa)
+        except (OSError, IOError) as e:
+            error_no = eventloop.errno_from_exception(e)
+            if error_no == errno.EINPROGRESS:
+                return 0
+            elif error_no in (errno.EOPNOTSUPP, errno.ENOTCONN):
+                self._server.disable_remote_fast_open()
+                return None
+            raise
+
+    def _on_attempt_event(self, sock, event):
+        fd = sock.fileno()
+        sa, sent = self._attempts.pop(fd)[1:]
+        error = eventloop.get_sock_error(sock)
+        if event & eventloop.POLL_ERR or error.errno:
+            # not a fast open miss, the data wasn't taken since it couldn't
+            # connect at all
+            logging.debug('can not connect to %s: %s', sa[0], error)
+            self._loop.remove(sock)
+            del self._fd_to_handlers[fd]
+            sock.close()
+            if self._remote_ips:
+                # don't wait for the timer
+                self._connect_next()
+            elif not self._attempts:
+                self._log_error(error)
+                self.report_failure()
+                self.destroy()
+            return
+        # the first one connected, close the others
+        self._close_attempts()
+        if sent:
+            self._data_to_write_to_remote.consume(sent)
+            self._server.report_fast_open(sa[:2], syn_data_acked(sock))
+        self._remote_sock = sock
+        self._loop.modify(sock, self._get_event(sock))
+        self._on_remote_write()
+
+    def _close_attempts(self):
+        self._loop.cancel(self._attempt_timer)
+        self._attempt_timer = None
+        self._remote_ips = None
+        for fd, (sock, sa, sent) in self._attempts.items():
+            self._loop.remove(sock)
+            del self._fd_to_handlers[fd]
+            sock.close()
+        self._attempts.clear()
+
+    def _handle_connected(self, remote_sock):
+        # sslocal, a connection from the pool, it is writable right away
+        logging.debug('using a prewarmed connection')
+        self._remote_sock = remote_sock
+        self._fd_to_handlers[remote_sock.fileno()] = self
+        self._loop.add(remote_sock,
+                       eventloop.POLL_ERR | eventloop.POLL_OUT | self._poll_et,
+                       self._server)
+        self._stage = STAGE_CONNECTING
+        self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
+        self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
+
     def _handle_dns_resolved(self, result, error):
         if error:
             self._log_error(error)
+            self.report_failure()
             self.destroy()
             return
         if result:
@@ -385,7 +693,6 @@ class TCPRelayHandler(object):
 
                 try:
                     self._stage = STAGE_CONNECTING
-                    remote_addr = ip
                     if self._is_local:
                         remote_port = self._chosen_server[1]
                     else:
@@ -395,113 +702,221 @@ class TCPRelayHandler(object):
                         # for fastopen:
                         # wait for more data to arrive and send them in one SYN
                         self._stage = STAGE_CONNECTING
-                        # we don't have to wait for remote since it's not
-                        # created
-                        self._update_stream(STREAM_UP, WAIT_STATUS_READING)
-                        # TODO when there is already data in this packet
+                        if self._early_data:
+                            # the client sent data with the request, it may
+                            # be waiting for a reply, so don't wait for more
+                            self._fast_open_connect()
+                        else:
+                            # we don't have to wait for remote since it's
+                            # not created
+                            self._update_stream(STREAM_UP,
+                                                WAIT_STATUS_READING)
                     else:
-                        # else do connect
-                        remote_sock = self._create_remote_socket(remote_addr,
-                                                                 remote_port)
-                        try:
-                            remote_sock.connect((remote_addr, remote_port))
-                        except (OSError, IOError) as e:
-                            if eventloop.errno_from_exception(e) == \
-                                    errno.EINPROGRESS:
-                                pass
-                        self._loop.add(remote_sock,
-                                       eventloop.POLL_ERR | eventloop.POLL_OUT,
-                                       self._server)
+                        # else do connect, to all the addresses in turn
+                        self._remote_ips = collections.deque(result[2])
+                        self._remote_port = remote_port
                         self._stage = STAGE_CONNECTING
                         self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
                         self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
+                        self._connect_next()
                     return
                 except Exception as e:
                     shell.print_exception(e)
                     if self._config['verbose']:
                         traceback.print_exc()
+        self.report_failure()
         self.destroy()
 
+    def _recv(self, sock):
+        # returns (data, buf), buf is the pooled buffer data refers to,
+        # it should be put back to the pool when data is no longer used
+        if self._buffer_pool is None:
+            return sock.recv(BUF_SIZE), None
+        buf = self._buffer_pool.get()
+        try:
+            n = sock.recv_into(buf)
+        except Exception:
+            self._buffer_pool.put(buf)
+            raise
+        return memoryview(buf)[:n], buf
+
+    def _encrypt(self, data):
+        if self._buffer_pool is not None:
+            return self._encryptor.encrypt_inplace(data)
+        return self._encryptor.encrypt(data)
+
+    def _decrypt(self, data):
+        if self._buffer_pool is not None:
+            return self._encryptor.decrypt_inplace(data)
+        return self._encryptor.decrypt(data)
+
+    def _offload(self, stream, data, buf):
+        # encrypt or decrypt a large chunk in the executor, it is written in
+        # _on_offloaded() when it comes back
+        # returns False if the chunk should be handled in the loop thread
+        if self._executor is None or len(data) < self._crypto_threshold:
+            return False
+        if stream == STREAM_UP:
+            func = self._encrypt if self._is_local else self._decrypt
+            sock = self._local_sock
+        else:
+            func = self._decrypt if self._is_local else self._encrypt
+            sock = self._remote_sock
+        self._crypting[stream] = True
+        self._loop.modify(sock, self._get_event(sock))
+        self._executor.submit(
+            func, data,
+            lambda result, error: self._on_offloaded(stream, buf, result,
+                                                     error))
+        return True
+
+    def _on_offloaded(self, stream, buf, data, error):
+        # called in the loop thread, data refers to buf as before
+        self._crypting[stream] = False
+        if self._stage == STAGE_DESTROYED or error is not None:
+            if buf is not None:
+                self._buffer_pool.put(buf)
+            if error is not None:
+                self._log_error(error)
+                self.destroy()
+            return
+        if stream == STREAM_UP:
+            sock, read_sock = self._remote_sock, self._local_sock
+        else:
+            sock, read_sock = self._local_sock, self._remote_sock
+        self._write_to_sock(data, sock, buf)
+        if self._stage != STAGE_DESTROYED:
+            # read the stream again, and in edge-triggered mode, re-arm it
+            # in case it became readable while we were waiting
+            self._loop.modify(read_sock, self._get_event(read_sock))
+
     def _on_local_read(self):
         # handle all local read events and dispatch them to methods for
         # each stage
-        if not self._local_sock:
-            return
+        # returns True if there may be more data to read
+        if not self._local_sock or self._crypting[STREAM_UP]:
+            return False
         is_local = self._is_local
         data = None
+        buf = None
         try:
-            data = self._local_sock.recv(BUF_SIZE)
+            data, buf = self._recv(self._local_sock)
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
-                return
-        if not data:
-            self.destroy()
-            return
-        self._update_activity(len(data))
-        if not is_local:
-            data = self._encryptor.decrypt(data)
+                return False
+        try:
             if not data:
-                return
-        if self._stage == STAGE_STREAM:
-            if self._is_local:
-                data = self._encryptor.encrypt(data)
-            self._write_to_sock(data, self._remote_sock)
-            return
-        elif is_local and self._stage == STAGE_INIT:
-            # TODO check auth method
-            self._write_to_sock(b'\x05\00', self._local_sock)
-            self._stage = STAGE_ADDR
-            return
-        elif self._stage == STAGE_CONNECTING:
-            self._handle_stage_connecting(data)
-        elif (is_local and self._stage == STAGE_ADDR) or \
-                (not is_local and self._stage == STAGE_INIT):
-            self._handle_stage_addr(data)
+                self.destroy()
+                return False
+            # a short read means the socket buffer is drained
+            more = len(data) == BUF_SIZE
+            self._update_activity(len(data))
+            if self._stage == STAGE_STREAM and \
+                    self._offload(STREAM_UP, data, buf):
+                buf = None
+                return False
+            if not is_local:
+                try:
+                    data = self._decrypt(data)
+                except AeadDecryptError as e:
+                    self._log_error(e)
+                    self.destroy()
+                    return False
+                if not data:
+                    return more
+            if self._stage == STAGE_STREAM:
+                if self._is_local:
+                    data = self._encrypt(data)
+                self._write_to_sock(data, self._remote_sock, buf)
+                buf = None
+                return more and self._stage != STAGE_DESTROYED and \
+                    self._upstream_status & WAIT_STATUS_READING != 0
+            if buf is not None and type(data) == memoryview:
+                # the other stages keep the data, so don't let it refer to
+                # the pooled buffer
+                data = data.tobytes()
+            if is_local and self._stage in (STAGE_INIT, STAGE_ADDR):
+                self._handle_socks5(data)
+            elif self._stage == STAGE_CONNECTING:
+                self._handle_stage_connecting(data)
+            elif not is_local and self._stage == STAGE_INIT:
+                self._handle_stage_addr(data)
+            return more and self._stage != STAGE_DESTROYED and \
+                self._upstream_status & WAIT_STATUS_READING != 0
+        finally:
+            if buf is not None:
+                self._buffer_pool.put(buf)
 
     def _on_remote_read(self):
         # handle all remote read events
+        # returns True if there may be more data to read
+        if self._crypting[STREAM_DOWN]:
+            return False
         data = None
+        buf = None
         try:
-            data = self._remote_sock.recv(BUF_SIZE)
+            data, buf = self._recv(self._remote_sock)
 
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
-                return
-        if not data:
-            self.destroy()
-            return
-        self._update_activity(len(data))
-        if self._is_local:
-            data = self._encryptor.decrypt(data)
-        else:
-            data = self._encryptor.encrypt(data)
+                return False
         try:
-            self._write_to_sock(data, self._local_sock)
-        except Exception as e:
-            shell.print_exception(e)
-            if self._config['verbose']:
-                traceback.print_exc()
-            # TODO use logging when debug completed
-            self.destroy()
+            if not data:
+                # reset or closed by the server before it was writable
+                self.report_failure()
+                self.destroy()
+                return False
+            more = len(data) == BUF_SIZE
+            self._update_activity(len(data))
+            if self._offload(STREAM_DOWN, data, buf):
+                buf = None
+                return False
+            if self._is_local:
+                try:
+                    data = self._decrypt(data)
+                except AeadDecryptError as e:
+                    self._log_error(e)
+                    self.destroy()
+                    return False
+            else:
+                data = self._encrypt(data)
+            try:
+                self._write_to_sock(data, self._local_sock, buf)
+                buf = None
+            except Exception as e:
+                shell.print_exception(e)
+                if self._config['verbose']:
+                    traceback.print_exc()
+                # TODO use logging when debug completed
+                self.destroy()
+                return False
+            return more and self._stage != STAGE_DESTROYED and \
+                self._downstream_status & WAIT_STATUS_READING != 0
+        finally:
+            if buf is not None:
+                self._buffer_pool.put(buf)
 
     def _on_local_write(self):
         # handle local writable event
         if self._data_to_write_to_local:
-            data = b''.join(self._data_to_write_to_local)
-            self._data_to_write_to_local = []
-            self._write_to_sock(data, self._local_sock)
+            self._flush_to_sock(self._data_to_write_to_local,
+                                self._local_sock)
         else:
             self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
 
     def _on_remote_write(self):
         # handle remote writable event
         self._stage = STAGE_STREAM
+        if self._connect_start is not None:
+            self._server.balancer.report_success(
+                self._chosen_server,
+                eventloop.monotonic() - self._connect_start)
+            self._connect_start = None
         if self._data_to_write_to_remote:
-            data = b''.join(self._data_to_write_to_remote)
-            self._data_to_write_to_remote = []
-            self._write_to_sock(data, self._remote_sock)
+            self._flush_to_sock(self._data_to_write_to_remote,
+                                self._remote_sock)
         else:
             self._update_stream(STREAM_UP, WAIT_STATUS_READING)
 
@@ -515,6 +930,7 @@ class TCPRelayHandler(object):
         logging.debug('got remote error')
         if self._remote_sock:
             logging.error(eventloop.get_sock_error(self._remote_sock))
+        self.report_failure()
         self.destroy()
 
     # 事件分发器
@@ -547,7 +963,7 @@ class TCPRelayHandler(object):
                     return
             # POLL_HUP 已经断开，可能还有数据可读 POLL_IN 有数据可读
             if event & (eventloop.POLL_IN | eventloop.POLL_HUP):
-                self._on_remote_read()
+                self._drain(self._remote_sock, self._on_remote_read)
                 if self._stage == STAGE_DESTROYED:
                     return
             if event & eventloop.POLL_OUT:
@@ -558,11 +974,13 @@ class TCPRelayHandler(object):
                 if self._stage == STAGE_DESTROYED:
                     return
             if event & (eventloop.POLL_IN | eventloop.POLL_HUP):
-                self._on_local_read()
+                self._drain(self._local_sock, self._on_local_read)
                 if self._stage == STAGE_DESTROYED:
                     return
             if event & eventloop.POLL_OUT:
                 self._on_local_write()
+        elif sock.fileno() in self._attempts:
+            self._on_attempt_event(sock, event)
         else:
             logging.warn('unknown socket')
 
@@ -570,6 +988,14 @@ class TCPRelayHandler(object):
         logging.error('%s when handling connection from %s:%d' %
                       (e, self._client_address[0], self._client_address[1]))
 
+    def report_failure(self):
+        # sslocal, the chosen server didn't resolve, refused, reset or timed
+        # out while we were connecting to it, only call it for these, not
+        # when the client gives up, or healthy servers would be ejected
+        if self._is_local and self._connect_start is not None:
+            self._connect_start = None
+            self._server.balancer.report_failure(self._chosen_server)
+
     def destroy(self):
         # destroy the handler and release any resources
         # promises:
@@ -583,11 +1009,14 @@ class TCPRelayHandler(object):
             logging.debug('already destroyed')
             return
         self._stage = STAGE_DESTROYED
+        if self._is_local:
+            self._server.balancer.release(self._chosen_server)
         if self._remote_address:
             logging.debug('destroy: %s:%d' %
                           self._remote_address)
         else:
             logging.debug('destroy')
+        self._close_attempts()
         if self._remote_sock:
             logging.debug('destroying remote')
             self._loop.remove(self._remote_sock)
@@ -600,6 +1029,8 @@ class TCPRelayHandler(object):
             del self._fd_to_handlers[self._local_sock.fileno()]
             self._local_sock.close()
             self._local_sock = None
+        self._data_to_write_to_local.clear()
+        self._data_to_write_to_remote.clear()
         self._dns_resolver.remove_callback(self._handle_dns_resolved)
         self._server.remove_handler(self)
 
@@ -610,20 +1041,41 @@ class TCPRelay(object):
     server.py 调用，默认没有 stat_callback
     tcprelay.TCPRelay(a_config, dns_resolver, False)
     """
-    def __init__(self, config, dns_resolver, is_local, stat_callback=None):
+    def __init__(self, config, dns_resolver, is_local, stat_callback=None,
+                 server_balancer=None):
         self._config = config
         self._is_local = is_local
         self._dns_resolver = dns_resolver
+        # sslocal, chooses a server for each connection, it can be shared
+        # with the UDPRelay
+        self._balancer = None
+        if is_local:
+            self._balancer = server_balancer or \
+                balancer.Balancer.from_config(config)
         self._closed = False
         self._eventloop = None
         self._fd_to_handlers = {}
+        self._edge_triggered = False
+        self._executor = None
+        # (server, server_port): ConnectionPool, sslocal only
+        self._connection_pools = {}
+        # ssserver, (ip, port): how many times in a row the destination
+        # didn't take the data in the SYN
+        self._remote_fast_open = not is_local and \
+            config.get('remote_fast_open', False)
+        self._fast_open_misses = \
+            lru_cache.LRUCache(timeout=FAST_OPEN_CACHE_TIMEOUT,
+                               max_entries=FAST_OPEN_CACHE_SIZE)
+        # all the write queues of the handlers share the same budget
+        self._memory_budget = \
+            buffers.MemoryBudget(config.get('memory_budget', 0))
+        # the key and the method are the same for all the handlers
+        self._cipher_profile = encrypt.CipherProfile(config['password'],
+                                                     config['method'])
         # 配置文件中设置的超时时间
         self._timeout = config['timeout']
-        self._timeouts = []  # a list for all the handlers
-        # we trim the timeouts once a while
-        self._timeout_offset = 0   # last checked position for timeout
-        # { handler: pos }
-        self._handler_to_timeouts = {}  # key: handler value: index in timeouts
+        # { handler: timer }
+        self._handler_to_timeouts = {}  # key: handler value: timer in loop
 
         # 用于客户端和服务端复用
         if is_local:
@@ -655,8 +1107,13 @@ class TCPRelay(object):
         # 告诉内核允许复用处于 TIME_WAIT 状态的本地 socket
         # http://www.gnu.org/software/libc/manual/html_node/Socket_002dLevel-Options.html
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if config.get('reuse_port', False):
+            common.set_reuse_port(server_socket)
         server_socket.bind(sa)
         server_socket.setblocking(False)
+        if NODELAY_INHERITED:
+            # for the accepted sockets
+            server_socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
         if config['fast_open']:
             try:
                 """
@@ -695,15 +1152,89 @@ class TCPRelay(object):
         if self._closed:
             raise Exception('already closed')
         self._eventloop = loop
+        if self._config.get('edge_triggered', False):
+            if loop.support_edge_triggered:
+                self._edge_triggered = True
+            else:
+                logging.warn('edge-triggered mode is only available with '
+                             'epoll, using level-triggered mode')
+        if self._config.get('crypto_threads', 0) > 0:
+            self._executor = loop.executor(self._config['crypto_threads'])
+        if self._is_local and self._config.get('prewarm', 0) > 0:
+            self._add_connection_pools()
         # 加入到事件队列中
         self._eventloop.add(self._server_socket,
                             eventloop.POLL_IN | eventloop.POLL_ERR, self)
         self._eventloop.add_periodic(self.handle_periodic)
 
+    def _add_connection_pools(self):
+        # a pool for each server and port we may choose
+        if self._config['fast_open']:
+            # the data is sent with the SYN, there is no round trip to save
+            logging.warn('prewarm is not used with fast open')
+            return
+        servers = self._config['server']
+        if type(servers) != list:
+            servers = [servers]
+        ports = self._config['server_port']
+        if type(ports) != list:
+            ports = [ports]
+        for server in servers:
+            for port in ports:
+                self._connection_pools[(server, port)] = \
+                    connpool.ConnectionPool(self._eventloop,
+                                            self._dns_resolver, server, port,
+                                            self._config['prewarm'])
+
+    def take_connection(self, server):
+        # a connected socket to server, or None
+        pool = self._connection_pools.get(server, None)
+        if pool is None:
+            return None
+        return pool.take()
+
+    def remote_fast_open(self, address):
+        # whether to send the data in the SYN to address
+        return self._remote_fast_open and \
+            self._fast_open_misses.get(address, 0) < FAST_OPEN_MAX_MISSES
+
+    def report_fast_open(self, address, acked):
+        if acked:
+            if address in self._fast_open_misses:
+                del self._fast_open_misses[address]
+        else:
+            self._fast_open_misses[address] = \
+                self._fast_open_misses.get(address, 0) + 1
+
+    def disable_remote_fast_open(self):
+        if self._remote_fast_open:
+            logging.error('fast open to destinations is not supported on '
+                          'this OS')
+            self._remote_fast_open = False
+
+    @property
+    def balancer(self):
+        return self._balancer
+
+    @property
+    def edge_triggered(self):
+        return self._edge_triggered
+
+    @property
+    def memory_budget(self):
+        return self._memory_budget
+
+    @property
+    def executor(self):
+        return self._executor
+
+    @property
+    def cipher_profile(self):
+        return self._cipher_profile
+
     def remove_handler(self, handler):
-        index = self._handler_to_timeouts.get(hash(handler), -1)
-        if index >= 0:
-            # delete is O(n), so we just set it to None
+        timer = self._handler_to_timeouts.pop(hash(handler), None)
+        if timer:
             """
             Python 的时间复杂度
             对字典的删除操作的平均时间复杂度为 O(1)，这是在散列无冲突的情况下估算的
@@ -712,8 +1243,7 @@ class TCPRelay(object):
             此处用到了 Python 内置的 hash 函数，其实是调用了实例中的 __hash__ 方法
             此处由于 TCPRelayHandler 为新式类，本身就具有 __hash__ 方法，否则当对象为旧式类
             """
-            self._timeouts[index] = None
-            del self._handler_to_timeouts[hash(handler)]
+            self._eventloop.cancel(timer)
 
     # 此处 handler 为 TCPRelayHandler 实例
     def update_activity(self, handler, data_len):
@@ -722,67 +1252,31 @@ class TCPRelay(object):
             self._stat_callback(self._listen_port, data_len)
 
         # set handler to active
-        now = int(time.time())
-        # 每隔 TIMEOUT_PRECISION 秒，默认 10 秒，监测一次 timeout，此处距离上次更新太近，所以直接返回
-        if now - handler.last_activity < eventloop.TIMEOUT_PRECISION:
-            # thus we can lower timeout modification frequency
+        # we don't move the timer here, _sweep_timeout() will check
+        # last_activity and reschedule it when it fires
+        handler.last_activity = eventloop.monotonic()
+        if hash(handler) not in self._handler_to_timeouts:
+            self._handler_to_timeouts[hash(handler)] = \
+                self._eventloop.call_later(self._timeout,
+                                           self._sweep_timeout, handler)
+
+    def _sweep_timeout(self, handler):
+        # called by the event loop when handler may have timed out
+        # so the work is O(expired) instead of scanning all the handlers
+        del self._handler_to_timeouts[hash(handler)]
+        idle = eventloop.monotonic() - handler.last_activity
+        if idle < self._timeout:
+            # it has been active since the timer was set, check again later
+            self._handler_to_timeouts[hash(handler)] = \
+                self._eventloop.call_later(self._timeout - idle,
+                                           self._sweep_timeout, handler)
             return
-        # 更新 last_activity 字段
-        handler.last_activity = now
-        index = self._handler_to_timeouts.get(hash(handler), -1)
-        if index >= 0:
-            # delete is O(n), so we just set it to None
-            self._timeouts[index] = None
-        length = len(self._timeouts)
-        # 添加该 handler 到 _timeouts 列表中
-        self._timeouts.append(handler)
-        # 将 _timeouts 长度存入 hash(handler) 的键中
-        self._handler_to_timeouts[hash(handler)] = length
-
-    def _sweep_timeout(self):
-        # tornado's timeout memory management is more flexible than we need
-        # we just need a sorted last_activity queue and it's faster than heapq
-        # in fact we can do O(1) insertion/remove so we invent our own
-        # _timeouts 其实是一个列表，保存了很多 handler，指向 TCPRelayHandler 实例
-        # 只有 _timeouts 非空的时候才进行操作
-        if self._timeouts:
-            logging.log(shell.VERBOSE_LEVEL, 'sweeping timeouts')
-            now = time.time()
-            length = len(self._timeouts)
-            # _timeout_offset 初始值为 0，记录上次检测到的位置
-            pos = self._timeout_offset
-            # 从上次更新到的位置开始循环
-            while pos < length:
-                handler = self._timeouts[pos]
-                # 取出 handler，如果空则跳过
-                if handler:
-                    # 如果没有超时，退出该循环，否则删除 TCPRelayHandler 实例，并在 _timeouts 列表中标记为空
-                    if now - handler.last_activity < self._timeout:
-                        break
-                    else:
-                        if handler.remote_address:
-                            logging.warn('timed out: %s:%d' %
-                                         handler.remote_address)
-                        else:
-                            logging.warn('timed out')
-                        handler.destroy()
-                        self._timeouts[pos] = None  # free memory
-                        pos += 1
-                else:
-                    pos += 1
-            # 每次最多删除 TIMEOUTS_CLEAN_SIZE 个超时的 TCPRelayHandler 实例
-            # 或者 当前 pos 大于 _timeouts 的长度的一半
-            # length >> 1 位操作符 等效于 length/2
-            if pos > TIMEOUTS_CLEAN_SIZE and pos > length >> 1:
-                # clean up the timeout queue when it gets larger than half
-                # of the queue
-                # 相当于删除已经检测过的 handlers
-                self._timeouts = self._timeouts[pos:]
-                # 将 _handler_to_timeouts 中每一项都减去 pos, 然后设置 pos 为 0
-                for key in self._handler_to_timeouts:
-                    self._handler_to_timeouts[key] -= pos
-                pos = 0
-            self._timeout_offset = pos
+        if handler.remote_address:
+            logging.warn('timed out: %s:%d' % handler.remote_address)
+        else:
+            logging.warn('timed out')
+        handler.report_failure()
+        handler.destroy()
 
     def handle_event(self, sock, fd, event):
         # handle events and dispatch to handlers
@@ -794,32 +1288,44 @@ class TCPRelay(object):
             if event & eventloop.POLL_ERR:
                 # TODO
                 raise Exception('server_socket error')
+            self._accept()
+        else:
+            if sock:
+                handler = self._fd_to_handlers.get(fd, None)
+                if handler:
+                    handler.handle_event(sock, event)
+            else:
+                logging.warn('poll removed fd')
+
+    def _accept(self):
+        # accept until there is nothing left, or ACCEPT_BUDGET is used up,
+        # so that a burst of connections doesn't wait for a poll each
+        for i in range(0, ACCEPT_BUDGET):
             try:
                 logging.debug('accept')
                 # 建立新连接
-                conn = self._server_socket.accept()
+                conn, addr = self._server_socket.accept()
                 # 交给 TCP 转发类
                 TCPRelayHandler(self, self._fd_to_handlers,
-                                self._eventloop, conn[0], self._config,
-                                self._dns_resolver, self._is_local)
+                                self._eventloop, conn, self._config,
+                                self._dns_resolver, self._is_local, addr)
             except (OSError, IOError) as e:
                 error_no = eventloop.errno_from_exception(e)
                 if error_no in (errno.EAGAIN, errno.EINPROGRESS,
                                 errno.EWOULDBLOCK):
                     return
+                elif error_no == errno.ECONNABORTED:
+                    # the client has given up, try the next one
+                    continue
                 else:
+                    # like EMFILE, trying again now won't help
                     shell.print_exception(e)
                     if self._config['verbose']:
                         traceback.print_exc()
-        else:
-            if sock:
-                handler = self._fd_to_handlers.get(fd, None)
-                if handler:
-                    handler.handle_event(sock, event)
-            else:
-                logging.warn('poll removed fd')
+                    return
 
     def handle_periodic(self):
+        self._fast_open_misses.sweep()
         if self._closed:
             # 关闭 socket，删除事件队列中对应事件
             if self._server_socket:
@@ -830,12 +1336,13 @@ class TCPRelay(object):
             if not self._fd_to_handlers:
                 logging.info('stopping')
                 self._eventloop.stop()
-        # 定时检测一下 timeouts
-        self._sweep_timeout()
 
     def close(self, next_tick=False):
         logging.debug('TCP close')
         self._closed = True
+        for pool in self._connection_pools.values():
+            pool.close()
+        self._connection_pools = {}
         if not next_tick:
             if self._eventloop:
                 self._eventloop.remove_periodic(self.handle_periodic)
@@ -843,3 +1350,137 @@ class TCPRelay(object):
             self._server_socket.close()
             for handler in list(self._fd_to_handlers.values()):
                 handler.destroy()
+
+
+def test_syn_data_acked():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    conn = listener.accept()[0]
+    # no data in the SYN, or we can't tell
+    assert syn_data_acked(client) == (TCP_INFO is None)
+    # not a TCP socket, we can't tell
+    a, b = socket.socketpair()
+    assert syn_data_acked(a)
+    for sock in (listener, client, conn, a, b):
+        sock.close()
+
+
+def test_remote_fast_open():
+    config = {
+        'server': '127.0.0.1',
+        'server_port': 0,
+        'password': b'test',
+        'method': 'aes-256-cfb',
+        'timeout': 60,
+        'fast_open': False,
+        'remote_fast_open': True,
+    }
+    relay = TCPRelay(config, None, False)
+    a = ('1.1.1.1', 80)
+    b = ('2.2.2.2', 80)
+    assert relay.remote_fast_open(a)
+    for i in range(0, FAST_OPEN_MAX_MISSES - 1):
+        relay.report_fast_open(a, False)
+    assert relay.remote_fast_open(a)
+    # it took the data once, the misses start over
+    relay.report_fast_open(a, True)
+    for i in range(0, FAST_OPEN_MAX_MISSES - 1):
+        relay.report_fast_open(a, False)
+    assert relay.remote_fast_open(a)
+    relay.report_fast_open(a, False)
+    assert not relay.remote_fast_open(a)
+    assert relay.remote_fast_open(b)
+    # the misses are forgotten after FAST_OPEN_CACHE_TIMEOUT
+    relay._fast_open_misses.timeout = 0
+    relay._fast_open_misses.sweep()
+    assert relay.remote_fast_open(a)
+    # the OS doesn't support it
+    relay.disable_remote_fast_open()
+    assert not relay.remote_fast_open(b)
+    relay.close()
+
+    # sslocal never uses it
+    config['local_address'] = '127.0.0.1'
+    config['local_port'] = 0
+    config['server_port'] = 8388
+    relay = TCPRelay(config, None, True)
+    assert not relay.remote_fast_open(a)
+    relay.close()
+
+
+class _Resolver(object):
+    # answers only when the test tells it to
+    def __init__(self):
+        self.callbacks = []
+
+    def resolve(self, hostname, callback):
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+
+def test_report_failure():
+    config = {
+        'server': 'ss.test',
+        'server_port': 8388,
+        'local_address': '127.0.0.1',
+        'local_port': 0,
+        'password': b'test',
+        'method': 'table',
+        'timeout': 60,
+        'fast_open': False,
+        'verbose': 0,
+    }
+    resolver = _Resolver()
+    loop = eventloop.EventLoop()
+    relay = TCPRelay(config, resolver, True)
+    relay.add_to_loop(loop)
+    stat = relay.balancer.stat(('ss.test', 8388))
+    port = relay._server_socket.getsockname()[1]
+    clients = []
+
+    def connect():
+        client = socket.create_connection(('127.0.0.1', port))
+        client.sendall(b'\x05\x01\x00\x05\x01\x00\x01\x7f\x00\x00\x01'
+                       b'\x00\x50')
+        clients.append(client)
+
+    def client_gives_up():
+        # still resolving the server
+        assert len(resolver.callbacks) == 1
+        clients[0].close()
+
+    def retry():
+        # the client gave up, it's not the fault of the server
+        assert not resolver.callbacks
+        assert stat.failures == 0 and stat.in_flight == 0
+        connect()
+
+    def dns_fails():
+        assert len(resolver.callbacks) == 1
+        resolver.callbacks.pop()(None, Exception('no such host'))
+
+    def check():
+        assert stat.failures == 1 and stat.in_flight == 0
+        loop.stop()
+
+    connect()
+    loop.call_later(0.1, client_gives_up)
+    loop.call_later(0.2, retry)
+    loop.call_later(0.3, dns_fails)
+    loop.call_later(0.4, check)
+    loop.run()
+    assert stat.failures == 1
+    relay.close()
+    for client in clients:
+        client.close()
+
+
+if __name__ == '__main__':
+    test_syn_data_acked()
+    test_remote_fast_open()
+    test_report_failure()
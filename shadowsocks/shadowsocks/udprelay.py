@@ -66,14 +66,34 @@ import socket
 import logging
 import struct
 import errno
-import random
+import traceback
+import collections
 
-from shadowsocks import encrypt, eventloop, lru_cache, common, shell
+from shadowsocks import encrypt, eventloop, lru_cache, common, shell, mmsg, \
+    balancer
 from shadowsocks.common import parse_header, pack_addr
+from shadowsocks.crypto.aead import AeadDecryptError
 
 
 BUF_SIZE = 65536
 
+# while resolving a destination, keep at most DNS_PENDING_SIZE datagrams to
+# it, when the queue is full the oldest one is dropped, since newer datagrams
+# are more useful for realtime traffic such as games and VoIP
+DNS_PENDING_SIZE = 32
+
+# resolve at most DNS_PENDING_HOSTS destinations at the same time, datagrams
+# to other unresolved destinations are dropped
+DNS_PENDING_HOSTS = 256
+
+# on Linux, receive at most UDP_BATCH_SIZE datagrams with one recvmmsg(), and
+# send the replies with one sendmmsg()
+UDP_BATCH_SIZE = 32
+
+# keep at most UDP_CACHE_SIZE client sockets, each one holds a file
+# descriptor, the least recently used one is closed when there are more
+UDP_CACHE_SIZE = 4096
+
 
 def client_key(source_addr, server_af):
     # notice this is server af, not dest af
@@ -81,13 +101,18 @@ def client_key(source_addr, server_af):
 
 
 class UDPRelay(object):
-    def __init__(self, config, dns_resolver, is_local, stat_callback=None):
+    def __init__(self, config, dns_resolver, is_local, stat_callback=None,
+                 server_balancer=None):
         self._config = config
+        self._balancer = None
         if is_local:
             self._listen_addr = config['local_address']
             self._listen_port = config['local_port']
             self._remote_addr = config['server']
             self._remote_port = config['server_port']
+            # shared with the TCPRelay, which tells it the failing servers
+            self._balancer = server_balancer or \
+                balancer.Balancer.from_config(config)
         else:
             self._listen_addr = config['server']
             self._listen_port = config['server_port']
@@ -96,14 +121,24 @@ class UDPRelay(object):
         self._dns_resolver = dns_resolver
         self._password = common.to_bytes(config['password'])
         self._method = config['method']
+        self._engine = encrypt.CipherEngine(self._password, self._method)
         self._timeout = config['timeout']
         self._is_local = is_local
         self._cache = lru_cache.LRUCache(timeout=config['timeout'],
-                                         close_callback=self._close_client)
+                                         close_callback=self._close_client,
+                                         max_entries=UDP_CACHE_SIZE)
         self._client_fd_to_server_addr = \
-            lru_cache.LRUCache(timeout=config['timeout'])
-        self._dns_cache = lru_cache.LRUCache(timeout=300)
+            lru_cache.LRUCache(timeout=config['timeout'],
+                               max_entries=UDP_CACHE_SIZE)
+        # server_addr: (callback, datagrams waiting for the DNS result)
+        self._dns_pending = {}
+        if mmsg.HAS_MMSG:
+            self._receiver = mmsg.get_receiver(UDP_BATCH_SIZE, BUF_SIZE)
+        else:
+            self._receiver = None
         self._eventloop = None
+        # sweeps the cache when its least recently used client expires
+        self._sweep_timer = None
         self._closed = False
         self._sockets = set()
         if 'forbidden_ip' in config:
@@ -118,35 +153,57 @@ class UDPRelay(object):
                             (self._listen_addr, self._listen_port))
         af, socktype, proto, canonname, sa = addrs[0]
         server_socket = socket.socket(af, socktype, proto)
+        if config.get('reuse_port', False):
+            common.set_reuse_port(server_socket)
         server_socket.bind((self._listen_addr, self._listen_port))
         server_socket.setblocking(False)
         self._server_socket = server_socket
         self._stat_callback = stat_callback
 
     def _get_a_server(self):
-        server = self._config['server']
-        server_port = self._config['server_port']
-        if type(server_port) == list:
-            server_port = random.choice(server_port)
-        if type(server) == list:
-            server = random.choice(server)
+        server, server_port = self._balancer.choose()
         logging.debug('chosen server: %s:%d', server, server_port)
         return server, server_port
 
     def _close_client(self, client):
         if hasattr(client, 'close'):
-            self._sockets.remove(client.fileno())
+            fd = client.fileno()
+            self._sockets.remove(fd)
+            if fd in self._client_fd_to_server_addr:
+                del self._client_fd_to_server_addr[fd]
             self._eventloop.remove(client)
             client.close()
         else:
             # just an address
             pass
 
+    def _seal(self, data):
+        return self._engine.seal(encrypt.random_string(self._engine.iv_len),
+                                 data)
+
+    def _recv_batch(self, sock):
+        if self._receiver is not None:
+            return self._receiver.recv(sock)
+        return [sock.recvfrom(BUF_SIZE)]
+
+    def _log_datagram_error(self, e):
+        shell.print_exception(e)
+        if self._config['verbose']:
+            traceback.print_exc()
+
     def _handle_server(self):
-        server = self._server_socket
-        data, r_addr = server.recvfrom(BUF_SIZE)
+        # the batch has been taken off the socket, so a bad datagram must
+        # not drop the rest of it
+        for data, r_addr in self._recv_batch(self._server_socket):
+            try:
+                self._handle_server_data(data, r_addr)
+            except Exception as e:
+                self._log_datagram_error(e)
+
+    def _handle_server_data(self, data, r_addr):
         if not data:
             logging.debug('UDP handle_server: data is empty')
+            return
         if self._stat_callback:
             self._stat_callback(self._listen_port, len(data))
         if self._is_local:
@@ -157,7 +214,11 @@ class UDPRelay(object):
             else:
                 data = data[3:]
         else:
-            data = encrypt.encrypt_all(self._password, self._method, 0, data)
+            try:
+                data = self._engine.open(data)
+            except AeadDecryptError as e:
+                logging.debug('UDP handle_server: %s', e)
+                return
             # decrypt data
             if not data:
                 logging.debug('UDP handle_server: data is empty after decrypt')
@@ -172,37 +233,75 @@ class UDPRelay(object):
         else:
             server_addr, server_port = dest_addr, dest_port
 
-        addrs = self._dns_cache.get(server_addr, None)
-        if addrs is None:
-            addrs = socket.getaddrinfo(server_addr, server_port, 0,
-                                       socket.SOCK_DGRAM, socket.SOL_UDP)
-            if not addrs:
-                # drop
-                return
-            else:
-                self._dns_cache[server_addr] = addrs
+        if common.is_ip(server_addr):
+            self._send_to_server(r_addr, data, header_length, server_addr,
+                                 server_port)
+            return
+        pending = self._dns_pending.get(server_addr, None)
+        if pending is not None:
+            # the query is still pending, wait for it together
+            callback, queue = pending
+            if len(queue) == DNS_PENDING_SIZE:
+                logging.debug('UDP drop a message to %s while resolving',
+                              common.to_str(server_addr))
+            queue.append((r_addr, data, header_length, server_port))
+            return
+        if len(self._dns_pending) >= DNS_PENDING_HOSTS:
+            logging.debug('UDP drop a message to %s, too many pending '
+                          'DNS queries', common.to_str(server_addr))
+            return
 
-        af, socktype, proto, canonname, sa = addrs[0]
+        # one callback for each hostname, so that we can remove them from
+        # the resolver separately
+        def callback(result, error):
+            self._handle_dns_resolved(server_addr, result, error)
+        queue = collections.deque([(r_addr, data, header_length, server_port)],
+                                  DNS_PENDING_SIZE)
+        self._dns_pending[server_addr] = (callback, queue)
+        # the resolver caches hostnames and expires them, so a cached one
+        # goes into _handle_dns_resolved directly
+        self._dns_resolver.resolve(server_addr, callback)
+
+    def _handle_dns_resolved(self, server_addr, result, error):
+        pending = self._dns_pending.pop(server_addr, None)
+        if pending is None:
+            return
+        ip = None
+        if result:
+            ip = result[1]
+        if error or not ip:
+            logging.debug('UDP drop %d messages to %s: %s', len(pending[1]),
+                          common.to_str(server_addr), error)
+            return
+        for r_addr, data, header_length, server_port in pending[1]:
+            self._send_to_server(r_addr, data, header_length, ip,
+                                 server_port)
+
+    def _send_to_server(self, r_addr, data, header_length, ip, server_port):
+        af = common.is_ip(ip)
+        if not af:
+            return
         key = client_key(r_addr, af)
         client = self._cache.get(key, None)
         if not client:
-            # TODO async getaddrinfo
             if self._forbidden_iplist:
-                if common.to_str(sa[0]) in self._forbidden_iplist:
+                if common.to_str(ip) in self._forbidden_iplist:
                     logging.debug('IP %s is in forbidden list, drop' %
-                                  common.to_str(sa[0]))
+                                  common.to_str(ip))
                     # drop
                     return
-            client = socket.socket(af, socktype, proto)
+            client = socket.socket(af, socket.SOCK_DGRAM, socket.SOL_UDP)
             client.setblocking(False)
             self._cache[key] = client
             self._client_fd_to_server_addr[client.fileno()] = r_addr
+            if self._sweep_timer is None:
+                self._schedule_sweep()
 
             self._sockets.add(client.fileno())
             self._eventloop.add(client, eventloop.POLL_IN, self)
 
         if self._is_local:
-            data = encrypt.encrypt_all(self._password, self._method, 1, data)
+            data = self._seal(data)
             if not data:
                 return
         else:
@@ -210,7 +309,7 @@ class UDPRelay(object):
         if not data:
             return
         try:
-            client.sendto(data, (server_addr, server_port))
+            client.sendto(data, (common.to_str(ip), server_port))
         except IOError as e:
             err = eventloop.errno_from_exception(e)
             if err in (errno.EINPROGRESS, errno.EAGAIN):
@@ -219,39 +318,51 @@ class UDPRelay(object):
                 shell.print_exception(e)
 
     def _handle_client(self, sock):
-        data, r_addr = sock.recvfrom(BUF_SIZE)
+        client_addr = self._client_fd_to_server_addr.get(sock.fileno())
+        responses = []
+        for data, r_addr in self._recv_batch(sock):
+            try:
+                response = self._handle_client_data(data, r_addr)
+            except Exception as e:
+                self._log_datagram_error(e)
+                continue
+            if response and client_addr:
+                responses.append((response, client_addr))
+        # if client_addr is unknown, this packet is from somewhere else we
+        # know, simply drop that packet
+        if self._receiver is not None:
+            mmsg.send_batch(self._server_socket, responses)
+        else:
+            for response, client_addr in responses:
+                self._server_socket.sendto(response, client_addr)
+
+    def _handle_client_data(self, data, r_addr):
+        # returns the response to the client
         if not data:
             logging.debug('UDP handle_client: data is empty')
-            return
+            return None
         if self._stat_callback:
             self._stat_callback(self._listen_port, len(data))
         if not self._is_local:
             addrlen = len(r_addr[0])
             if addrlen > 255:
                 # drop
-                return
+                return None
             data = pack_addr(r_addr[0]) + struct.pack('>H', r_addr[1]) + data
-            response = encrypt.encrypt_all(self._password, self._method, 1,
-                                           data)
-            if not response:
-                return
+            return self._seal(data)
         else:
-            data = encrypt.encrypt_all(self._password, self._method, 0,
-                                       data)
+            try:
+                data = self._engine.open(data)
+            except AeadDecryptError as e:
+                logging.debug('UDP handle_client: %s', e)
+                return None
             if not data:
-                return
+                return None
             header_result = parse_header(data)
             if header_result is None:
-                return
+                return None
             # addrtype, dest_addr, dest_port, header_length = header_result
-            response = b'\x00\x00\x00' + data
-        client_addr = self._client_fd_to_server_addr.get(sock.fileno())
-        if client_addr:
-            self._server_socket.sendto(response, client_addr)
-        else:
-            # this packet is from somewhere else we know
-            # simply drop that packet
-            pass
+            return b'\x00\x00\x00' + data
 
     def add_to_loop(self, loop):
         if self._eventloop:
@@ -283,12 +394,30 @@ class UDPRelay(object):
                 for sock in self._sockets:
                     sock.close()
                 logging.info('closed UDP port %d', self._listen_port)
+
+    def _schedule_sweep(self):
+        # a new client expires after the ones in the cache, and a visit
+        # only moves the deadline later, so the timer never fires late,
+        # if it fires early it just sweeps nothing and moves on
+        expiry = self._cache.next_expiry()
+        if expiry is None:
+            self._sweep_timer = None
+            return
+        delay = max(0, expiry - lru_cache.monotonic())
+        self._sweep_timer = self._eventloop.call_later(delay,
+                                                       self._sweep_cache)
+
+    def _sweep_cache(self):
+        # _close_client() removes the fd mappings of the expired clients
         self._cache.sweep()
-        self._client_fd_to_server_addr.sweep()
+        self._schedule_sweep()
 
     def close(self, next_tick=False):
         logging.debug('UDP close')
         self._closed = True
+        if self._eventloop:
+            self._eventloop.cancel(self._sweep_timer)
+            self._sweep_timer = None
         if not next_tick:
             if self._eventloop:
                 self._eventloop.remove_periodic(self.handle_periodic)
@@ -296,3 +425,56 @@ class UDPRelay(object):
             self._server_socket.close()
             for client in list(self._cache.values()):
                 client.close()
+        for callback, queue in self._dns_pending.values():
+            self._dns_resolver.remove_callback(callback)
+        self._dns_pending.clear()
+
+
+def check_swept(relay, n):
+    assert len(relay._cache) == n
+    assert len(relay._sockets) == n
+    assert len(relay._client_fd_to_server_addr) == n
+
+
+def test_client_cache():
+    config = {
+        'server': '127.0.0.1',
+        'server_port': 0,
+        'password': b'test',
+        'method': 'aes-256-cfb',
+        'timeout': 0.2,
+        'verbose': 0,
+    }
+    loop = eventloop.EventLoop()
+    relay = UDPRelay(config, None, False)
+    relay.add_to_loop(loop)
+    relay._cache.max_entries = 4
+    dest = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dest.bind(('127.0.0.1', 0))
+    port = dest.getsockname()[1]
+    for i in range(0, 6):
+        relay._send_to_server(('127.0.0.1', 10000 + i), b'data', 0,
+                              b'127.0.0.1', port)
+    # the two least recently used clients are closed
+    assert len(relay._cache) == 4
+    assert len(relay._sockets) == 4
+    assert len(relay._client_fd_to_server_addr) == 4
+    assert client_key(('127.0.0.1', 10000), socket.AF_INET) not in \
+        relay._cache
+    # a visit moves the deadline later
+    loop.call_later(0.1, relay._cache.touch,
+                    client_key(('127.0.0.1', 10005), socket.AF_INET))
+    loop.call_later(0.25, check_swept, relay, 1)
+    loop.call_later(0.4, check_swept, relay, 0)
+    loop.call_later(0.4, loop.stop)
+    loop.run()
+    assert relay._sweep_timer is None
+    assert len(relay._cache) == 0
+    assert len(relay._sockets) == 0
+    assert len(relay._client_fd_to_server_addr) == 0
+    relay.close()
+    dest.close()
+
+
+if __name__ == '__main__':
+    test_client_cache()
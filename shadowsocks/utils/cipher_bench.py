@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# measures the throughput of every method at different chunk sizes, see
+# README.md
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import json
+import time
+import getopt
+import platform
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+from shadowsocks import encrypt
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DEFAULT_SIZES = '64,256,1024,4096,16384,65536'
+
+# stream:  Encryptor.encrypt(), what TCP does
+# inplace: Encryptor.encrypt_inplace(), TCP with pooled buffers
+# packet:  CipherEngine.seal(), a new IV for each packet, what UDP does
+PATHS = ('stream', 'inplace', 'packet')
+
+PASSWORD = b'benchmark'
+
+
+def backend_of(method):
+    # the module that implements the method, like openssl or sodium
+    m = encrypt.method_supported[method][2]
+    return m.__module__.split('.')[-1]
+
+
+def make_call(method, path, data):
+    # returns a function that processes data once, or None if the method
+    # doesn't support the path
+    if path == 'packet':
+        engine = encrypt.CipherEngine(PASSWORD, method)
+        iv = os.urandom(engine.iv_len)
+        return lambda: engine.seal(iv, data)
+    encryptor = encrypt.Encryptor(PASSWORD, method)
+    # send the IV first, so we only measure the data
+    encryptor.encrypt(b'\x00')
+    if path == 'stream':
+        return lambda: encryptor.encrypt(data)
+    if not encryptor.inplace:
+        return None
+    view = memoryview(bytearray(data))
+    return lambda: encryptor.encrypt_inplace(view)
+
+
+def peak_bytes(call):
+    # how much memory a call allocates at most, a chunk copied twice shows
+    # up as twice its size, Python has no counter for allocations
+    if tracemalloc is None:
+        return None
+    result = 0
+    for i in range(0, 3):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        call()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result = max(result, peak - before)
+    return result
+
+
+def measure(call, size, duration):
+    call()
+    count = 0
+    batch = 1
+    start = time.time()
+    while True:
+        for i in range(0, batch):
+            call()
+        count += batch
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            break
+        batch *= 2
+    return {
+        'mb_per_s': round(size * count / elapsed / 1000000, 2),
+        'ns_per_call': int(elapsed * 1000000000 / count),
+        'calls': count,
+    }
+
+
+def run(methods, sizes, paths, duration):
+    results = []
+    skipped = {}
+    for method in methods:
+        if method not in encrypt.method_supported:
+            skipped[method] = 'not supported'
+            print('%-24s skipped: not supported' % method, file=sys.stderr)
+            continue
+        try:
+            encrypt.try_cipher(PASSWORD, method)
+        except Exception as e:
+            skipped[method] = str(e)
+            print('%-24s skipped: %s' % (method, e), file=sys.stderr)
+            continue
+        for path in paths:
+            for size in sizes:
+                call = make_call(method, path, os.urandom(size))
+                if call is None:
+                    continue
+                r = measure(call, size, duration)
+                r.update({
+                    'method': method,
+                    'backend': backend_of(method),
+                    'path': path,
+                    'size': size,
+                    'peak_bytes': peak_bytes(call),
+                })
+                results.append(r)
+                print('%-24s %-8s %-8s %6d %10.2f MB/s %10d ns %8s B' %
+                      (method, r['backend'], path, size, r['mb_per_s'],
+                       r['ns_per_call'], r['peak_bytes']))
+                sys.stdout.flush()
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'duration': duration,
+        'results': results,
+        'skipped': skipped,
+    }
+
+
+def compare(report, baseline, threshold):
+    # returns the results that are slower than the baseline by more than
+    # threshold percent
+    old = {}
+    for r in baseline['results']:
+        old[(r['method'], r['path'], r['size'])] = r
+    regressions = []
+    for r in report['results']:
+        b = old.get((r['method'], r['path'], r['size']), None)
+        if b is None or not b['mb_per_s']:
+            continue
+        change = (r['mb_per_s'] - b['mb_per_s']) * 100 / b['mb_per_s']
+        if change < -threshold:
+            regressions.append((r, b, change))
+    return regressions
+
+
+USAGE = '''usage: cipher_bench.py [OPTION]...
+Measures the throughput of the encryption methods, see README.
+
+  -m METHODS             comma separated methods, default: all
+  -s SIZES               comma separated chunk sizes in bytes,
+                         default: %s
+  -p PATHS               comma separated paths, default: all of %s
+  -t SECONDS             seconds for each measurement, default: 0.2
+  -o FILE                write the results to this JSON file
+  -b FILE                compare with the results in this JSON file
+  --threshold PERCENT    percent of throughput we can lose before it
+                         counts as a regression, default: 10
+  -h, --help             show this help message and exit
+''' % (DEFAULT_SIZES, ', '.join(PATHS))
+
+
+def usage_error(message):
+    print(message, file=sys.stderr)
+    print(USAGE, file=sys.stderr)
+    sys.exit(2)
+
+
+def main():
+    methods = None
+    sizes = DEFAULT_SIZES
+    paths = ','.join(PATHS)
+    duration = 0.2
+    output = None
+    baseline_path = None
+    threshold = 10
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'hm:s:p:t:o:b:',
+                                      ['help', 'threshold='])
+        for key, value in optlist:
+            if key in ('-h', '--help'):
+                print(USAGE)
+                sys.exit(0)
+            elif key == '-m':
+                methods = value.split(',')
+            elif key == '-s':
+                sizes = value
+            elif key == '-p':
+                paths = value
+            elif key == '-t':
+                duration = float(value)
+            elif key == '-o':
+                output = value
+            elif key == '-b':
+                baseline_path = value
+            elif key == '--threshold':
+                threshold = float(value)
+        sizes = [int(size) for size in sizes.split(',')]
+    except (getopt.GetoptError, ValueError) as e:
+        usage_error(e)
+    if args:
+        usage_error('unexpected arguments: %s' % ' '.join(args))
+
+    if methods is None:
+        methods = sorted(encrypt.method_supported.keys())
+    paths = paths.split(',')
+    for path in paths:
+        if path not in PATHS:
+            usage_error('unknown path %s' % path)
+
+    report = run(methods, sizes, paths, duration)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, threshold)
+        for r, b, change in regressions:
+            print('regression: %s %s %d: %.2f MB/s, was %.2f MB/s (%.1f%%)' %
+                  (r['method'], r['path'], r['size'], r['mb_per_s'],
+                   b['mb_per_s'], change), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()